@@ -115,12 +115,15 @@ from qff.frame.order import (
 from qff.frame.api import (
     set_benchmark,
     set_slippage,
+    set_volume_ratio,
     set_order_cost,
     run_daily,
     run_file,
     set_universe,
     pass_today
 )
+from qff.frame.sweep import run_sweep
+from qff.price.shared import publish_market_data, attach_market_data, remove_market_data
 
 from qff.helper.formula import (
     ABS,
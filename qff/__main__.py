@@ -35,7 +35,7 @@ import textwrap
 from typing import Dict, Optional
 from qff import __version__
 from qff.frame.cli import Command, RunCommand, SimTradeCommand, ConfigCommand, CreateCommand, SaveCommand, \
-    ResumeCommand, DropCommand, DbinfoCommand, KshowCommand
+    ResumeCommand, DropCommand, DbinfoCommand, KshowCommand, SweepCommand
 
 
 desc = """
@@ -74,6 +74,7 @@ def main(args: Optional[List[str]] = None) -> int:
     cmd_dict: Dict[str, Command] = {
         'run': RunCommand(sub_parser),
         'sim': SimTradeCommand(sub_parser),
+        'sweep': SweepCommand(sub_parser),
         'resume': ResumeCommand(sub_parser),
         'config': ConfigCommand(sub_parser),
         'create': CreateCommand(sub_parser),
@@ -30,14 +30,15 @@ from datetime import datetime
 from typing import Optional, Callable
 from qff.tools.logs import log
 from qff.tools.date import is_trade_day, get_real_trade_date, util_date_valid, get_pre_trade_day
-from qff.frame.context import context, strategy
+from qff.frame.context import context, strategy, g
 from qff.frame.portfolio import Portfolio
 from qff.frame.const import RUN_TYPE
 from qff.frame.backtest import back_test_run
 from qff.frame.simtrade import sim_trade_run
 from qff.price.cache import ContextData
+from qff.price.shared import attach_market_data
 
-__all__ = ['set_benchmark', 'set_order_cost', 'set_slippage', 'run_daily', 'run_file',
+__all__ = ['set_benchmark', 'set_order_cost', 'set_slippage', 'set_volume_ratio', 'run_daily', 'run_file',
            'set_universe', 'pass_today']
 
 
@@ -67,10 +68,11 @@ def _wrap_strategy_func(func_obj, include_data=False):
         return None
 
 
-def _load_strategy_file(path):
+def _load_strategy_file(path, params=None):
     """
     装载策略文件
     :param path: 策略文件的路径
+    :param params: 策略参数字典，导入后覆盖策略模块中的同名全局变量
     :return (boolean): 返回加载是否成功
     """
     # 1、导入策略文件
@@ -83,6 +85,10 @@ def _load_strategy_file(path):
         log.error('策略文件路径！{}'.format(path))
         return False
 
+    if params is not None:
+        for key, value in params.items():
+            setattr(module, key, value)
+
     # 2、给strategy策略对象赋函数指针
 
     strategy.initialize = _wrap_strategy_func(_getattr(module, 'initialize'))
@@ -271,6 +277,24 @@ def set_slippage(slippage=0.00246):
     return
 
 
+def set_volume_ratio(ratio=0):
+    # type: (float) -> None
+    """
+    设置成交量比例(回测专用)
+
+    默认撮合时不考虑成交量，订单一次全部成交。设置成交量比例后，每个分钟bar的成交数量不超过该bar成交量乘以成交量比例(按整手计算)，
+    未成交的部分在后续bar中继续撮合，收盘时仍未成交的部分撤销。适用于流动性较差的小市值股票回测。
+
+    :param ratio: 成交量比例，取值范围(0, 1]，如0.25表示最多成交bar成交量的25%，0表示不考虑成交量
+
+    """
+    if ratio < 0 or ratio > 1:
+        log.error("参数ratio不合法！取值范围为[0, 1]")
+        return
+    context.volume_ratio = ratio
+    return
+
+
 # context.universe = ['000001', '601567', '000166', '601636'] 测试使用
 def set_universe(security_list):
     # type: (list) -> None
@@ -310,7 +334,11 @@ def run_file(strategy_file: str,
              name: Optional[str] = None,
              output_dir: Optional[str] = None,
              log_level: str = 'info',
-             trace: bool = False):
+             trace: bool = False,
+             prefetch: bool = False,
+             params: Optional[dict] = None,
+             shared_data: Optional[list] = None,
+             report: bool = True):
     """
     运行策略文件，并初始化环境参数。
 
@@ -325,6 +353,12 @@ def run_file(strategy_file: str,
     :param output_dir: 指定结果数据输出目录
     :param log_level: 控制台日志输出的级别, 有效值为 'debug', 'info', 'warning', 'error'，默认值为‘info’
     :param trace: 策略运行过程中是否进行交互,模拟交易时自动有效
+    :param prefetch: 回测开始前是否批量预载入股票池及基准指数的行情数据，以减少回测过程中的数据库查询
+    :param params: 策略参数字典，策略文件导入后赋值给策略模块中的同名全局变量，initialize执行后赋值给全局对象g的同名属性，
+                   用于参数寻优(参见 :func:`.run_sweep` )
+    :param shared_data: 共享行情数据名称列表，回测前以只读方式映射由 :func:`.publish_market_data` 发布的行情数据，
+                        多个回测进程共享同一份数据
+    :param report: 回测完成后是否保存context数据文件(pkl)并生成策略运行报告，参数寻优时只收集风险指标，设置为False
 
     :return: None
 
@@ -340,21 +374,27 @@ def run_file(strategy_file: str,
     log.set_level(log_level)
     log.debug('调用run_file' + str(locals()).replace('{', '(').replace('}', ')'))
 
-    if not _load_strategy_file(strategy_file):
+    if not _load_strategy_file(strategy_file, params):
         print("输入的策略文件路径加载失败！")
         return
     context.strategy_file = strategy_file
 
+    for name in (shared_data or []):
+        attach_market_data(name)
+
     if resume:
         if strategy.process_initialize is not None:
             strategy.process_initialize()
         if context.run_type == RUN_TYPE.BACK_TEST:
-            back_test_run(trace)
+            back_test_run(trace, prefetch, report)
         else:
             sim_trade_run()
     else:
         context.log_file = log.file_name
         strategy.initialize()
+        if params is not None:
+            for key, value in params.items():
+                setattr(g, key, value)
 
         if freq in ['day', 'min', 'tick']:
             context.run_freq = freq
@@ -379,7 +419,7 @@ def run_file(strategy_file: str,
 
         if run_type == 'bt':
             _set_backtest_period(start, end)
-            back_test_run(trace)
+            back_test_run(trace, prefetch, report)
         elif run_type == 'sim':
             sim_trade_run()
         else:
@@ -30,21 +30,25 @@ import os
 import datetime
 
 from qff.frame.settle import settle_by_day, profit_analyse
-from qff.frame.order import order_broker
+from qff.frame.order import order_broker, reset_broker
 from qff.frame.context import context, strategy, run_strategy_funcs
 from qff.frame.const import RUN_TYPE, RUN_STATUS
 from qff.frame.backup import save_context
 from qff.frame.trace import Trace
 from qff.tools.date import get_trade_days, get_trade_min_list, get_pre_trade_day
 from qff.price.query import get_price
+from qff.price.panel import load_price_panel, clear_price_panel
+from qff.price.fund_index import fund_index
 from qff.tools.logs import log
 from qff.tools.local import cache_path
 
 
-def back_test_run(trace=False):
+def back_test_run(trace=False, prefetch=False, report=True):
     """
     回测框架运行函数,执行该函数将运行回测过程
     :param trace: 设置策略运行过程中是否进行交互
+    :param prefetch: 是否在回测开始前批量预载入股票池(context.universe)及基准指数的行情数据面板
+    :param report: 回测完成后是否保存context数据文件(pkl)并生成策略运行报告
     :return 无返回值
 
     """
@@ -70,8 +74,15 @@ def back_test_run(trace=False):
         return
 
     context.bm_start = context.bm_data.iloc[0].close
+
+    if prefetch:
+        if len(context.universe) == 0:
+            log.warning("股票池context.universe为空，仅预载入基准指数行情数据！")
+        load_price_panel(context.universe, context.current_dt[0:10], context.end_date, 'stock')
+        load_price_panel([context.benchmark], context.current_dt[0:10], context.end_date, 'index')
+
     if trace:
-        bt_thread = threading.Thread(target=_back_test_run)
+        bt_thread = threading.Thread(target=_back_test_run, args=(report,))
         bt_thread.setDaemon(True)
         # 运行命令行环境...
         trace = Trace(bt_thread)
@@ -81,11 +92,12 @@ def back_test_run(trace=False):
         bt_thread.join()
         log.warning("回测框架运行结束！")
     else:
-        _back_test_run()
+        _back_test_run(report)
 
 
-def _back_test_run():
+def _back_test_run(report=True):
     log.debug('_back_test_run(): 回测线程开始运行...')
+    reset_broker()
     days = get_trade_days(context.current_dt[0:10], context.end_date)  # 回测中断恢复时可继续运行
     for day in days:
         if context.status != RUN_STATUS.RUNNING:
@@ -161,7 +173,10 @@ def _back_test_run():
             strategy.on_strategy_end()
 
         context.run_end = datetime.datetime.now()
-        profit_analyse()
+        clear_price_panel()
+        fund_index.clear()
+        if report:
+            profit_analyse()
 
         # log.error("回测运行完成!，执行quit退出交互环境后进行回测数据分析")
         log.info("_back_test_run回测线程运行完成!")
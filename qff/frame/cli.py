@@ -22,11 +22,13 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import ast
 import argparse
 import textwrap
 import os
 from datetime import datetime
 from qff.frame.api import run_file
+from qff.frame.sweep import run_sweep
 
 from qff.frame.backup import load_context
 from qff.frame.context import context
@@ -93,6 +95,9 @@ class RunCommand(Command):
         self.parser.add_argument("-o", "--output-dir", help="结果数据输出到指定目录,默认<home>/.qff/output/")
         self.parser.add_argument("-t", "--trace", action='store_true', help="策略运行过程中是否进行交互,模拟交易时自动生效")
         self.parser.add_argument("--resume", action='store_true', help="恢复前期暂停的策略运行，一般用于模拟交易中")
+        self.parser.add_argument("-p", "--prefetch", action='store_true', help="回测开始前批量预载入股票池及基准指数的行情数据")
+        self.parser.add_argument("--shared-data", action='append', metavar="<name>",
+                                 help="映射已发布的共享行情数据，可重复输入多个名称")
         self.parser.add_argument("-l", "--log-level", choices=['verbose', 'info', 'warning', 'error'], default='info',
                                  help="设置控制台日志输出的级别，可选(verbose,info,warning,error),默认info")
 
@@ -158,6 +163,74 @@ class SimTradeCommand(Command):
         run_file(strategy_file, 'sim', **args)
 
 
+class SweepCommand(Command):
+    """
+    使用qff框架对指定策略文件进行参数寻优，多进程并行回测参数网格中的所有参数组合，汇总各组合的风险指标。
+    参数通过 -P name=v1,v2,... 指定，可重复输入多个参数，策略中通过同名的模块全局变量或g的属性读取参数值。
+
+    示例：qff sweep ma_cross.py -P short=5,10 -P long=20,30,60 -w 4 -s 2022-01-01 -e 2022-12-31
+    """
+    usage = f"\nqff sweep <strategy_file> -P <name=v1,v2,...> [options]"
+    summary = "对策略文件进行参数寻优"
+
+    def __init__(self, sub_parser):
+        super().__init__('sweep', sub_parser)
+
+    def add_options(self) -> None:
+        self.parser.add_argument("strategy_file", help="策略文件名称路径", nargs='?')
+        self.parser.add_argument("-P", "--param", action='append', default=[], metavar="<name=v1,v2,...>",
+                                 help="策略参数名称及取值列表，可重复输入多个参数")
+        self.parser.add_argument("-w", "--workers", type=int, help="并行进程数量，默认为CPU核数", metavar="<n>")
+        self.parser.add_argument("-n", "--name", help="策略名称,默认为策略文件名", metavar="<name>")
+        self.parser.add_argument("-f", "--freq", choices=['day', 'min'], default='day',
+                                 help="设置回测执行频率,可选(day, min),默认day")
+        self.parser.add_argument("-c", "--cash", type=int, help="设置账户初始资金，默认￥1,000,000", metavar="<money>", default=1000000)
+        self.parser.add_argument("-s", "--start", type=lambda s: datetime.strptime(s, '%Y-%m-%d').strftime('%Y-%m-%d'),
+                                 help="设置回测开始日期,默认为结束日期前60个交易日", metavar="<YYYY-MM-DD>")
+        self.parser.add_argument("-e", "--end", type=lambda s: datetime.strptime(s, '%Y-%m-%d').strftime('%Y-%m-%d'),
+                                 help="设置回测结束日期,默认为当日之前最近一个交易日", metavar="<YYYY-MM-DD>")
+        self.parser.add_argument("-o", "--output-dir", help="结果数据输出到指定目录,默认<home>/.qff/output/")
+        self.parser.add_argument("-p", "--prefetch", action='store_true', help="预先载入股票池及基准指数的行情数据，供各进程共享")
+        self.parser.add_argument("-l", "--log-level", choices=['verbose', 'info', 'warning', 'error'], default='error',
+                                 help="设置子进程控制台日志输出的级别，可选(verbose,info,warning,error),默认error")
+
+    @staticmethod
+    def _parse_value(value):
+        try:
+            return ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            return value
+
+    def main(self, args):
+        args = vars(args)
+        args.pop('cmd')
+        strategy_file = args.pop('strategy_file')
+
+        if strategy_file is None:
+            print('Error:参数strategy_file必须指定！\n')
+            self.parser.print_help()
+            return
+        elif not os.path.exists(strategy_file):
+            print(f'输入的策略文件不存在!{strategy_file}')
+            return
+
+        param_grid = {}
+        for item in args.pop('param'):
+            if '=' not in item:
+                print(f'参数格式错误，应为name=v1,v2,...: {item}')
+                return
+            key, values = item.split('=', 1)
+            param_grid[key.strip()] = [self._parse_value(v.strip()) for v in values.split(',')]
+        if len(param_grid) == 0:
+            print('Error:至少需要通过-P指定一个参数！\n')
+            self.parser.print_help()
+            return
+
+        df = run_sweep(strategy_file, param_grid, **args)
+        if df is not None:
+            print_df(df)
+
+
 class ResumeCommand(Command):
     """
 
@@ -328,6 +401,7 @@ class SaveCommand(Command):
         ⌨️命令格式：qff save init_info         : 初始化股票列表、指数列表、ETF列表                                        \n\
         ⌨️命令格式：qff save init_name         : 初始化股票历史更名数据                                                        \n\
         ⌨️命令格式：qff save save_delist       : 保存退市股票的日数据和分钟数据                                                 \n\
+        ⌨️命令格式：qff save parquet           : 导出行情数据至本地Parquet文件                                                 \n\
         ----------------------------------------------------------------------------------------------------------------------\n\
 
     """
@@ -347,7 +421,7 @@ class SaveCommand(Command):
                 args.subcommand not in ['all', 'day', 'min', 'stock_list', 'stock_day', 'index_day', 'etf_day',
                                         'stock_min', 'index_min', 'etf_min', 'stock_xdxr', 'stock_block', 'report',
                                         'valuation', 'mtss', 'index_stock', 'industry_stock', 'init_info', 'init_name',
-                                        'save_delist']:
+                                        'save_delist', 'parquet']:
 
             self.parser.print_help()
             return
@@ -103,6 +103,7 @@ class Context:
         self.bm_data = None
         self.bm_start = None            # 基准指数回测前一天的收盘点数
         self.slippage = 0.00246         # 固定滑点
+        self.volume_ratio = 0           # 成交量比例，0表示撮合时不考虑成交量
         self.universe = []              # 股票池，通过set_universe(stock_list)设定
         self.trade_cost = TradeCost()   # 股票交易费用对象
         self.portfolio = None           # 股票账户信息对象
@@ -230,6 +231,16 @@ context = Context()
 g = GlobalVar()
 
 
+def reset_globals():
+    """
+    重置全局对象context、strategy和g，用于在同一进程中重新运行策略
+    """
+    context.__init__()
+    strategy.__init__()
+    g.__dict__.clear()
+    g.__init__()
+
+
 def run_strategy_funcs(strategy_funcs):
     # try:
     if isinstance(strategy_funcs, list):
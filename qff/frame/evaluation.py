@@ -46,8 +46,11 @@
 """
 import os
 import sys
+import multiprocessing
+import pickle
+import numpy as np
 import pandas as pd
-from typing import List, Callable
+from typing import List, Callable, Dict, Optional, Union
 import inspect
 import matplotlib.pyplot as plt
 from qff.tools.logs import log
@@ -344,23 +347,23 @@ def _plot_eval_data(data: pd.DataFrame, title: str = None, filename=None):
     return
 
 
-def _strategy_run(get_signal_fun: Callable, hold_gaps, start, end, stock_list) -> pd.DataFrame:
+def _collect_pairs(get_signal_fun, hold_gaps, start, end, stock_list, klines=None):
+    # type: (Callable, list, str, str, List[str], Optional[Dict[str, pd.DataFrame]]) -> list
     """
-    策略运行函数，执行get_signal_fun，根据返回值生成pnl数据
-    :param get_signal_fun: 择时函数,获取买点信号，输入参数为（code,kline数据), 返回值List[date_str]
-    :param hold_gaps : 持仓周期，评估策略在不同持仓周期下的表现，默认[1, 3, 5, 10, 20]
-    :param start: 评价测试开始日期
-    :param end: 评价测试结束日期
-    :param stock_list: 评价测试使用的股票集合，为None表示当前所有上市股票
-    :return: pd.DataFrame，columns=['code', 'sell_date', 'buy_date', 'sell_price', 'buy_price',
-            'hold_gap', 'pnl_ratio', 'pnl_money']
+    逐只股票执行择时函数，收集买点及各持仓周期对应的卖点数据
+    :param klines: 预先载入的{code: kline}数据，为None时逐只股票查询
+    :return: List[[code, sell_date, buy_date, sell_price, buy_price, hold_gap]]
     """
     pair_table = []
-    # fetch_start = get_pre_trade_day(start, 250)[:10]  # 为了取年线数据
     for i in range(len(stock_list)):
         code = stock_list[i]
-        log.info("正在执行策略函数{}/{}，当前股票代码：{}".format(i, len(stock_list), code))
-        kline: pd.DataFrame = get_price(code, start, end)
+        if klines is None:
+            log.info("正在执行策略函数{}/{}，当前股票代码：{}".format(i, len(stock_list), code))
+            kline: pd.DataFrame = get_price(code, start, end)
+        else:
+            kline = klines.get(code)
+        if kline is None or len(kline) == 0:
+            continue
         signal_list = get_signal_fun(code, kline)
         if signal_list and isinstance(signal_list, list):
             for buy_date in signal_list:
@@ -387,6 +390,73 @@ def _strategy_run(get_signal_fun: Callable, hold_gaps, start, end, stock_list) -
                             gap
                         ]
                     )
+    return pair_table
+
+
+_worker_signal_fun = None
+
+
+def _init_worker(get_signal_fun):
+    # 进程池初始化函数，保存父进程序列化传入的择时函数
+    global _worker_signal_fun
+    _worker_signal_fun = get_signal_fun
+
+
+def _shard_worker(task):
+    index, hold_gaps, start, end, codes = task
+    # 批量载入本分片所有股票的K线数据，再按股票代码切片
+    data = get_price(codes, start, end)
+    klines = {}
+    if data is not None:
+        if len(codes) == 1:
+            klines[codes[0]] = data
+        else:
+            for code, kline in data.groupby(level='code'):
+                klines[code] = kline.droplevel('code')
+    return index, len(codes), _collect_pairs(_worker_signal_fun, hold_gaps, start, end, codes, klines)
+
+
+def _strategy_run(get_signal_fun: Callable, hold_gaps, start, end, stock_list, workers=None,
+                  shard_size=50) -> pd.DataFrame:
+    """
+    策略运行函数，执行get_signal_fun，根据返回值生成pnl数据
+    :param get_signal_fun: 择时函数,获取买点信号，输入参数为（code,kline数据), 返回值List[date_str]
+    :param hold_gaps : 持仓周期，评估策略在不同持仓周期下的表现，默认[1, 3, 5, 10, 20]
+    :param start: 评价测试开始日期
+    :param end: 评价测试结束日期
+    :param stock_list: 评价测试使用的股票集合，为None表示当前所有上市股票
+    :param workers: 并行进程数量，大于1时将股票集合按shard_size分片，在进程池中并行执行择时函数
+    :param shard_size: 每个分片的股票数量，分片内的K线数据一次批量载入
+    :return: pd.DataFrame，columns=['code', 'sell_date', 'buy_date', 'sell_price', 'buy_price',
+            'hold_gap', 'pnl_ratio', 'pnl_money']
+    """
+    if workers is not None and workers > 1:
+        try:
+            pickle.dumps(get_signal_fun)
+            if getattr(get_signal_fun, '__module__', None) == '__main__' and \
+                    not hasattr(sys.modules['__main__'], '__file__'):
+                raise TypeError('交互环境中定义的函数不能在子进程中导入')
+        except Exception as e:
+            log.warning(f"择时函数无法传递给子进程，改为单进程执行！应使用模块级函数：{e}")
+            workers = None
+
+    if workers is not None and workers > 1:
+        tasks = [(i, hold_gaps, start, end, stock_list[pos:pos + shard_size])
+                 for i, pos in enumerate(range(0, len(stock_list), shard_size))]
+        # 父进程中已有pymongo等后台线程，不使用fork方式，避免子进程继承被其他线程持有的锁而死锁
+        methods = multiprocessing.get_all_start_methods()
+        mp = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        shards: List[Optional[list]] = [None] * len(tasks)
+        finished = 0
+        with mp.Pool(processes=workers, initializer=_init_worker, initargs=(get_signal_fun,)) as pool:
+            for index, count, pairs in pool.imap_unordered(_shard_worker, tasks):
+                shards[index] = pairs
+                finished += count
+                log.info("正在执行策略函数{}/{}，已完成分片：{}/{}".format(finished, len(stock_list),
+                                                                 sum(x is not None for x in shards), len(tasks)))
+        pair_table = [pair for pairs in shards for pair in pairs]
+    else:
+        pair_table = _collect_pairs(get_signal_fun, hold_gaps, start, end, stock_list)
 
     pair_title = ['code', 'sell_date', 'buy_date', 'sell_price', 'buy_price', 'hold_gap']
     pnl = pd.DataFrame(pair_table, columns=pair_title)
@@ -395,18 +465,101 @@ def _strategy_run(get_signal_fun: Callable, hold_gaps, start, end, stock_list) -
     return pnl
 
 
-def strategy_eval(get_signal_fun: Callable,
+def _signal_matrix(signals, index, columns):
+    # type: (Union[pd.DataFrame, Dict[str, List[str]]], pd.Index, pd.Index) -> pd.DataFrame
+    """
+    将买点信号转换为与收盘价面板对齐的布尔矩阵
+
+    :param signals: 布尔型DataFrame(行索引为日期, 列为股票代码), 或者{code: List[date_str]}格式的字典
+    :param index: 收盘价面板的日期索引
+    :param columns: 收盘价面板的股票代码
+    :return: pd.DataFrame，行索引为index，列为columns，值为bool
+    """
+    if isinstance(signals, pd.DataFrame):
+        matrix = signals.copy()
+        matrix.index = matrix.index.astype(str).str[:10]
+        return matrix.reindex(index=index, columns=columns).fillna(False).astype(bool)
+
+    values = np.zeros((len(index), len(columns)), dtype=bool)
+    col_loc = {code: i for i, code in enumerate(columns)}
+    for code, date_list in signals.items():
+        if code not in col_loc or not date_list:
+            continue
+        rows = index.get_indexer([str(x)[:10] for x in date_list])
+        values[rows[rows >= 0], col_loc[code]] = True
+    return pd.DataFrame(values, index=index, columns=columns)
+
+
+def _signal_run(signals, hold_gaps, start, end, stock_list) -> pd.DataFrame:
+    """
+    向量化的信号评价函数，一次载入全部股票的收盘价面板，通过数组平移计算所有持仓周期的收益，生成与_strategy_run相同的pnl数据
+    :param signals: 买点信号，布尔型DataFrame(行索引为日期, 列为股票代码)，或者{code: List[date_str]}格式的字典
+    :param hold_gaps : 持仓周期列表
+    :param start: 评价测试开始日期
+    :param end: 评价测试结束日期
+    :param stock_list: 评价测试使用的股票集合
+    :return: pd.DataFrame，columns=['code', 'sell_date', 'buy_date', 'sell_price', 'buy_price',
+            'hold_gap', 'pnl_ratio', 'pnl_money']
+    """
+    pair_title = ['code', 'sell_date', 'buy_date', 'sell_price', 'buy_price', 'hold_gap']
+    log.info("正在载入{}只股票的收盘价数据...".format(len(stock_list)))
+    data = get_price(stock_list, start, end, fields=['close'])
+    if data is None:
+        pnl = pd.DataFrame(columns=pair_title)
+    else:
+        if len(stock_list) == 1:
+            close = data[['close']].rename(columns={'close': stock_list[0]})
+        else:
+            close = data['close'].unstack('code')
+        close = close.sort_index()
+        close.index = close.index.astype(str).str[:10]
+
+        prices = close.values.astype('float64')
+        buy_mask = _signal_matrix(signals, close.index, close.columns).values & ~np.isnan(prices)
+        dates = close.index.values
+        codes = close.columns.values
+        n = len(prices)
+        frames = []
+        for gap in hold_gaps:
+            gap = int(gap)
+            if gap >= n:
+                continue
+            buy_price = prices[:n - gap]
+            sell_price = prices[gap:]
+            rows, cols = np.nonzero(buy_mask[:n - gap] & ~np.isnan(sell_price))
+            frames.append(pd.DataFrame({
+                'code': codes[cols],
+                'sell_date': dates[rows + gap],
+                'buy_date': dates[rows],
+                'sell_price': sell_price[rows, cols],
+                'buy_price': buy_price[rows, cols],
+                'hold_gap': gap
+            }))
+        if len(frames) > 0:
+            pnl = pd.concat(frames, ignore_index=True)
+            pnl = pnl.sort_values(['code', 'buy_date', 'hold_gap'], kind='mergesort').reset_index(drop=True)
+        else:
+            pnl = pd.DataFrame(columns=pair_title)
+
+    pnl['pnl_ratio'] = round((pnl.sell_price / pnl.buy_price) - 1, 4)
+    pnl['pnl_money'] = pnl['pnl_ratio'] * 10000
+    return pnl
+
+
+def strategy_eval(get_signal_fun: Optional[Callable],
                   name: str = None,
                   desc: str = None,
                   hold_gaps: List[str] = None,
                   start: str = '2010-01-04',
                   end: str = '2022-05-06',
                   security: List[str] = None,
-                  csv: str = None) -> None:
+                  csv: str = None,
+                  signals: Union[pd.DataFrame, Dict[str, List[str]]] = None,
+                  workers: int = None) -> None:
     """
     策略评价函数， 对每个股票的历史曲线数据进行择时，分析策略运行效果，并生成策略评价报告word文件。
 
-    :param get_signal_fun: 择时函数,获取买点信号，输入参数为（code,kline数据), 返回值List[date_str]
+    :param get_signal_fun: 择时函数,获取买点信号，输入参数为（code,kline数据), 返回值List[date_str]。提供signals参数时可以为None
     :param name: 策略名称
     :param desc: 策略描述
     :param hold_gaps: 持仓周期，评估策略在不同持仓周期下的表现，默认[1, 3, 5, 10, 20]
@@ -414,6 +567,11 @@ def strategy_eval(get_signal_fun: Callable,
     :param end: 评价测试结束日期
     :param security: 评价测试使用的股票集合，为None表示当前所有上市股票
     :param csv: 保存pnl的数据文件,如果存在该文件，则直接使用该文件数据，否则运行策略函数，并将运行结果保存至csv文件中。
+    :param signals: 预先计算的买点信号，可以是布尔型DataFrame(行索引为日期, 列为股票代码, True表示买点)，也可以是
+        {code: List[date_str]}格式的字典。提供该参数时不再逐只股票运行择时函数，而是一次载入收盘价面板，向量化计算
+        各持仓周期的收益；security为None时使用signals中的股票代码。
+    :param workers: 并行进程数量，大于1时将股票集合分片，在进程池中并行执行择时函数，每个分片的K线数据批量载入。
+        择时函数需为模块级函数，以便序列化后传递给子进程，无法序列化时(如lambda)改为单进程执行。
 
     :return: None
 
@@ -428,11 +586,21 @@ def strategy_eval(get_signal_fun: Callable,
         stock_list = pnl['code'].unique().tolist()
         hold_gaps = pnl['hold_gap'].unique()
     else:
-        log.info("开始执行策略函数，收集买点信号...")
-        stock_list = security if security else get_stock_list()
         if hold_gaps is None:
             hold_gaps = [1, 3, 5, 10, 20]
-        pnl: pd.DataFrame = _strategy_run(get_signal_fun, hold_gaps, start, end, stock_list)
+        if signals is not None:
+            log.info("开始向量化计算买点信号收益...")
+            if security:
+                stock_list = security
+            elif isinstance(signals, pd.DataFrame):
+                stock_list = signals.columns.tolist()
+            else:
+                stock_list = list(signals.keys())
+            pnl: pd.DataFrame = _signal_run(signals, hold_gaps, start, end, stock_list)
+        else:
+            log.info("开始执行策略函数，收集买点信号...")
+            stock_list = security if security else get_stock_list()
+            pnl: pd.DataFrame = _strategy_run(get_signal_fun, hold_gaps, start, end, stock_list, workers)
         if csv:
             pnl.to_csv(csv_file)
 
@@ -457,7 +625,10 @@ def strategy_eval(get_signal_fun: Callable,
     else:
         reporter.add_paragraph("策略描述略！")
     reporter.add_heading('2、代码：', level=2)
-    reporter.add_paragraph(inspect.getsource(get_signal_fun))
+    if get_signal_fun is not None:
+        reporter.add_paragraph(inspect.getsource(get_signal_fun))
+    else:
+        reporter.add_paragraph("买点信号由信号矩阵直接提供。")
     reporter.add_heading('3、测试参数：', level=2)
     reporter.add_paragraph("测试周期：{} - {},共{}个交易日".format(start, end, get_trade_gap(start, end)))
     reporter.add_paragraph("样本数量：共{}只股票".format(len(stock_list)))
@@ -22,6 +22,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import numpy as np
 import pandas as pd
 from qff.price.cache import get_current_data
 from qff.frame.context import context
@@ -30,7 +31,8 @@ from qff.frame.const import RUN_TYPE, ORDER_TYPE, ORDER_STATUS
 from qff.price.query import get_stock_name
 from qff.tools.utils import util_gen_id
 from qff.tools.logs import log
-from typing import Dict, Callable, Optional
+from qff.tools.date import get_trade_min_list
+from typing import Dict, List, Callable, Optional
 
 
 # 订单未完成, 无任何成交
@@ -58,7 +60,8 @@ class Order:
     cancel_time    str                       订单取消时间
     style          :class:`.ORDER_TYPE`      订单类型，市价单还是限价单
     order_price    float                     委托价格,当订单为限价单时
-    trade_amount   int                       成交数量
+    trade_amount   int                       成交数量，部分成交时为累计成交数量
+    remaining      int                       未成交数量
     trade_money    float                     成交金额(含交易费用）
     trade_price    float                     成交均价，等于成交金额除以成交数量,包含了交易费用分摊
     commission     float                     交易费用（佣金、税费等）
@@ -126,69 +129,94 @@ class Order:
     def __repr__(self):
         return self.message
 
-    def deal(self, deal_time=None):
+    @property
+    def remaining(self):
+        """
+        未成交数量
+        """
+        return self.amount - self.trade_amount
+
+    def deal(self, deal_time=None, amount=None):
         """
         订单成交
 
+        :param deal_time: 成交时间，默认为当前时间
+        :param amount: 本次成交数量，默认为全部未成交数量。小于未成交数量时为部分成交，订单仍为OPEN状态
         :return:
         """
-
-        money = round(self.order_price * self.amount, 2)
-        self.trade_amount = self.amount
+        amount = self.remaining if amount is None else min(int(amount), self.remaining)
+        if amount <= 0:
+            return
+
+        # 交易费用按累计成交金额计算，本次成交分摊累计费用的增量，全部成交时与一次成交的费用一致
+        pre_money = round(self.order_price * self.trade_amount, 2)
+        self.trade_amount += amount
+        money = round(self.order_price * self.trade_amount, 2)
         if self.is_buy:
-            self.commission = round(max(money * context.trade_cost.open_commission,
-                                        context.trade_cost.min_commission) + money * context.trade_cost.open_tax, 2)
-            self.trade_money = money + self.commission
+            commission = round(max(money * context.trade_cost.open_commission,
+                                   context.trade_cost.min_commission) + money * context.trade_cost.open_tax, 2)
+            deal_money = money - pre_money + commission - self.commission
         else:
-            self.commission = round(max(money * context.trade_cost.close_commission,
-                                        context.trade_cost.min_commission) + money * context.trade_cost.close_tax, 2)
-            self.trade_money = money - self.commission
+            commission = round(max(money * context.trade_cost.close_commission,
+                                   context.trade_cost.min_commission) + money * context.trade_cost.close_tax, 2)
+            deal_money = money - pre_money - (commission - self.commission)
             # 股票卖出时，计算该订单的收益
-            self.gain = round(self.trade_money -
-                              context.portfolio.positions[self.security].avg_cost * self.trade_amount, 2)
+            self.gain = round(self.gain + deal_money -
+                              context.portfolio.positions[self.security].avg_cost * amount, 2)
+        self.commission = commission
+        self.trade_money += deal_money
 
         self.trade_price = round(self.trade_money / self.trade_amount, 2)
         self.deal_time = deal_time if deal_time is not None else context.current_dt
+        deal_type = "订单成交" if self.remaining == 0 else "订单部分成交"
 
         # 对账户资金或股票数据进行更新
         if self.is_buy:  # 买入
-            context.portfolio.locked_cash -= self.lock_money
+            context.portfolio.locked_cash -= deal_money
+            self.lock_money -= deal_money
             if self.security in context.portfolio.positions.keys():
                 # 加仓
                 position: Position = context.portfolio.positions[self.security]
-                position.today_open_amount += self.trade_amount  # 当日加仓数量
+                position.today_open_amount += amount  # 当日加仓数量
                 position.today_open_price = self.trade_price  # 当日买入单价
                 position.transact_time = self.deal_time  # 最后交易时间
-                position.avg_cost = round((position.avg_cost * position.total_amount + self.trade_money)
-                                          / (position.total_amount + self.trade_amount), 2)  # 当前持仓成本
-                position.acc_avg_cost = round((position.acc_avg_cost * position.total_amount + self.trade_money)
-                                              / (position.total_amount + self.trade_amount), 2)  # 累计持仓成本
-                position.total_amount += self.trade_amount  # 总仓位
+                position.avg_cost = round((position.avg_cost * position.total_amount + deal_money)
+                                          / (position.total_amount + amount), 2)  # 当前持仓成本
+                position.acc_avg_cost = round((position.acc_avg_cost * position.total_amount + deal_money)
+                                              / (position.total_amount + amount), 2)  # 累计持仓成本
+                position.total_amount += amount  # 总仓位
 
             else:
                 # 生成一个position对象
-                position = Position(self.security, self.security_name, self.deal_time, self.trade_amount,
+                position = Position(self.security, self.security_name, self.deal_time, amount,
                                     self.trade_price)
                 context.portfolio.positions[self.security] = position
 
-            log.info("订单成交：买入，订单编号：{}，股票代码：{}，下单数量：{}， 成交时间：{}.".
-                     format(self.id, self.security, self.trade_amount, self.deal_time))
+            log.info("{}：买入，订单编号：{}，股票代码：{}，成交数量：{}， 成交时间：{}.".
+                     format(deal_type, self.id, self.security, amount, self.deal_time))
 
         else:  # 卖出
-            context.portfolio.available_cash += self.trade_money
+            context.portfolio.available_cash += deal_money
             position: Position = context.portfolio.positions[self.security]
-            position.locked_amount -= self.amount  # 挂单冻结仓位
+            position.locked_amount -= amount  # 挂单冻结仓位
             position.transact_time = self.deal_time  # 最后交易时间
-            if position.total_amount > self.trade_amount:
-                position.acc_avg_cost = round((position.acc_avg_cost * position.total_amount - self.trade_money)
-                                              / (position.total_amount - self.amount), 2)  # 累计持仓成本
-            position.total_amount -= self.trade_amount  # 总仓位
+            if position.total_amount > amount:
+                position.acc_avg_cost = round((position.acc_avg_cost * position.total_amount - deal_money)
+                                              / (position.total_amount - amount), 2)  # 累计持仓成本
+            position.total_amount -= amount  # 总仓位
             if position.total_amount == 0:
                 context.portfolio.positions.pop(position.security)
 
-            log.info("订单成交：卖出，订单编号：{}，股票代码：{}，下单数量：{}， 成交时间：{}.".
-                     format(self.id, self.security, self.trade_amount, self.deal_time))
+            log.info("{}：卖出，订单编号：{}，股票代码：{}，成交数量：{}， 成交时间：{}.".
+                     format(deal_type, self.id, self.security, amount, self.deal_time))
 
+        if self.remaining > 0:
+            return
+
+        if self.is_buy:  # 释放剩余的锁定资金
+            context.portfolio.locked_cash -= self.lock_money
+            context.portfolio.available_cash += self.lock_money
+            self.lock_money = 0
         self.status = ORDER_STATUS.DEAL
 
         if self._callback is not None:
@@ -205,13 +233,14 @@ class Order:
         self.status = ORDER_STATUS.CANCELLED
         self.cancel_time = context.current_dt
 
-        # 对账户资金或股票进行解锁
+        # 对账户资金或股票进行解锁，部分成交的订单只解锁未成交部分
         if self.is_buy:  # 买入
             context.portfolio.locked_cash -= self.lock_money
             context.portfolio.available_cash += self.lock_money
+            self.lock_money = 0
         else:  # 卖出
-            context.portfolio.positions[self.security].locked_amount -= self.amount
-            context.portfolio.positions[self.security].closeable_amount += self.amount
+            context.portfolio.positions[self.security].locked_amount -= self.remaining
+            context.portfolio.positions[self.security].closeable_amount += self.remaining
         log.info("订单取消：订单编号：{}，股票代码：{}，下单数量：{}, {}."
                  .format(self.id, self.security, self.amount, ('买入' if self.is_buy else '卖出')))
         if self._callback is not None:
@@ -242,7 +271,8 @@ def order(security, amount=100, price=None, callback=None):
 
     订单撮合规则：
 
-    1. 为简化操作，撮合时不考虑成交量,一个订单一次成交记录
+    1. 默认撮合时不考虑成交量,一个订单一次成交记录；回测时可通过 :func:`.set_volume_ratio` 设置成交量比例，
+       每个bar的成交数量不超过该bar成交量乘以成交量比例，未成交部分在后续bar中继续撮合
     2. 市价单买入时按当前价格+滑点价格，转成限价单。如果当前价格为涨停价格，则订单取消。
     3. 市价单卖出时按当前价格-滑点价格，转成限价单。如果当前价格为跌停价格，则订单取消。
     4. 如果运行频率为天，则下单后立即撮合，读取剩余的分钟数据曲线,判断最高价是否大于委托价，是则成交。
@@ -327,6 +357,8 @@ def order(security, amount=100, price=None, callback=None):
                  format(_order.id, _order.security, amount, ('买入' if _order.is_buy else '卖出')))
         if context.run_freq == 'day' and context.run_type == RUN_TYPE.BACK_TEST:
             order_broker_day(_order.id)
+        else:
+            order_matcher.add(_order)
         return _order.id
     else:
         return None
@@ -493,27 +525,177 @@ def get_open_orders():
     return rtn
 
 
+_day_capacity: Dict[str, tuple] = {}  # 股票代码 -> (交易日, 当日分钟数据时间数组, 各bar剩余可成交数量)
+
+
 def order_broker_day(order_id):
     """
     如果回测运行频率为 'day',则立即进行订单撮合
+
+    新订单加入后，对该股票全部未完成订单按下单顺序一次撮合：以剩余分钟数据的最低价/最高价数组一次性计算各订单的成交bar。
+    设置成交量比例时，同一股票当日各bar的剩余可成交数量在订单之间及多次撮合之间共享，已占用的数量不再重复分配
     :param order_id:
     :return: None
     """
     log.debug('调用order_broker_day' + str(locals()).replace('{', '(').replace('}', ')'))
-    _order = context.order_list[order_id]
-    code = _order.security
+    code = context.order_list[order_id].security
+    orders = [_order for _order in context.order_list.values()
+              if _order.security == code and _order.status == ORDER_STATUS.OPEN]
 
     data: pd.DataFrame = get_current_data(code).min_data_after
-    if data is not None and len(data) > 1:
-        for i in range(0, len(data)):
-            if _order.is_buy:
-                if data.iloc[i].low <= _order.order_price:
-                    _order.deal(data.index[i])
-                    break
-            elif data.iloc[i].high >= _order.order_price:
-                _order.deal(data.index[i])
-                break
-    return
+    if data is None or len(data) <= 1 or len(orders) == 0:
+        return
+
+    low = data['low'].to_numpy()
+    high = data['high'].to_numpy()
+    is_buy = np.array([_order.is_buy for _order in orders])
+    price = np.array([_order.order_price for _order in orders], dtype='float64')
+    # 各订单在各bar是否可以成交，行为订单，列为bar
+    hit = np.where(is_buy[:, None], low[None, :] <= price[:, None], high[None, :] >= price[:, None])
+
+    capacity = _remaining_capacity(code, data) if 'vol' in data.columns else None
+    if capacity is None:
+        first = hit.argmax(axis=1)
+        for i in np.flatnonzero(hit.any(axis=1)):
+            orders[i].deal(data.index[first[i]])
+        return
+
+    # 依次占用各bar的剩余可成交数量，capacity为缓存数组的视图，占用后的数量保留到下次撮合
+    for i, _order in enumerate(orders):
+        fill = np.where(hit[i], capacity, 0)
+        cum = np.cumsum(fill)
+        qty = np.minimum(cum, _order.remaining) - np.minimum(cum - fill, _order.remaining)
+        capacity -= qty
+        for j in np.flatnonzero(qty):
+            _order.deal(data.index[j], int(qty[j]))
+
+
+def _remaining_capacity(code, data):
+    # type: (str, pd.DataFrame) -> Optional[np.ndarray]
+    """
+    返回剩余分钟数据各bar的剩余可成交数量，未设置成交量比例时返回None
+
+    同一交易日内多次撮合(如run_daily在不同时间下单)时，min_data_after是当日分钟数据的后段，返回缓存数组对应部分的视图
+    """
+    day = context.current_dt[0:10]
+    index = np.asarray(data.index, dtype=str)
+    cached = _day_capacity.get(code)
+    if cached is not None and cached[0] == day:
+        offset = int(np.searchsorted(cached[1], index[0]))
+        if len(cached[1]) - offset == len(index) and cached[1][offset] == index[0]:
+            return cached[2][offset:]
+    capacity = _volume_capacity(data['vol'].to_numpy())
+    if capacity is not None:
+        _day_capacity[code] = (day, index, capacity)
+    return capacity
+
+
+def _volume_capacity(vol):
+    # type: (np.ndarray) -> Optional[np.ndarray]
+    """
+    按成交量比例计算各bar可成交的股票数量(整手)，未设置成交量比例时返回None
+    """
+    ratio = getattr(context, 'volume_ratio', 0)
+    if not ratio:
+        return None
+    return (np.asarray(vol, dtype='float64') * ratio // 100).astype('int64') * 100
+
+
+class OrderMatcher:
+    """
+    分钟撮合引擎
+
+    未完成订单按股票分组保存。回测时各股票的当日分钟数据在首次撮合时对齐为按分钟序号访问的最低价/最高价/成交量数组，
+    每分钟撮合通过整数分钟游标读取数组，不再对分钟数据进行切片；模拟交易时仍读取实时行情。
+    撮合引擎不保存在context中，交易日变化(或框架恢复运行)时根据context.order_list重建。
+    """
+
+    def __init__(self):
+        self.day = None
+        self.books: Dict[str, List[Order]] = {}  # 按股票分组的未完成订单
+        self._ids = set()
+        self._grid = []
+        self._minute_index: Dict[str, int] = {}
+        self._bars: Dict[str, tuple] = {}  # 股票代码 -> (最低价数组, 最高价数组)
+
+    def _sync(self):
+        day = context.current_dt[0:10]
+        if day == self.day:
+            return
+        self.day = day
+        self.books.clear()
+        self._ids.clear()
+        self._bars.clear()
+        self._grid = get_trade_min_list(day)
+        self._minute_index = {dt: i for i, dt in enumerate(self._grid)}
+
+        # 防止框架恢复运行导入其他日期的context
+        stale = [_id for _id, _order in context.order_list.items() if _order.add_time[0:10] != day]
+        for _id in stale:
+            context.order_list.pop(_id)
+        for _order in context.order_list.values():
+            self._add(_order)
+
+    def _add(self, _order):
+        if _order.status == ORDER_STATUS.OPEN and _order.id not in self._ids:
+            self._ids.add(_order.id)
+            self.books.setdefault(_order.security, []).append(_order)
+
+    def add(self, _order):
+        # type: (Order) -> None
+        """
+        添加待撮合的订单
+        """
+        self._sync()
+        self._add(_order)
+
+    def _last_bar(self, code, cursor):
+        if cursor is None:
+            data = get_current_data(code)
+            return data.last_low, data.last_high, None
+        bars = self._bars.get(code)
+        if bars is None:
+            bars = get_current_data(code).min_bar_arrays(self._grid)
+            self._bars[code] = bars
+        return bars[0][cursor], bars[1][cursor], bars[2][cursor]
+
+    def match(self):
+        """
+        按当前分钟撮合所有未完成订单
+        """
+        self._sync()
+        cursor = self._minute_index.get(context.current_dt) if context.run_type == RUN_TYPE.BACK_TEST else None
+        for code in list(self.books.keys()):
+            orders = [_order for _order in self.books[code] if _order.status == ORDER_STATUS.OPEN]
+            ready = [_order for _order in orders if _order.add_time < context.current_dt]  # 防止下单后马上撮合
+            if len(ready) > 0:
+                low, high, vol = self._last_bar(code, cursor)
+                capacity = _volume_capacity(vol) if vol is not None else None
+                for _order in ready:
+                    if (low < _order.order_price) if _order.is_buy else (high > _order.order_price):
+                        if capacity is None:
+                            _order.deal()
+                        elif capacity > 0:
+                            amount = min(int(capacity), _order.remaining)
+                            _order.deal(amount=amount)
+                            capacity -= amount
+                orders = [_order for _order in orders if _order.status == ORDER_STATUS.OPEN]
+
+            if len(orders) > 0:
+                self.books[code] = orders
+            else:
+                self._ids.difference_update(_order.id for _order in self.books.pop(code))
+
+
+order_matcher = OrderMatcher()
+
+
+def reset_broker():
+    """
+    清空撮合引擎及日频撮合的成交量缓存，在回测或模拟交易开始运行时调用，避免同一进程中多次运行之间状态残留
+    """
+    _day_capacity.clear()
+    order_matcher.__init__()
 
 
 def order_broker():
@@ -522,19 +704,4 @@ def order_broker():
     :return:
     """
     log.debug('调用order_broker' + str(locals()).replace('{', '(').replace('}', ')'))
-    for _order in context.order_list.values():
-        if _order.add_time[0:10] != context.current_dt[0:10]:  # 防止框架恢复运行导入其他日期的context
-            context.order_list.remove(_order)
-        if _order.status == ORDER_STATUS.OPEN and _order.add_time < context.current_dt:  # 防止下单后马上撮合
-            code = _order.security
-            data = get_current_data(code)
-            if _order.is_buy:
-                if data.last_low < _order.order_price:
-                    _order.deal()
-                    # log.info("订单成交：订单编号{}，股票代码{},成交数量{}，成交时间{}"
-                    #          .format(_order.id, code, _order.trade_amount, context.current_dt[11:]))
-
-            elif data.last_high > _order.order_price:
-                _order.deal()
-                # log.info("订单成交：订单编号{}，股票代码{},成交数量{}，成交时间{}"
-                #          .format(_order.id, code, _order.trade_amount, context.current_dt[11:]))
+    order_matcher.match()
@@ -94,7 +94,7 @@ def settle_by_day():
     for _order in context.order_list.values():
         if _order.status == ORDER_STATUS.OPEN:
             _order.cancel()
-        elif _order.status == ORDER_STATUS.DEAL:
+        if _order.trade_amount > 0:  # 包含部分成交后撤销的订单
             do = _order.message
             context.order_hists.append(do)
 
@@ -34,7 +34,7 @@ from time import sleep
 from qff.frame.context import context, strategy, run_strategy_funcs
 from qff.frame.const import RUN_TYPE, RUN_STATUS
 from qff.frame.backup import save_context
-from qff.frame.order import order_broker
+from qff.frame.order import order_broker, reset_broker
 from qff.frame.settle import settle_by_day, profit_analyse
 from qff.frame.trace import Trace
 from qff.tools.date import is_trade_day
@@ -74,6 +74,7 @@ def sim_trade_run():
 
 
 def _sim_trade_run():
+    reset_broker()
     while context.status == RUN_STATUS.RUNNING:
         _time = pd.Timestamp.now()
         stime = _time.strftime('%Y-%m-%d %H:%M:%S')
@@ -0,0 +1,166 @@
+# coding :utf-8
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016-2019 XuHaiJiang/QFF
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+策略参数寻优
+
+对同一策略文件的多组参数并行运行回测。每组参数在进程池中一个全新的子进程内运行(maxtasksperchild=1)，
+子进程拥有独立的context、strategy和g全局对象；回测完成后不保存pkl文件和策略运行报告，只收集 stats_risk 风险指标，
+汇总为一张结果表。
+"""
+
+import os
+import itertools
+import multiprocessing
+import pandas as pd
+from typing import Dict, List, Optional, Union
+from qff.frame.api import run_file, _load_strategy_file, _set_backtest_period
+from qff.frame.context import context, strategy, g, reset_globals
+from qff.frame.const import RUN_STATUS
+from qff.frame.stats import stats_risk
+from qff.price.shared import publish_market_data, remove_market_data
+from qff.tools.local import back_test_path
+from qff.tools.utils import auto_file_name
+from qff.tools.logs import log
+
+__all__ = ['run_sweep']
+
+
+def _expand_grid(param_grid):
+    # type: (Union[Dict[str, list], List[dict]]) -> List[dict]
+    if isinstance(param_grid, dict):
+        keys = list(param_grid.keys())
+        return [dict(zip(keys, values)) for values in itertools.product(*param_grid.values())]
+    return [dict(params) for params in param_grid]
+
+
+def _prefetch(strategy_file, params, start, end, name):
+    # type: (str, dict, Optional[str], Optional[str], str) -> list
+    # 在父进程中执行一次initialize获取股票池和基准指数，将行情数据发布为共享数据，各子进程只读映射
+    shared = []
+    try:
+        if _load_strategy_file(strategy_file, params):
+            strategy.initialize()
+            for key, value in params.items():
+                setattr(g, key, value)
+            _set_backtest_period(start, end)
+            if len(context.universe) > 0:
+                shared.append(publish_market_data(context.universe, context.start_date, context.end_date,
+                                                  'stock', f'{name}_sweep_stock'))
+            shared.append(publish_market_data([context.benchmark], context.start_date, context.end_date,
+                                              'index', f'{name}_sweep_index'))
+    finally:
+        reset_globals()
+    return shared
+
+
+def _sweep_worker(task):
+    index, strategy_file, params, kwargs = task
+    result = dict(params)
+    try:
+        run_file(strategy_file, params=params, **kwargs)
+        if context.status == RUN_STATUS.DONE and len(context.asset_hists) > 2:
+            result.update(stats_risk(context))
+        else:
+            result['错误信息'] = '回测未完成'
+    except Exception as e:
+        result['错误信息'] = str(e)
+    return index, result
+
+
+def run_sweep(strategy_file,
+              param_grid,
+              workers=None,
+              freq='day',
+              cash=1000000,
+              start=None,
+              end=None,
+              name=None,
+              output_dir=None,
+              prefetch=False,
+              log_level='error'):
+    # type: (str, Union[Dict[str, list], List[dict]], Optional[int], str, int, Optional[str], Optional[str], Optional[str], Optional[str], bool, str) -> Optional[pd.DataFrame]
+    """
+    对策略文件进行参数寻优，并行回测所有参数组合
+
+    策略参数在策略文件导入后赋值给策略模块中的同名全局变量，并在initialize执行后赋值给全局对象g的同名属性，
+    因此策略中的可调参数既可以定义为模块全局变量，也可以在initialize中以g的属性设置默认值。
+
+    :param strategy_file: 策略文件路径
+    :param param_grid: 参数网格，dict格式时key为参数名，value为参数取值列表，运行所有取值的组合；
+                       也可以是参数字典的列表，逐个运行
+    :param workers: 并行进程数量，默认为CPU核数
+    :param freq: 策略执行频率，有效值为 'day','min',默认值为 'day'
+    :param cash: 账户初始资金，默认值1000000
+    :param start: 回测开始日期，默认为结束日期前60个交易日
+    :param end: 回测结束日期, 默认为上一个交易日
+    :param name: 策略名称，默认为策略文件名，各参数组合的回测以“名称_序号”命名，结果表保存为“名称_sweep.csv”
+    :param output_dir: 指定结果数据输出目录
+    :param prefetch: 是否在父进程中预先将股票池及基准指数的行情数据发布为共享数据，各子进程只读映射，避免重复查询数据库
+    :param log_level: 子进程控制台日志输出的级别，默认值为'error'
+
+    :return: 结果表，每行对应一组参数，列为参数值及 stats_risk 返回的风险指标
+
+    :example:
+
+    .. code-block:: python
+
+        df = run_sweep('ma_cross.py', {'short': [5, 10], 'long': [20, 30, 60]}, workers=4,
+                       start='2022-01-01', end='2022-12-31')
+
+    """
+    combos = _expand_grid(param_grid)
+    if len(combos) == 0:
+        log.error("参数param_grid不能为空！")
+        return None
+    if name is None:
+        name = os.path.basename(strategy_file).split('.')[0]
+
+    shared = _prefetch(strategy_file, combos[0], start, end, name) if prefetch else []
+
+    tasks = [(i, strategy_file, params, dict(freq=freq, cash=cash, start=start, end=end, name=f'{name}_{i}',
+                                             output_dir=output_dir, log_level=log_level, shared_data=shared,
+                                             report=False))
+             for i, params in enumerate(combos)]
+
+    # 父进程中已有pymongo等后台线程，不使用fork方式，避免子进程继承被其他线程持有的锁而死锁
+    methods = multiprocessing.get_all_start_methods()
+    mp = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    results: List[Optional[dict]] = [None] * len(tasks)
+    print(f"参数寻优开始：{len(tasks)}组参数，{workers or os.cpu_count()}个进程")
+    try:
+        with mp.Pool(processes=workers, maxtasksperchild=1) as pool:
+            for done, (index, result) in enumerate(pool.imap_unordered(_sweep_worker, tasks), 1):
+                results[index] = result
+                print(f"[{done}/{len(tasks)}] {tasks[index][2]} {result.get('策略收益', result.get('错误信息'))}")
+    finally:
+        for shared_name in shared:
+            remove_market_data(shared_name)
+
+    df = pd.DataFrame(results)
+    out_path = back_test_path if output_dir is None else output_dir
+    csv_file = auto_file_name(os.path.join(out_path, f'{name}_sweep.csv'))
+    df.to_csv(csv_file, index=False, encoding='utf-8-sig')
+    print(f"参数寻优结果已保存至：{csv_file}")
+    return df
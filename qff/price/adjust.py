@@ -0,0 +1,130 @@
+# coding :utf-8
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016-2019 XuHaiJiang/QFF
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+复权因子缓存
+
+按标的缓存stock_adj中的复权因子。复权因子是阶梯函数，只保存系数发生变化的日期，以排序后的日期数组和前/后复权系数数组保存。get_price复权计算时，
+通过searchsorted查找每条行情记录对应的复权系数，并一次性与全部价格列相乘，避免对整个复权因子表做
+(date, code)多重索引关联。save_stock_xdxr更新stock_adj后，需调用invalidate()使对应标的的缓存失效。
+"""
+
+import threading
+import numpy as np
+import pandas as pd
+from typing import Dict, List, Optional
+from qff.tools.mongo import DATABASE
+
+__all__ = ['AdjFactorCache', 'adj_cache']
+
+PRICE_COLUMNS = ['open', 'high', 'low', 'close']
+
+
+class AdjFactorCache:
+    """
+    复权因子缓存对象，缓存的每个标的为(变化日期数组, 前复权系数数组, 后复权系数数组)
+    """
+
+    def __init__(self):
+        self._factors: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+
+    def get(self, code):
+        # type: (List[str]) -> Dict[str, tuple]
+        """
+        获取多个标的的复权因子，未缓存的标的一次批量查询数据库
+
+        :param code: 标的代码列表
+        :return: dict, key为标的代码, value为(日期数组, 前复权系数数组, 后复权系数数组), 无复权因子的标的不包含在内
+        """
+        with self._lock:
+            missing = [_code for _code in code if _code not in self._factors]
+            if len(missing) > 0:
+                cursor = DATABASE.stock_adj.find({'code': {'$in': missing}}, {"_id": 0}, batch_size=10000)
+                adj = pd.DataFrame([item for item in cursor])
+                groups = {} if len(adj) == 0 else dict(list(adj.sort_values('date').groupby('code')))
+                for _code in missing:
+                    df = groups.get(_code)
+                    if df is None:
+                        self._factors[_code] = None
+                    else:
+                        # 只保留前/后复权系数与前一日不同的记录，按日期查找时取当日或之前最近的变化点，结果不变
+                        qfq = df['qfq'].to_numpy(dtype='float64')
+                        hfq = df['hfq'].to_numpy(dtype='float64')
+                        changed = np.ones(len(df), dtype=bool)
+                        changed[1:] = (qfq[1:] != qfq[:-1]) | (hfq[1:] != hfq[:-1])
+                        df = df[changed]
+                        self._factors[_code] = (
+                            pd.to_datetime(df['date'], format='%Y-%m-%d').to_numpy(dtype='datetime64[D]'),
+                            df['qfq'].to_numpy(dtype='float64'),
+                            df['hfq'].to_numpy(dtype='float64'),
+                        )
+            return {_code: self._factors[_code] for _code in code if self._factors[_code] is not None}
+
+    def apply(self, data, date_index, fq):
+        # type: (pd.DataFrame, str, str) -> Optional[pd.DataFrame]
+        """
+        对行情数据进行复权计算
+
+        :param data: 包含code、date(分钟数据为datetime)及价格列的行情数据
+        :param date_index: 日期列名称，'date'或'datetime'
+        :param fq: 复权选项，'pre'-前复权，'post'-后复权
+
+        :return: 复权后的行情数据，所有标的均无复权因子时返回None
+        """
+        factors = self.get(data['code'].unique().tolist())
+        if len(factors) == 0:
+            return None
+
+        dates = data[date_index] if date_index == 'date' else data[date_index].str[:10]
+        days = pd.to_datetime(dates, format='%Y-%m-%d').to_numpy(dtype='datetime64[D]')
+        col = 1 if fq == 'pre' else 2
+        cof = np.ones(len(data))
+        for _code, idx in data.groupby('code').indices.items():
+            item = factors.get(_code)
+            if item is None:
+                continue
+            pos = np.searchsorted(item[0], days[idx], side='right') - 1  # 取当日或之前最近一日的复权系数
+            valid = pos >= 0
+            cof[idx[valid]] = item[col][pos[valid]]
+
+        columns = [column for column in PRICE_COLUMNS if column in data.columns]
+        data[columns] = np.round(data[columns].to_numpy(dtype='float64') * cof[:, None], 2)
+        return data
+
+    def invalidate(self, code=None):
+        """
+        使标的的复权因子缓存失效
+
+        :param code: 标的代码或代码列表，None表示清空全部缓存
+        """
+        with self._lock:
+            if code is None:
+                self._factors.clear()
+            else:
+                for _code in ([code] if isinstance(code, str) else code):
+                    self._factors.pop(_code, None)
+
+
+adj_cache = AdjFactorCache()
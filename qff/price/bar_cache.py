@@ -0,0 +1,223 @@
+# coding :utf-8
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016-2019 XuHaiJiang/QFF
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+行情数据进程内缓存
+
+策略运行中history、attribute_history等函数会以重叠的时间窗口反复调用get_price，本模块以(market, freq, code, fq)为键，
+缓存每个标的一段连续时间范围内已完成清洗和复权计算的行情数据：
+
+1. 请求范围在缓存范围之内时，直接切片返回；
+2. 请求范围与缓存范围重叠时，只查询缺失的首尾部分并合并；
+3. 缓存总容量超过配置项 [PRICE] cache_size (单位MB)时，按最近最少使用(LRU)原则淘汰。
+
+缓存默认关闭，需在配置文件中将 [PRICE] cache_size 设置为大于0的容量后开启。
+"""
+
+import threading
+import pandas as pd
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+from qff.tools.config import get_config
+
+__all__ = ['BarCache', 'bar_cache']
+
+
+class BarCache:
+    """
+    行情数据LRU缓存对象
+
+    ================== =====================  =======================================================================
+        属性            类型                      说明
+    ================== =====================  =======================================================================
+    max_bytes          int                      缓存容量上限(字节)
+    hits               int                      完全命中缓存的次数(按标的计)
+    partial            int                      部分命中、只查询缺失首尾数据的次数(按标的计)
+    misses             int                      未命中缓存的次数(按标的计)
+    evictions          int                      被淘汰的缓存条目数量
+    ================== =====================  =======================================================================
+
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.partial = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bytes = 0
+        self._entries = OrderedDict()  # key为(market, freq, code, fq)，value为[开始时间, 结束时间, 数据, 占用字节]
+        self._loading = {}  # 正在查询中的key及其完成事件
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get_price(self, code, start, end, freq, market, fq, loader):
+        # type: (List[str], str, str, str, str, Optional[str], Callable) -> pd.DataFrame
+        """
+        从缓存中读取多个标的的行情数据，缺失部分通过loader查询后补入缓存
+
+        :param code: 标的代码列表
+        :param start: 开始时间
+        :param end: 结束时间
+        :param freq: 数据频率
+        :param market: 市场类型
+        :param fq: 复权选项
+        :param loader: 查询函数 loader(code_list, start, end)，返回包含code列的行情DataFrame
+
+        :return: 包含date(分钟数据为datetime)、code及行情字段列的DataFrame, 无数据时返回空DataFrame
+        """
+        date_index = 'date' if freq == 'day' else 'datetime'
+        keys = {_code: (market, freq, _code, str(fq)) for _code in code}
+        # 1、按缺失的时间范围对标的分组，相同范围的标的一次查询。其他线程正在查询的标的先等待其完成，避免重复查询
+        while True:
+            with self._lock:
+                waits = [self._loading[key] for key in keys.values() if key in self._loading]
+                if len(waits) == 0:
+                    plans, frames = self._plan(code, keys, start, end)
+                    loading = {keys[_code] for codes in plans.values() for _code in codes}
+                    for key in loading:
+                        self._loading[key] = threading.Event()
+                    break
+            for event in waits:
+                event.wait()
+
+        # 2、释放锁后查询缺失数据，查询期间其他线程可以读取缓存中的其他标的
+        try:
+            results = []
+            for (_start, _end), codes in plans.items():
+                data = loader(codes, _start, _end)
+                groups = {} if len(data) == 0 else \
+                    {key: df for key, df in data.set_index(date_index).groupby('code')}
+                results.append((_start, _end, codes, groups))
+
+            # 3、将查询数据与缓存数据合并，并切片返回请求范围内的数据
+            with self._lock:
+                for _start, _end, codes, groups in results:
+                    for _code in codes:
+                        df = groups.get(_code)
+                        self._merge(keys[_code], _start, _end, df.drop('code', axis=1) if df is not None else None)
+                for key in loading:
+                    df = self._entries[key][2]
+                    frames[key[2]] = None if df is None else df.loc[start:end]
+                self._evict()
+        finally:
+            with self._lock:
+                for key in loading:
+                    self._loading.pop(key).set()
+
+        ret = [frames[_code].assign(code=_code) for _code in code
+               if frames.get(_code) is not None and len(frames[_code]) > 0]
+        if len(ret) == 0:
+            return pd.DataFrame()
+        return pd.concat(ret, sort=False).rename_axis(date_index).reset_index()
+
+    def _plan(self, code, keys, start, end):
+        # 返回缺失数据的查询计划{(开始时间, 结束时间): 标的列表}，以及完全命中缓存的标的在请求范围内的数据
+        plans: Dict[tuple, List[str]] = {}
+        frames = {}
+        for _code in code:
+            entry = self._entries.get(keys[_code])
+            if entry is None or end < entry[0] or start > entry[1]:
+                self.misses += 1
+                plans.setdefault((start, end), []).append(_code)
+                continue
+            self._entries.move_to_end(keys[_code])
+            if start >= entry[0] and end <= entry[1]:
+                self.hits += 1
+                frames[_code] = None if entry[2] is None else entry[2].loc[start:end]
+                continue
+            self.partial += 1
+            if start < entry[0]:
+                plans.setdefault((start, entry[0]), []).append(_code)
+            if end > entry[1]:
+                plans.setdefault((entry[1], end), []).append(_code)
+        return plans, frames
+
+    def _merge(self, key, start, end, data):
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._bytes -= entry[3]
+        if entry is None or end < entry[0] or start > entry[1]:
+            lo, hi, frames = start, end, [data]
+        else:
+            lo, hi, frames = min(start, entry[0]), max(end, entry[1]), [entry[2], data]
+
+        frames = [df for df in frames if df is not None and len(df) > 0]
+        if len(frames) == 0:
+            data = None
+        else:
+            data = pd.concat(frames, sort=False) if len(frames) > 1 else frames[0]
+            data = data[~data.index.duplicated(keep='last')].sort_index()
+        nbytes = 0 if data is None else int(data.memory_usage(index=True, deep=True).sum())
+        self._entries[key] = [lo, hi, data, nbytes]
+        self._entries.move_to_end(key)
+        self._bytes += nbytes
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and len(self._entries) > 0:
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry[3]
+            self.evictions += 1
+
+    def invalidate(self, code):
+        """
+        删除指定标的的全部缓存数据，用于复权因子更新后避免返回过期的复权价格
+
+        :param code: 标的代码
+        """
+        with self._lock:
+            for key in [key for key in self._entries if key[2] == code]:
+                self._bytes -= self._entries.pop(key)[3]
+
+    def clear(self):
+        """
+        清空缓存数据及统计计数
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = self.partial = self.misses = self.evictions = 0
+
+    def info(self):
+        # type: () -> dict
+        """
+        返回缓存的统计信息，用于调整缓存容量
+
+        :return: dict, 包含命中次数、部分命中次数、未命中次数、淘汰条目数、缓存条目数、已用字节及容量上限
+        """
+        return {
+            'hits': self.hits,
+            'partial': self.partial,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'max_bytes': self.max_bytes,
+        }
+
+
+bar_cache = BarCache(int(get_config('PRICE', 'cache_size', '0')) * 1024 * 1024)
@@ -26,10 +26,12 @@ from qff.tools.logs import log
 from qff.price.query import get_price, get_stock_name, get_index_name, get_stock_block
 from qff.tools.date import get_trade_min_list
 from qff.price.fetch import fetch_current_ticks, fetch_today_min_curve, fetch_price
+from qff.price.panel import PricePanel, get_price_panel
 
 from qff.frame.context import context
 from qff.frame.const import RUN_TYPE, RUN_STATUS
 from typing import Optional
+import numpy as np
 import pandas as pd
 
 
@@ -286,6 +288,34 @@ class BacktestData(SecurityUnitData):
     def paused(self):
         return self._day_buff["vol"][-1] < 1
 
+    def min_bar_arrays(self, grid):
+        # type: (list) -> tuple
+        """
+        将当日分钟数据按分钟网格对齐为最低价、最高价及成交量数组，供分钟撮合按整数下标读取
+
+        网格中每个时间点取该时间之前(含)最近一个bar的数据，与min_data_before.iloc[-1]一致，09:30取当日开盘价
+
+        成交量只计入每个bar开始的分钟，避免5分钟等周期数据在网格中重复计算
+
+        :param grid: 当日分钟时间列表，同get_trade_min_list(day)
+        :return: (最低价数组, 最高价数组, 成交量数组)
+        """
+        if self._min_buff is None:
+            self._get_min_buff()
+        index = np.asarray(self._min_buff.index, dtype=str)
+        grid = np.asarray(grid, dtype=str)
+        raw = np.searchsorted(index, grid, side='right') - 1
+        pos = np.clip(raw, 0, len(index) - 1)
+        low = self._min_buff['low'].to_numpy(dtype='float64')[pos]
+        high = self._min_buff['high'].to_numpy(dtype='float64')[pos]
+        new_bar = (raw >= 0) & (raw != np.r_[-1, raw[:-1]])
+        vol = np.where(new_bar, self._min_buff['vol'].to_numpy(dtype='float64')[pos], 0)
+        if self._day_open is not None:
+            opening = grid < grid[0][0:11] + '09:31'
+            low[opening] = self._day_open
+            high[opening] = self._day_open
+        return low, high, vol
+
     @property
     def min_data_before(self):
         if self._min_buff is None:
@@ -358,6 +388,29 @@ class BacktestData(SecurityUnitData):
             return int(high_limit_count * freq)
 
 
+class PanelData(BacktestData):
+    """
+    回测时从预载入的行情数据面板中读取数据的标的数据快照对象，面板中缺失分钟数据时按BacktestData方式查询数据库
+    """
+    def __init__(self, code, market, panel):
+        # type: (str, str, PricePanel) -> None
+        SecurityUnitData.__init__(self, code, market)
+        self._panel = panel
+        self._day_buff = panel.day_frame(code, context.current_dt[0:10])
+        self._pre_close = self._day_buff['close'][0]
+        self._day_open = self._day_buff['open'][-1]
+        self._min_buff = None
+        self._min_buff_freq = None
+
+    def _get_min_buff(self):
+        data = self._panel.min_frame(self.code, context.current_dt[0:10])
+        if data is None:
+            super()._get_min_buff()
+        else:
+            self._min_buff = data
+            self._min_buff_freq = '1min'
+
+
 class RealtimeData(SecurityUnitData):
     def __init__(self, code, market="stock"):
         super().__init__(code, market)
@@ -494,7 +547,11 @@ def get_current_data(code, market='stock'):
     security = code + '.' + market
     if security not in unit_data_cache.keys():
         if context.run_type == RUN_TYPE.BACK_TEST:
-            unit_data_cache[security] = BacktestData(code, market)
+            panel = get_price_panel(market)
+            if panel is not None and panel.has(code, context.current_dt[0:10]):
+                unit_data_cache[security] = PanelData(code, market, panel)
+            else:
+                unit_data_cache[security] = BacktestData(code, market)
         elif context.run_type == RUN_TYPE.SIM_TRADE:
             unit_data_cache[security] = RealtimeData(code, market)
         else:
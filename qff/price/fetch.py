@@ -90,7 +90,7 @@ def _calc_today_min_len():
 
 
 # @retry(stop_max_attempt_number=3, wait_random_min=50, wait_random_max=100)
-def fetch_price(code, count=None, freq='day', market='stock', start=None):
+def fetch_price(code, count=None, freq='day', market='stock', start=None, api=None):
     """
     从tdx服务器上获取曲线数据，仅可查询一支股票，按天或者分钟，返回数据格式为 DataFrame
 
@@ -101,6 +101,8 @@ def fetch_price(code, count=None, freq='day', market='stock', start=None):
     :param market: 市场类型，目前支持“stock/index/etf", 默认“stock".
     :param start: 开始日期，不带分钟信息。与 count 二选一，不可同时使用. 字符串或者 datetime.date 对象,如果 count
         和 start 参数都没有, 则取count=1,即获取最近一条数据。
+    :param api: 已连接的TdxHq_API对象(如连接池中的连接)，批量下载时复用同一连接，此时下载异常直接抛出，由调用者处理；
+        为None时新建连接
 
     :type code: str
     :type count: int
@@ -124,52 +126,59 @@ def fetch_price(code, count=None, freq='day', market='stock', start=None):
     elif count <= 0:
         count = 40800
 
-    ip, port = get_best_ip()
-    api = TdxHq_API()
+    if api is not None:
+        return _fetch_bars(api, code, count, freq, market, start)
     try:
+        ip, port = get_best_ip()
+        api = TdxHq_API()
         with api.connect(ip, port):
-            ret = []
-            _start = 0
-            while count > 0:
-                _len = 800 if count > 800 else count
-                if market in ['stock', 'etf']:
-                    df = api.get_security_bars(freq, select_market_code(code), code, _start, _len)
-                elif market == 'index':
-                    df = api.get_index_bars(freq, select_index_code(code), code, _start, _len)
-                if df is not None and len(df) > 0:
-                    df = api.to_df(df)
-                    ret.append(df)
-                    _start += _len
-                    count -= _len
-                else:
-                    break
-
-            if len(ret) > 0:
-                data = pd.concat(ret, axis=0, sort=False) if len(ret) > 1 else ret[0]
-
-                if freq in [0, 1, 2, 3, 8]:  # 分钟数据
-                    data = data.drop(['year', 'month', 'day', 'hour', 'minute'], axis=1, inplace=False)
-                    data = data.assign(datetime=data['datetime'] + ':00')
-                    data.set_index('datetime', inplace=True)
-
-                else:
-                    data = data.assign(date=data['datetime'].apply(lambda x: str(x[0:10])))
-                    data = data.drop(['year', 'month', 'day', 'hour', 'minute', 'datetime'], axis=1, inplace=False)
-                    data.set_index('date', inplace=True)
-                data.sort_index(inplace=True)
-                data.insert(0, 'code', code)
-                if start is not None:
-                    data = data.loc[start:]
-                return data
-            else:
-                # 这里的问题是: 如果只取了一天的股票,而当天停牌, 那么就直接返回None了
-                return None
+            return _fetch_bars(api, code, count, freq, market, start)
 
     except Exception as err:
         log.error(f'fetch_price exception:{err}')
         return None
 
 
+def _fetch_bars(api, code, count, freq, market, start):
+    # 通过已连接的api分页下载曲线数据，freq为_select_freq转换后的通达信周期代码
+    ret = []
+    _start = 0
+    while count > 0:
+        _len = 800 if count > 800 else count
+        if market in ['stock', 'etf']:
+            df = api.get_security_bars(freq, select_market_code(code), code, _start, _len)
+        elif market == 'index':
+            df = api.get_index_bars(freq, select_index_code(code), code, _start, _len)
+        if df is not None and len(df) > 0:
+            df = api.to_df(df)
+            ret.append(df)
+            _start += _len
+            count -= _len
+        else:
+            break
+
+    if len(ret) > 0:
+        data = pd.concat(ret, axis=0, sort=False) if len(ret) > 1 else ret[0]
+
+        if freq in [0, 1, 2, 3, 8]:  # 分钟数据
+            data = data.drop(['year', 'month', 'day', 'hour', 'minute'], axis=1, inplace=False)
+            data = data.assign(datetime=data['datetime'] + ':00')
+            data.set_index('datetime', inplace=True)
+
+        else:
+            data = data.assign(date=data['datetime'].apply(lambda x: str(x[0:10])))
+            data = data.drop(['year', 'month', 'day', 'hour', 'minute', 'datetime'], axis=1, inplace=False)
+            data.set_index('date', inplace=True)
+        data.sort_index(inplace=True)
+        data.insert(0, 'code', code)
+        if start is not None:
+            data = data.loc[start:]
+        return data
+    else:
+        # 这里的问题是: 如果只取了一天的股票,而当天停牌, 那么就直接返回None了
+        return None
+
+
 def fetch_today_min_curve(code, market='stock'):
     """
     获取当天的分钟曲线，返回当前时间前的当日1分钟曲线数据，用于模拟交易环境
@@ -188,12 +197,13 @@ def fetch_today_min_curve(code, market='stock'):
     return fetch_price(code, count, freq='1m', market=market)
 
 
-def fetch_current_ticks(code, market='stock'):
+def fetch_current_ticks(code, market='stock', api=None):
     """
     获取单个股票或指数当前时刻的ticks数据
 
     :param code: 一支股票代码或者一个指数代码
     :param market: 市场类型，目前支持“stock"和”index", 默认“stock".
+    :param api: 已连接的TdxHq_API对象(如连接池中的连接)，为None时新建连接
 
     :type code: str
     :type market: str
@@ -220,6 +230,9 @@ def fetch_current_ticks(code, market='stock'):
         ==================  ====================
 
     """
+    if api is not None:
+        data = api.get_security_quotes([(select_market_code(code, market), code)])[0]
+        return json.loads(json.dumps(data))
     ip, port = get_best_ip()
     api = TdxHq_API()
     with api.connect(ip, port):
@@ -370,17 +383,20 @@ def fetch_stock_list(market='stock'):
 
 
 @retry(stop_max_attempt_number=3, wait_random_min=50, wait_random_max=100)
-def fetch_stock_xdxr(code):
+def fetch_stock_xdxr(code, api=None):
     """
     获取除权除息数据
     :param code:
+    :param api: 已连接的TdxHq_API对象(如连接池中的连接)，为None时新建连接
     :return:
     """
     market_code = select_market_code(code)
-    ip, port = get_best_ip()
-    api = TdxHq_API()
-    # with api.connect(ip, port):
-    api.connect(ip, port)
+    own_api = api is None
+    if own_api:
+        ip, port = get_best_ip()
+        api = TdxHq_API()
+        # with api.connect(ip, port):
+        api.connect(ip, port)
     category = {
         '1': '除权除息', '2': '送配股上市', '3': '非流通股上市', '4': '未知股本变动',
         '5': '股本变化',
@@ -405,7 +421,8 @@ def fetch_stock_xdxr(code):
 
     else:
         data = None
-    api.close()
+    if own_api:
+        api.close()
     return data
 
 
@@ -31,6 +31,8 @@ import datetime
 from typing import Dict, Optional
 from dateutil.relativedelta import relativedelta
 from qff.tools.mongo import DATABASE
+from qff.tools.config import get_config
+from qff.tools.parquet import read_report_parquet
 from qff.tools.date import (
     util_date_valid,
     get_pre_trade_day,
@@ -38,13 +40,30 @@ from qff.tools.date import (
     get_real_trade_date,
     get_trade_days,
     date_to_int,
-    int_to_date
+    int_to_date,
+    trade_calendar
 )
+from qff.price.fund_index import fund_index
 from qff.tools.logs import log
 from qff.frame.context import context
 from qff.frame.const import RUN_TYPE, RUN_STATUS
 from qff.tools.utils import util_code_tolist
 
+REPORT_BACKEND = get_config('REPORT', 'backend', 'mongo')  # 财报数据后端: mongo-MongoDB数据库, parquet-本地列式文件
+
+
+def _find_report(filter, projection):
+    # type: (dict, Optional[dict]) -> pd.DataFrame
+    """
+    查询财报数据，配置为parquet后端时只读取所需字段列，本地文件不支持的查询条件改为查询数据库
+    """
+    if REPORT_BACKEND == 'parquet':
+        data = read_report_parquet(filter, projection)
+        if data is not None:
+            return data
+    cursor = DATABASE.report.find(filter=filter, projection=projection)
+    return pd.DataFrame([item for item in cursor])
+
 
 def get_fundamentals(filter, projection=None, date=None, report_date=None):
     # type: (Optional[Dict], Optional[Dict], Optional[str], Optional[str]) -> Optional[pd.DataFrame]
@@ -110,6 +129,7 @@ def get_fundamentals(filter, projection=None, date=None, report_date=None):
             log.error("参数report_date不合法！")
             return None
         filter['report_date'] = date_to_int(rd)
+        pub_range = None
     else:
         if date is None:
             if context.run_type == RUN_TYPE.BACK_TEST and context.status == RUN_STATUS.RUNNING:
@@ -126,15 +146,19 @@ def get_fundamentals(filter, projection=None, date=None, report_date=None):
         start = (datetime.datetime.strptime(end, '%Y-%m-%d') - relativedelta(months=8)).strftime('%Y-%m-%d')
         if start < '2000-01-01':
             start = '2000-01-01'
-        filter['f314'] = {
-            "$lte": date_to_int(end[2:]),
-            "$gte": date_to_int(start[2:])
-        }
-
-    coll = DATABASE.report
-    cursor = coll.find(filter=filter, projection=projection)
-
-    db_data = pd.DataFrame([item for item in cursor])
+        pub_range = (date_to_int(start), date_to_int(end))
+
+    db_data = None
+    if context.run_type == RUN_TYPE.BACK_TEST and context.status == RUN_STATUS.RUNNING:
+        db_data = fund_index.query(filter, projection, pub_range)  # 回测时使用财报时点索引，不支持的查询条件返回None
+
+    if db_data is None:
+        if pub_range is not None:
+            filter['f314'] = {
+                "$lte": date_to_int(end[2:]),
+                "$gte": date_to_int(start[2:])
+            }
+        db_data = _find_report(filter, projection)
     if len(db_data) < 1:
         log.error("get_fundamentals未查询到数据")
         return None
@@ -267,9 +291,7 @@ def get_stock_reports(code, fields=None, start=None, end=None):
         log.error("参数start不合法！查询日期需大于2000-01-01")
         return None
 
-    coll = DATABASE.report
-    cursor = coll.find(filter=_filter, projection=projection)
-    db_data = pd.DataFrame([item for item in cursor])
+    db_data = _find_report(_filter, projection)
     if len(db_data) > 1:
         db_data = db_data.sort_values('report_date')
         db_data.insert(2, 'pub_date', db_data['f314'].apply(int_to_date))
@@ -343,9 +365,7 @@ def get_stock_forecast(code=None, start=None, end=None):
         'f285': 1,
         'f286': 1,
     }
-    coll = DATABASE.report
-    cursor = coll.find(filter=_filter, projection=projection)
-    db_data = pd.DataFrame([item for item in cursor])
+    db_data = _find_report(_filter, projection)
     if len(db_data) >= 1:
         db_data['f313'] = db_data['f313'].apply(int_to_date)
         db_data.rename(columns={
@@ -436,9 +456,7 @@ def get_stock_express(code=None, start=None, end=None):
         'f293': 1,
         'f294': 1,
     }
-    coll = DATABASE.report
-    cursor = coll.find(filter=_filter, projection=projection)
-    db_data = pd.DataFrame([item for item in cursor])
+    db_data = _find_report(_filter, projection)
     if len(db_data) >= 1:
         db_data.insert(2, 'pub_date', db_data['f315'].apply(int_to_date))
         db_data.drop(columns=['f315'], inplace=True)
@@ -460,28 +478,43 @@ def get_stock_express(code=None, start=None, end=None):
 
 
 def get_fundamentals_continuously(code, fields=None, end_date=None, count=None):
-    # type: (str, Optional[list], Optional[str], Optional[int]) -> Optional[pd.DataFrame]
+    # type: (Optional[list, str], Optional[list], Optional[str], Optional[int]) -> Optional[pd.DataFrame]
     """
-    查询单个股票连续多日的财务数据
+    查询一个或多个股票连续多日的财务数据
 
     详细的财务数据表及字段描述请见financial_dict
 
-    :param code:  一支股票代码
+    :param code:  一支股票代码或者一个股票代码的list，多只股票时一次查询数据库，并统一对齐到交易日历
     :param fields: 返回的财务数据字段list，'001'-'580',None表示所有财务指标,详细的财务数据表及字段描述请见 :ref:`db_finance`
     :param end_date: 查询日期, 一个字符串(格式类似'2015-10-15')，可以是None, 使用默认日期. 这个默认日期在回测时，
                     等于 context.current_dt 的前一天。在实盘时，为当前最新日期，一般是昨天。
-    :param count: 获取 end_date 前 count 个日期的数据
+    :param count: 获取 end_date 前 count 个日期的数据，code为列表时必须指定，以限制返回结果的大小
 
-    :return: 返回一个 [pandas.DataFrame]
+    :return: 返回一个 [pandas.DataFrame]，code为字符串时每行对应一个交易日；
+             code为列表时以(date, code)为多重索引，每行对应一个交易日的一只股票，首次发布财报之前的日期不包含在内
+
+    :example:
+
+    ::
+
+        # 获取全部股票最近20个交易日的每股收益
+        df = get_fundamentals_continuously(get_stock_list(), ['f001'], count=20)
+        eps = df['f001'].unstack('code')
 
     """
     if code is None:
         log.error("参数code不可为空！")
         return
-    elif not isinstance(code, str):
-        log.error("参数code不合法！,应该为字符串")
+    elif isinstance(code, str):
+        _filter = {'code': code}
+    elif isinstance(code, list) and all(isinstance(_code, str) for _code in code):
+        if count is None:
+            log.error("参数count不可为空！code为列表时需指定count")
+            return None
+        _filter = {'code': {'$in': code}}
+    else:
+        log.error("参数code不合法！,应该为字符串或字符串列表")
         return None
-    _filter = {'code': code}
 
     if fields is None:
         projection = {"_id": 0}
@@ -531,10 +564,17 @@ def get_fundamentals_continuously(code, fields=None, end_date=None, count=None):
             "$gte": date_to_int(query_start[2:])
         }
 
-    coll = DATABASE.report
-    cursor = coll.find(filter=_filter, projection=projection)
-    db_data = pd.DataFrame([item for item in cursor])
-    if len(db_data) > 1:
+    db_data = _find_report(_filter, projection)
+    if isinstance(code, list):
+        if len(db_data) == 0:
+            log.warning("get_fundamentals_continuously未查询到数据")
+            return None
+        res = _align_fundamentals(db_data, code, end, count)
+        if len(res) == 0:
+            log.warning("get_fundamentals_continuously未查询到数据")
+            return None
+        return res
+    elif len(db_data) > 1:
         db_data = db_data.sort_values('report_date')
         db_data.insert(2, 'pub_date', db_data['f314'].apply(int_to_date))
         db_data.drop(columns=['f314'], inplace=True)
@@ -553,6 +593,47 @@ def get_fundamentals_continuously(code, fields=None, end_date=None, count=None):
         return None
 
 
+def _align_fundamentals(db_data, code, end, count):
+    # type: (pd.DataFrame, list, str, Optional[int]) -> pd.DataFrame
+    """
+    将多只股票的财报数据一次性对齐到交易日历，每个交易日取各股票截至当日已发布的最新财报
+
+    :param db_data: 数据库查询得到的财报数据
+    :param code: 股票代码列表
+    :param end: 结束日期
+    :param count: 保留end前count个交易日的数据，None表示保留全部
+
+    :return: 以(date, code)为多重索引的DataFrame
+    """
+    db_data = db_data.sort_values(['code', 'report_date'])
+    db_data.insert(2, 'pub_date', db_data['f314'].apply(int_to_date))
+    db_data.drop(columns=['f314'], inplace=True)
+
+    # 周末及节假日发布的财报从下一个交易日开始生效
+    index = trade_calendar.ceil_array(db_data['pub_date'].to_numpy())
+    valid = index < len(trade_calendar)
+    db_data = db_data[valid].assign(date=trade_calendar.array[index[valid]])
+    db_data = db_data[db_data['date'] <= end].copy()
+    if len(db_data) == 0:
+        return db_data.set_index(['date', 'code'])
+
+    date_list = get_trade_days(db_data['date'].min(), end)
+    if count is not None:
+        date_list = date_list[-count:]
+    # 窗口开始前发布的财报合并至窗口首日参与向前填充，同一日生效多份财报时取最新报告期
+    db_data['date'] = db_data['date'].where(db_data['date'] >= date_list[0], date_list[0])
+    db_data = db_data.drop_duplicates(['code', 'date'], keep='last')
+
+    grid = pd.MultiIndex.from_product([date_list, code], names=['date', 'code']).to_frame(index=False)
+    res = grid.merge(db_data, on=['date', 'code'], how='left')
+    res = res.sort_values(['code', 'date'])
+    columns = [column for column in res.columns if column not in ['date', 'code']]
+    res[columns] = res.groupby('code')[columns].ffill()
+    res = res.dropna(subset=['report_date'])
+    res['report_date'] = res['report_date'].round(0).astype(int)
+    return res.set_index(['date', 'code']).sort_index()
+
+
 def get_history_fundamentals(code, fields, watch_date=None, report_date=None, count=1, interval='1q'):
     # type: (Optional[str], Optional[list], Optional[str], Optional[str], int, str) -> Optional[pd.DataFrame]
     """
@@ -653,10 +734,7 @@ def get_history_fundamentals(code, fields, watch_date=None, report_date=None, co
                 log.error("参数watch_date和report_date必须指定一个!")
                 return None
 
-            coll = DATABASE.report
-            cursor = coll.find(filter=_filter, projection=projection)
-
-            db_data = pd.DataFrame([item for item in cursor])
+            db_data = _find_report(_filter, projection)
             if len(db_data) < 1:
                 log.warning("get_history_fundamentals未查询到数据")
                 return None
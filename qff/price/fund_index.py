@@ -0,0 +1,168 @@
+# coding :utf-8
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016-2019 XuHaiJiang/QFF
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+财务数据时点索引
+
+回测运行期间，get_fundamentals每日查询report集合的开销较大。本模块在首次查询时一次性载入全部财报的code、
+report_date及公告日期f314，按(code, 公告日期)排序建立索引，查询某日可见的财报时通过二分查找确定每个标的的候选记录，
+财务字段仅在首次被查询时按列载入。仅支持由字段比较运算($gt/$gte/$lt/$lte/$eq/$ne/$in/$nin)组成的简单查询条件，
+其他查询条件返回None，由调用方回退至数据库查询。
+"""
+
+import threading
+import numpy as np
+import pandas as pd
+from typing import Dict, List, Optional, Tuple
+from qff.tools.mongo import DATABASE
+
+__all__ = ['FundamentalsIndex', 'fund_index']
+
+COMPARE_OPS = {
+    '$gt': np.greater,
+    '$gte': np.greater_equal,
+    '$lt': np.less,
+    '$lte': np.less_equal,
+    '$eq': np.equal,
+    '$ne': np.not_equal,
+}
+
+KEY_COLUMNS = ['code', 'report_date', 'f314']
+KEY_SCALE = 10 ** 8  # 索引键 = 标的序号 * KEY_SCALE + 公告日期(YYYYMMDD)
+
+
+class FundamentalsIndex:
+    """
+    财报时点索引对象，所有数组按(code, 公告日期, report_date)排序
+    """
+
+    def __init__(self):
+        self._keys: Optional[np.ndarray] = None
+        self._ords: Optional[np.ndarray] = None  # 各标的序号，用于批量生成查询键
+        self._row_index: Optional[pd.MultiIndex] = None
+        self._columns: Dict[str, np.ndarray] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def loaded(self):
+        return self._keys is not None
+
+    def _build(self):
+        cursor = DATABASE.report.find({}, {'_id': 0, 'code': 1, 'report_date': 1, 'f314': 1}, batch_size=10000)
+        df = pd.DataFrame([item for item in cursor], columns=KEY_COLUMNS)
+        f314 = df['f314'].fillna(0).to_numpy(dtype='int64')
+        # f314为YYMMDD格式，转换为YYYYMMDD后才能跨世纪排序，未公告的记录为0，不会被任何日期查询命中
+        df['pub'] = np.where((f314 > 0) & (f314 <= 999999),
+                             f314 + np.where(f314 > 800000, 19000000, 20000000), f314)
+        df = df.sort_values(['code', 'pub', 'report_date']).reset_index(drop=True)
+
+        codes, ords = np.unique(df['code'].to_numpy(dtype=str), return_inverse=True)
+        self._ords = np.arange(len(codes), dtype='int64')
+        self._keys = ords.astype('int64') * KEY_SCALE + df['pub'].to_numpy(dtype='int64')
+        self._row_index = pd.MultiIndex.from_arrays([df['code'], df['report_date']])
+        self._columns = {column: df[column].to_numpy() for column in KEY_COLUMNS}
+
+    def _load(self, fields):
+        # type: (List[str]) -> None
+        fields = [field for field in fields if field not in self._columns]
+        if len(fields) == 0:
+            return
+        projection = dict(**{'_id': 0, 'code': 1, 'report_date': 1}, **dict.fromkeys(fields, 1))
+        cursor = DATABASE.report.find({}, projection, batch_size=10000)
+        df = pd.DataFrame([item for item in cursor], columns=['code', 'report_date'] + fields)
+        df = df.drop_duplicates(['code', 'report_date']).set_index(['code', 'report_date']).reindex(self._row_index)
+        for field in fields:
+            self._columns[field] = df[field].to_numpy()
+
+    @staticmethod
+    def _parse_filter(filter):
+        # type: (Dict) -> Optional[List[Tuple[str, str, object]]]
+        conds = []
+        for column, cond in filter.items():
+            if column.startswith('$'):
+                return None
+            if isinstance(cond, dict):
+                for op, value in cond.items():
+                    if op not in COMPARE_OPS and op not in ['$in', '$nin']:
+                        return None
+                    conds.append((column, op, value))
+            else:
+                conds.append((column, '$eq', cond))
+        return conds
+
+    def query(self, filter, projection, pub_range=None):
+        # type: (Dict, Dict, Optional[Tuple[int, int]]) -> Optional[pd.DataFrame]
+        """
+        查询满足条件的财报记录，结果与数据库查询返回的记录一致(未按标的取最新一期)
+
+        :param filter: 查询条件字典，按pymongo格式输入
+        :param projection: 查询字段字典，仅支持包含字段方式
+        :param pub_range: 公告日期范围(开始, 结束)，YYYYMMDD格式整数，None表示不限制公告日期
+
+        :return: 包含code、report_date、f314及查询字段的DataFrame，查询条件不受支持时返回None
+        """
+        conds = self._parse_filter(filter)
+        if conds is None or any(value == 0 for key, value in projection.items() if key != '_id'):
+            return None
+        fields = [key for key in projection if key not in KEY_COLUMNS and key != '_id']
+        if len(fields) == 0:
+            return None  # 查询全部字段时载入所有列的代价过大，回退至数据库查询
+
+        with self._lock:
+            if not self.loaded:
+                self._build()
+            self._load(fields + [cond[0] for cond in conds])
+            keys, ords, columns = self._keys, self._ords, self._columns
+
+        if pub_range is None:
+            rows = np.arange(len(keys))
+        else:
+            lo = np.searchsorted(keys, ords * KEY_SCALE + pub_range[0], side='left')
+            hi = np.searchsorted(keys, ords * KEY_SCALE + pub_range[1], side='right')
+            counts = hi - lo
+            rows = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+        mask = np.ones(len(rows), dtype=bool)
+        for column, op, value in conds:
+            values = columns[column][rows]
+            if op == '$in':
+                mask &= np.isin(values, list(value))
+            elif op == '$nin':
+                mask &= ~np.isin(values, list(value))
+            else:
+                mask &= COMPARE_OPS[op](values, value)
+        rows = rows[mask]
+
+        return pd.DataFrame({column: columns[column][rows] for column in KEY_COLUMNS + fields})
+
+    def clear(self):
+        """
+        释放索引数据
+        """
+        with self._lock:
+            self._keys = self._ords = self._row_index = None
+            self._columns = {}
+
+
+fund_index = FundamentalsIndex()
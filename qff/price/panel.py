@@ -0,0 +1,184 @@
+# coding :utf-8
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016-2019 XuHaiJiang/QFF
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+回测行情数据面板
+
+回测开始前将股票池(context.universe)及基准指数在回测期间的日数据，以少量批量查询预先载入内存，按(日期, 标的)保存为
+NumPy数组；分钟数据按交易日分块(每块默认20个交易日)批量载入，每块占用内存不超过MAX_MIN_BYTES，标的数量较多时减少每块的
+交易日数量，单个交易日也超过上限时不载入分钟数据，由get_current_data()查询数据库。get_current_data()在回测时优先从面板中
+读取数据，避免每个交易日对每个标的重复查询数据库。
+"""
+
+import numpy as np
+import pandas as pd
+from typing import Dict, List, Optional
+from qff.price.query import get_price
+from qff.tools.date import get_trade_days, get_pre_trade_day, get_trade_min_list
+from qff.tools.logs import log
+
+__all__ = ['PricePanel', 'load_price_panel', 'get_price_panel', 'clear_price_panel']
+
+PANEL_FIELDS = ['open', 'close', 'high', 'low', 'vol', 'amount']
+
+MAX_MIN_BYTES = 512 * 1024 * 1024  # 每块分钟数据占用内存的上限(字节)
+
+price_panels: Dict[str, 'PricePanel'] = {}  # 行情数据面板，key为market
+
+
+def _to_array(data, field, index, columns):
+    # 将get_price返回的(日期, 代码)长表转换为二维数组, 行为日期(时间), 列为标的代码
+    if data is None or field not in data.columns:
+        return np.full((len(index), len(columns)), np.nan)
+    if data.index.nlevels == 1:  # 单个标的时get_price返回的行索引不包含code
+        return data[field].reindex(index).to_numpy(dtype='float64').reshape(-1, 1)
+    return data[field].unstack('code').reindex(index=index, columns=columns).to_numpy(dtype='float64')
+
+
+class PricePanel:
+    """
+    行情数据面板对象
+
+    ================== =====================  =======================================================================
+        属性            类型                      说明
+    ================== =====================  =======================================================================
+    market             str                      市场类型
+    codes              list                     面板包含的标的代码列表
+    dates              list                     面板包含的交易日列表(首个交易日为回测开始的前一交易日)
+    day                dict                     日数据数组, key为字段名, value为shape为(日期数, 标的数)的数组
+    min_block          int                      分钟数据每次批量载入的交易日数量，受MAX_MIN_BYTES限制，为0时不载入
+    ================== =====================  =======================================================================
+
+    """
+
+    def __init__(self, codes, start, end, market='stock', min_block=20):
+        # type: (List[str], str, str, str, int) -> None
+        self.market = market
+        self.codes = list(codes)
+        self.code_index = {code: i for i, code in enumerate(self.codes)}
+        self.dates = get_trade_days(get_pre_trade_day(start), end)
+        self.date_index = {date: i for i, date in enumerate(self.dates)}
+        # 每个交易日240条分钟数据，各字段为float64数组
+        self.min_block = min(min_block, MAX_MIN_BYTES // (240 * max(len(self.codes), 1) * len(PANEL_FIELDS) * 8))
+        if self.min_block < min_block:
+            log.warning(f'PricePanel分钟数据每块交易日数量由{min_block}调整为{self.min_block}，以限制内存占用')
+
+        data = get_price(self.codes, start=self.dates[0], end=self.dates[-1], market=market)
+        self.day = {field: _to_array(data, field, self.dates, self.codes) for field in PANEL_FIELDS}
+
+        self._min_dates = []
+        self._min_index = {}
+        self._min = {}
+
+    def covers(self, codes, start, end):
+        # type: (List[str], str, str) -> bool
+        """
+        判断面板是否已包含指定标的在回测期间的数据
+        """
+        return all(code in self.code_index for code in codes) \
+            and self.dates[0] <= get_pre_trade_day(start) and self.dates[-1] >= end
+
+    def has(self, code, date):
+        # type: (str, str) -> bool
+        """
+        判断面板中是否包含标的在指定交易日及其前一交易日的日数据(收盘价及成交量)
+        """
+        i = self.date_index.get(date)
+        j = self.code_index.get(code)
+        if i is None or i < 1 or j is None:
+            return False
+        return not any(np.isnan(self.day[field][i - 1:i + 1, j]).any() for field in ['close', 'vol'])
+
+    def day_frame(self, code, date, count=2):
+        # type: (str, str, int) -> pd.DataFrame
+        """
+        返回标的截至指定交易日最近count个交易日的日数据，格式与get_price返回结果一致，面板中缺失的交易日不返回
+        """
+        i = self.date_index[date] + 1
+        j = self.code_index[code]
+        index = pd.Index(self.dates[max(i - count, 0):i], name='date')
+        data = pd.DataFrame({field: self.day[field][max(i - count, 0):i, j] for field in PANEL_FIELDS}, index=index)
+        return data.dropna(subset=['close', 'vol']).astype({'vol': 'int64'})
+
+    def min_frame(self, code, date):
+        # type: (str, str) -> Optional[pd.DataFrame]
+        """
+        返回标的指定交易日的1分钟数据，格式与get_price返回结果一致，面板中无数据时返回None
+        """
+        if date not in self._min_index:
+            self._load_min_block(date)
+        j = self.code_index.get(code)
+        if j is None or date not in self._min_index:
+            return None
+        k = self._min_index[date]
+        rows = slice(k * 240, (k + 1) * 240)
+        index = pd.Index(get_trade_min_list(date)[1:], name='datetime')
+        data = pd.DataFrame({field: self._min[field][rows, j] for field in PANEL_FIELDS}, index=index).dropna()
+        if len(data) == 0:
+            return None
+        return data.astype({'vol': 'int64'})
+
+    def _load_min_block(self, date):
+        i = self.date_index.get(date)
+        if i is None or self.min_block < 1:
+            return
+        self._min_dates = self.dates[i:i + self.min_block]
+        self._min_index = {day: k for k, day in enumerate(self._min_dates)}
+        grid = [dt for day in self._min_dates for dt in get_trade_min_list(day)[1:]]
+        log.debug(f'PricePanel载入分钟数据:{self.market} {self._min_dates[0]}~{self._min_dates[-1]}')
+        data = get_price(self.codes, start=self._min_dates[0], end=self._min_dates[-1], freq='1min',
+                         market=self.market)
+        self._min = {field: _to_array(data, field, grid, self.codes) for field in PANEL_FIELDS}
+
+
+def load_price_panel(codes, start, end, market='stock', min_block=20):
+    # type: (List[str], str, str, str, int) -> Optional[PricePanel]
+    """
+    预先载入回测期间的行情数据面板
+
+    :param codes: 标的代码列表
+    :param start: 回测开始日期
+    :param end: 回测结束日期
+    :param market: 市场类型，目前支持“stock/index/etf"
+    :param min_block: 分钟数据每次批量载入的交易日数量
+
+    :return: 行情数据面板对象，标的列表为空时返回None
+    """
+    if codes is None or len(codes) == 0:
+        return None
+    panel = price_panels.get(market)
+    if panel is not None and panel.covers(codes, start, end):  # 参数寻优时由父进程预先载入
+        return panel
+    log.info(f'预载入{market}行情数据面板: {len(codes)}个标的, {start}~{end}')
+    price_panels[market] = PricePanel(codes, start, end, market, min_block)
+    return price_panels[market]
+
+
+def get_price_panel(market='stock'):
+    # type: (str) -> Optional[PricePanel]
+    return price_panels.get(market)
+
+
+def clear_price_panel():
+    price_panels.clear()
@@ -26,11 +26,18 @@
 从数据库中查询股票价格数据
 """
 
+import itertools
+import numpy as np
 import pandas as pd
 from typing import Dict, Optional
 from datetime import datetime
 from bson.regex import Regex
 from qff.tools.mongo import DATABASE
+from qff.tools.config import get_config
+from qff.tools.parquet import read_price_parquet
+from qff.price.bar_cache import bar_cache
+from qff.price.adjust import adj_cache
+from qff.price.resample import MIN_PERIODS, resample_min_bars
 from qff.tools.date import get_pre_trade_day, is_trade_day, get_real_trade_date, util_date_valid, util_time_valid
 from qff.tools.utils import util_code_tolist
 from qff.tools.logs import log
@@ -40,6 +47,8 @@ __all__ = ['get_price', 'get_bars', 'get_stock_list', 'get_stock_name', 'get_ind
            'get_mtss', 'get_all_securities', 'get_security_info', 'get_st_stock', 'get_paused_stock',
            'get_stock_block', 'history', 'attribute_history', 'get_index_name', 'get_industry_stocks']
 
+PRICE_BACKEND = get_config('PRICE', 'backend', 'mongo')  # 行情数据后端: mongo-MongoDB数据库, parquet-本地列式文件
+
 
 def get_price(security, start=None, end=None, freq='daily', fields=None, skip_paused=False, fq='pre', count=None,
               market='stock'):
@@ -163,15 +172,13 @@ def get_price(security, start=None, end=None, freq='daily', fields=None, skip_pa
         date_index = 'datetime'
     # 3、其他参数初始化
     code = util_code_tolist(security)
-    coll = DATABASE.get_collection(market + '_' + freq[-3:])
     field_list = ['open', 'close', 'low', 'high', 'vol', 'amount']
     if market == 'index':
         field_list += ['up_count', 'down_count']
 
     # 4、field参数计算
     if fields is None:
-        projection = {"_id": 0, "code": 1, date_index: 1, 'open': 1, 'close': 1, 'low': 1, 'high': 1, 'vol': 1,
-                      'amount': 1}
+        base_fields = ['open', 'close', 'low', 'high', 'vol', 'amount']
     else:
         if isinstance(fields, str):
             fields = [fields]
@@ -183,19 +190,90 @@ def get_price(security, start=None, end=None, freq='daily', fields=None, skip_pa
             if market == 'stock' and skip_paused and 'vol' not in base_fields:
                 base_fields.append('vol')
 
-            projection = dict.fromkeys(base_fields, 1)
-            prefix = {
-                "_id": 0,
-                "code": 1,
-                date_index: 1,
-            }
-            projection = dict(**prefix, **projection)
-
         else:
             log.error("get_price：参数fields不合法！,应该为字符串或字符串列表！")
             return None
 
-    # 5、数据库查询
+    # 5、数据查询及复权计算，历史数据优先从缓存中读取
+    if bar_cache.enabled and end[:10] < datetime.now().strftime('%Y-%m-%d'):
+        data = bar_cache.get_price(code, start, end, freq, market, fq,
+                                   lambda _code, _start, _end: _query_price(_code, _start, _end, freq, market, fq,
+                                                                            field_list))
+        if len(data) > 0:
+            data = data[[col for col in [date_index, 'code'] + base_fields if col in data.columns]]
+    else:
+        data = _query_price(code, start, end, freq, market, fq, base_fields)
+
+    if len(data) == 0:
+        log.debug("get_price未查询到数据")
+        return None
+
+    # 6、处理skip_paused
+    if market == 'stock' and skip_paused:
+        data = data.query('vol>1').copy()
+        if fields and 'vol' not in fields:
+            data = data.drop('vol', axis=1)
+
+    if count is not None:
+        data = data.groupby(['code'], as_index=False).tail(count)
+
+    if len(code) == 1:
+        data = data.drop('code', axis=1).set_index(date_index)
+    else:
+        data.set_index([date_index, 'code'], inplace=True)
+    return data
+
+
+def _cursor_to_frame(cursor, str_fields, num_fields, batch_size=10000):
+    # type: (object, list, list, int) -> pd.DataFrame
+    """
+    按批次读取数据库游标，将每批文档的各字段通过np.fromiter直接写入预分配的NumPy数组，避免生成记录字典列表及逐字段的中间列表
+
+    :param cursor: 数据库查询游标
+    :param str_fields: 字符串类型的字段列表，如code、date
+    :param num_fields: 数值类型的字段列表，按float64读取，缺失值为NaN；数据库中为整数且无缺失值的字段(如up_count)保持int64类型
+    :param batch_size: 每批次读取的记录数
+
+    :return: DataFrame, 无数据时返回空DataFrame
+    """
+    chunks = {field: [] for field in str_fields + num_fields}
+    integer = {}
+    batch = list(itertools.islice(cursor, batch_size))
+    while len(batch) > 0:
+        count = len(batch)
+        for field in str_fields:
+            chunks[field].append(np.fromiter((doc.get(field) for doc in batch), dtype=object, count=count))
+        for field in num_fields:
+            if field not in integer:
+                integer[field] = type(batch[0].get(field)) is int
+            try:
+                values = np.fromiter((doc.get(field, np.nan) for doc in batch), dtype='float64', count=count)
+            except TypeError:  # 字段值为None
+                values = np.array([doc.get(field) for doc in batch], dtype='float64')
+            chunks[field].append(values)
+        batch = list(itertools.islice(cursor, batch_size))
+
+    if len(chunks[str_fields[0]]) == 0:
+        return pd.DataFrame()
+    data = {field: np.concatenate(chunks[field]) for field in chunks}
+    for field in num_fields:
+        if integer[field] and not np.isnan(data[field]).any():
+            data[field] = data[field].astype('int64')
+    return pd.DataFrame(data)
+
+
+def _load_bars(code, start, end, freq, market, fields):
+    # type: (list, str, str, str, str, list) -> pd.DataFrame
+    """
+    从数据库(或本地Parquet文件)中读取原始行情数据，未进行数据清洗和复权计算
+    """
+    date_index = 'date' if freq == 'day' else 'datetime'
+    projection = dict(**{"_id": 0, "code": 1, date_index: 1}, **dict.fromkeys(fields, 1))
+
+    if PRICE_BACKEND == 'parquet':
+        columns = [key for key, value in projection.items() if value == 1]
+        return read_price_parquet(code, start, end, freq, market, columns)
+
     filter = {
         'code': {'$in': code},
         date_index: {
@@ -206,70 +284,59 @@ def get_price(security, start=None, end=None, freq='daily', fields=None, skip_pa
     if freq != 'day':
         filter['type'] = freq
 
+    coll = DATABASE.get_collection(market + '_' + freq[-3:])
     cursor = coll.find(filter, projection=projection, batch_size=10000)
+    return _cursor_to_frame(cursor, ['code', date_index], fields)
+
 
-    data = pd.DataFrame([item for item in cursor])
+def _query_price(code, start, end, freq, market, fq, fields):
+    # type: (list, str, str, str, str, Optional[str], list) -> pd.DataFrame
+    """
+    从数据库(或本地Parquet文件)中查询行情数据，完成数据清洗和复权计算，供get_price及行情缓存调用
+
+    :param code: 标的代码列表
+    :param start: 开始时间, 分钟数据为'YYYY-MM-DD HH:MM:SS'格式
+    :param end: 结束时间, 分钟数据为'YYYY-MM-DD HH:MM:SS'格式
+    :param freq: 'day'或'1min', '5min', '15min', '30min', '60min'
+    :param market: 市场类型
+    :param fq: 复权选项
+    :param fields: 行情字段列表
+
+    :return: 包含date(分钟数据为datetime)、code及行情字段列的DataFrame, 无数据时返回空DataFrame
+    """
+    date_index = 'date' if freq == 'day' else 'datetime'
+
+    # 1、数据库查询
+    data = _load_bars(code, start, end, freq, market, fields)
+
+    # 数据库中缺少的大周期分钟数据，由1分钟数据合成
+    if freq in MIN_PERIODS:
+        present = set(data['code'].unique()) if len(data) > 0 else set()
+        missing = [x for x in code if x not in present]
+        if len(missing) > 0:
+            bars = _load_bars(missing, start[:10] + ' 09:30:00', end, '1min', market, fields)
+            bars = resample_min_bars(bars, freq, start, end)
+            if len(bars) > 0:
+                data = pd.concat([data, bars], ignore_index=True) if len(data) > 0 else bars
     if len(data) == 0:
-        log.debug("get_price未查询到数据")
-        return None
+        return data
 
-    # 5、数据清洗
+    # 2、数据清洗
     data.drop_duplicates([date_index, 'code'], inplace=True)
     if 'vol' in data.columns.values:
-        data.vol = data.vol.apply(lambda x: int(x * 100))  # 股票成交数量不能有小数
+        vol = np.nan_to_num(data.vol.to_numpy(dtype='float64'))
+        data.vol = np.rint(vol * 100).astype('int64')  # 股票成交数量不能有小数
     if 'amount' in data.columns.values:
-        data.amount = data.amount.apply(lambda x: round(x, 2))  # 股票成交额保留两位小数
-    # 6、处理skip_paused
-    if market == 'stock' and skip_paused:
-        data = data.query('vol>1').copy()
-        if fields and 'vol' not in fields:
-            data = data.drop('vol', axis=1)
+        data.amount = data.amount.to_numpy(dtype='float64').round(2)  # 股票成交额保留两位小数
 
-    # 7、对股票进行复权计算
+    # 3、对股票进行复权计算
     if market == 'stock' and fq in ['pre', 'post']:
-        cursor = DATABASE.stock_adj.find(
-            {
-                'code': {
-                    '$in': code
-                },
-                "date": {
-                    "$lte": end[:10],
-                    "$gte": start[:10]
-                }
-            },
-            {"_id": 0},
-            batch_size=10000
-        )
-        adj = pd.DataFrame([item for item in cursor])
-        if len(adj) > 0:
-            if date_index == 'datetime':
-                data['date'] = data.datetime.apply(lambda x: str(x)[:10])  # 生成日期
-            data.set_index(['date', 'code'], inplace=True)
-            adj.set_index(['date', 'code'], inplace=True)
-            data = data.join(adj, how='left')
-            if fq == 'pre':
-                data['qfq'] = data['qfq'].fillna(1)  # 前复权空值填1，倒序
-                cof = data['qfq']
-            else:
-                data['hfq'] = data['hfq'].fillna(method='ffill')  # # 后复权空值填最后一个系数
-                cof = data['hfq']
-            for col in ['open', 'high', 'low', 'close']:
-                if col in data.columns.values:
-                    data[col] = round(data[col] * cof, 2)
-            data.reset_index(inplace=True)
-            data.drop(['qfq', 'hfq'], axis=1, inplace=True)
-            if date_index == 'datetime':
-                data.drop('date', axis=1, inplace=True)
-        else:
+        adjusted = adj_cache.apply(data, date_index, fq)
+        if adjusted is None:
             log.debug("get_price获取复权因子失败！返回未复权值")
+        else:
+            data = adjusted
 
-    if count is not None:
-        data = data.groupby(['code'], as_index=False).tail(count)
-
-    if len(code) == 1:
-        data = data.drop('code', axis=1).set_index(date_index)
-    else:
-        data.set_index([date_index, 'code'], inplace=True)
     return data
 
 
@@ -0,0 +1,86 @@
+# coding :utf-8
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016-2019 XuHaiJiang/QFF
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+分钟数据周期合成
+
+由1分钟数据合成5/15/30/60分钟数据，K线的时间标签与通达信一致，为所在区间的结束时间：
+上午从09:30开始、下午从13:00开始，按周期划分区间，如5分钟K线为09:35 ... 11:30, 13:05 ... 15:00，
+60分钟K线为10:30、11:30、14:00、15:00，09:30的集合竞价数据并入第一根K线。
+"""
+
+import numpy as np
+import pandas as pd
+from typing import Optional
+
+__all__ = ['MIN_PERIODS', 'resample_min_bars']
+
+MIN_PERIODS = {'5min': 5, '15min': 15, '30min': 30, '60min': 60}
+
+_AGG_FUNC = {'open': 'first', 'close': 'last', 'high': 'max', 'low': 'min', 'vol': 'sum', 'amount': 'sum'}
+
+
+def _bar_label(minutes, period):
+    # type: (np.ndarray, int) -> np.ndarray
+    """
+    计算每个分钟(相对零点的分钟数)所属K线的结束时间
+    """
+    session = np.where(minutes <= 11 * 60 + 30, 9 * 60 + 30, 13 * 60)
+    label = session + np.ceil((minutes - session) / period).astype('int32') * period
+    return np.maximum(label, session + period)
+
+
+def resample_min_bars(data, freq, start=None, end=None):
+    # type: (pd.DataFrame, str, Optional[str], Optional[str]) -> pd.DataFrame
+    """
+    将1分钟数据合成为更大周期的分钟数据
+
+    :param data: 1分钟数据，包含code、datetime('YYYY-MM-DD HH:MM:SS'格式)及行情字段列，
+        open取第一个值，close取最后一个值，high/low取最大/最小值，vol/amount求和，其他字段取最后一个值
+    :param freq: 目标周期，支持5min/15min/30min/60min
+    :param start: 合成后只保留时间标签不早于start的K线，用于剔除查询开始时间之前的不完整区间
+    :param end: 合成后只保留时间标签不晚于end的K线，用于剔除end所在的不完整区间，避免返回时间标签晚于end的K线
+    :return: 与输入格式相同的DataFrame，无数据时返回空DataFrame
+    """
+    if len(data) == 0:
+        return data
+    period = MIN_PERIODS[freq]
+    data = data.sort_values(['code', 'datetime'], kind='mergesort')
+    dt = data['datetime'].astype(str)
+    minutes = dt.str[11:13].astype('int32').to_numpy() * 60 + dt.str[14:16].astype('int32').to_numpy()
+    label = _bar_label(minutes, period)
+
+    fields = [col for col in data.columns if col not in ['code', 'datetime']]
+    keys = pd.DataFrame({'code': data['code'].to_numpy(), 'day': dt.str[:10].to_numpy(), 'label': label})
+    grouped = pd.concat([keys, data[fields].reset_index(drop=True)], axis=1) \
+        .groupby(['code', 'day', 'label'], sort=False)
+    bars = grouped.agg({field: _AGG_FUNC.get(field, 'last') for field in fields}).reset_index()
+
+    suffix = {t: ' {:02d}:{:02d}:00'.format(t // 60, t % 60) for t in np.unique(label)}
+    bars.insert(1, 'datetime', bars['day'] + bars['label'].map(suffix))
+    bars = bars.drop(['day', 'label'], axis=1)
+    if start is not None:
+        bars = bars[bars['datetime'] >= start]
+    if end is not None:
+        bars = bars[bars['datetime'] <= end]
+    return bars.reset_index(drop=True)
@@ -0,0 +1,179 @@
+# coding :utf-8
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016-2019 XuHaiJiang/QFF
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+多进程共享行情数据
+
+多个回测进程同时运行时，各进程分别从数据库查询相同的行情数据，内存占用成倍增加。本模块将股票池在回测期间的日数据及
+1分钟数据按(时间, 标的)数组写入 shared_path 目录下的内存映射文件，并以json格式的清单文件记录数组的位置和形状。
+回测进程以只读方式映射该文件并注册为行情数据面板，BacktestData(PanelData)直接读取映射数组，各进程共享操作系统的页缓存，
+N个并发回测只占用约一份数据的内存。
+"""
+
+import os
+import json
+import numpy as np
+from datetime import datetime
+from typing import List, Optional
+from qff.price.query import get_price
+from qff.price.panel import PricePanel, PANEL_FIELDS, price_panels, _to_array
+from qff.tools.date import get_trade_days, get_pre_trade_day, get_trade_min_list
+from qff.tools.local import shared_path
+from qff.tools.logs import log
+
+__all__ = ['publish_market_data', 'attach_market_data', 'remove_market_data', 'SharedPricePanel']
+
+MIN_BARS = 240  # 每个交易日1分钟bar数量
+
+
+def _files(name):
+    return os.path.join(shared_path, name + '.json'), os.path.join(shared_path, name + '.bin')
+
+
+def publish_market_data(codes, start, end, market='stock', name=None, minute=True, min_block=20):
+    # type: (List[str], str, str, str, Optional[str], bool, int) -> str
+    """
+    将标的在回测期间的日数据及1分钟数据写入内存映射文件，供多个回测进程共享
+
+    :param codes: 标的代码列表
+    :param start: 回测开始日期
+    :param end: 回测结束日期
+    :param market: 市场类型，目前支持“stock/index/etf"
+    :param name: 共享数据名称，默认为“市场_开始日期_结束日期”
+    :param minute: 是否包含1分钟数据
+    :param min_block: 1分钟数据每次批量查询的交易日数量
+
+    :return: 共享数据名称，回测进程通过 attach_market_data(name) 映射该数据
+    """
+    codes = list(codes)
+    dates = get_trade_days(get_pre_trade_day(start), end)
+    min_dates = dates[1:] if minute else []
+    if name is None:
+        name = f'{market}_{dates[1]}_{dates[-1]}'
+    manifest_file, data_file = _files(name)
+
+    arrays = {}
+    offset = 0
+    for prefix, rows in [('day', len(dates)), ('min', len(min_dates) * MIN_BARS)]:
+        for field in PANEL_FIELDS:
+            if rows > 0:
+                arrays[f'{prefix}.{field}'] = [offset, rows, len(codes)]
+                offset += rows * len(codes)
+
+    log.info(f'发布共享行情数据{name}: {len(codes)}个标的, {dates[1]}~{dates[-1]}')
+    buffer = np.memmap(data_file + '.tmp', dtype='float64', mode='w+', shape=(max(offset, 1),))
+
+    def view(key):
+        pos, rows, cols = arrays[key]
+        return buffer[pos:pos + rows * cols].reshape(rows, cols)
+
+    data = get_price(codes, start=dates[0], end=dates[-1], market=market)
+    for field in PANEL_FIELDS:
+        view('day.' + field)[:] = _to_array(data, field, dates, codes)
+
+    for i in range(0, len(min_dates), min_block):
+        block = min_dates[i:i + min_block]
+        grid = [dt for day in block for dt in get_trade_min_list(day)[1:]]
+        data = get_price(codes, start=block[0], end=block[-1], freq='1min', market=market)
+        rows = slice(i * MIN_BARS, (i + len(block)) * MIN_BARS)
+        for field in PANEL_FIELDS:
+            view('min.' + field)[rows] = _to_array(data, field, grid, codes)
+
+    buffer.flush()
+    del buffer
+    os.replace(data_file + '.tmp', data_file)
+
+    manifest = {
+        'name': name,
+        'market': market,
+        'codes': codes,
+        'dates': dates,
+        'min_dates': min_dates,
+        'fields': PANEL_FIELDS,
+        'arrays': arrays,
+        'created': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+    }
+    with open(manifest_file, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    return name
+
+
+class SharedPricePanel(PricePanel):
+    """
+    映射共享行情数据文件的行情数据面板，数组均为只读的内存映射视图，分钟数据不再分块查询数据库
+    """
+
+    def __init__(self, manifest, data_file):
+        # type: (dict, str) -> None
+        self.name = manifest['name']
+        self.market = manifest['market']
+        self.codes = manifest['codes']
+        self.code_index = {code: i for i, code in enumerate(self.codes)}
+        self.dates = manifest['dates']
+        self.date_index = {date: i for i, date in enumerate(self.dates)}
+        self.min_block = 0
+
+        buffer = np.memmap(data_file, dtype='float64', mode='r')
+
+        def view(key):
+            pos, rows, cols = manifest['arrays'][key]
+            return buffer[pos:pos + rows * cols].reshape(rows, cols)
+
+        self.day = {field: view('day.' + field) for field in PANEL_FIELDS}
+        self._min_dates = manifest['min_dates']
+        self._min_index = {day: k for k, day in enumerate(self._min_dates)}
+        self._min = {field: view('min.' + field) for field in PANEL_FIELDS} if len(self._min_dates) > 0 else {}
+
+    def _load_min_block(self, date):
+        return  # 共享数据不包含的日期由PanelData回退至数据库查询
+
+
+def attach_market_data(name):
+    # type: (str) -> Optional[SharedPricePanel]
+    """
+    以只读方式映射共享行情数据，并注册为当前进程的行情数据面板
+
+    :param name: 共享数据名称，publish_market_data 的返回值
+    :return: 行情数据面板对象，共享数据不存在时返回None
+    """
+    manifest_file, data_file = _files(name)
+    if not os.path.exists(manifest_file) or not os.path.exists(data_file):
+        log.error(f'共享行情数据{name}不存在！')
+        return None
+    with open(manifest_file, encoding='utf-8') as f:
+        manifest = json.load(f)
+    panel = SharedPricePanel(manifest, data_file)
+    price_panels[panel.market] = panel
+    log.info(f'映射共享行情数据{name}: {len(panel.codes)}个标的, {panel.dates[1]}~{panel.dates[-1]}')
+    return panel
+
+
+def remove_market_data(name):
+    # type: (str) -> None
+    """
+    删除共享行情数据文件，已映射该数据的进程不受影响
+    """
+    for file in _files(name):
+        if os.path.exists(file):
+            os.remove(file)
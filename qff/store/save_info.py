@@ -57,12 +57,12 @@ import json
 def save_stock_list():
     """
     每日自动更新stock_list表,同时维护stock_name表数据
-    :return: 无
+    :return: 全部保存成功返回True，出现错误返回False
     """
     print('====  开始更新股票列表信息 ====')
     if 'stock_list' not in DATABASE.list_collection_names():
         print('stock_list未初始化，请先运行qff save init_info命令')
-        return
+        return False
     else:
         coll_list = DATABASE.get_collection('stock_list')
 
@@ -152,10 +152,12 @@ def save_stock_list():
                 coll_name.insert_many(util_to_json_from_pandas(df_change))
 
         print('====  更新股票列表完成！ ====')
+        return True
 
     except Exception as err:
         print('====  更新股票列表完成！但出现异常！ ====')
         print(err)
+        return False
 
 
 def init_index_list():
@@ -31,9 +31,10 @@ import pandas as pd
 import numpy as np
 import pymongo
 import random
+from pymongo import UpdateOne
 from qff.tools.mongo import DATABASE
 from qff.tools.date import date_to_int, get_next_trade_day, get_trade_days, get_pre_trade_day
-from qff.tools.utils import util_to_json_from_pandas
+from qff.tools.utils import util_to_json_from_pandas, util_code_tolist
 
 
 _sh_url = 'http://www.sse.com.cn/market/dealingdata/overview/margin/a/rzrqjygk{}.xls'
@@ -76,34 +77,52 @@ def save_mtss_by_day(date, err):
     return
 
 
-def patch_mtss_data(code, start):
+def patch_mtss_data(code, start, chunk_size=500):
     """
     补充融资融券缺失数据
-    :return:
+
+    深交所数据不包含融资偿还额和融券偿还量，根据前一交易日余额计算：偿还额 = 前日余额 + 当日买入额 - 当日余额。
+    股票按chunk_size只分组，每组通过一次查询读取start前一交易日以来的数据，按股票分组平移计算后以一次bulk_write写入。
+
+    :param code: 一支股票代码或股票代码列表，只处理深交所股票
+    :param start: 开始日期
+    :param chunk_size: 每组处理的股票数量
+    :return: 全部更新成功返回True，出现错误返回False
     """
     coll = DATABASE.stock_mtss
+    ok = True
     start = get_pre_trade_day(start)
-    if code[0] in ['0', '3']:
-        ref = coll.find({'code': code, 'date': {'$gte': start}}, {'_id': 0})
+    codes = [x for x in util_code_tolist(code) if x[0] in ['0', '3']]
+    for pos in range(0, len(codes), chunk_size):
+        chunk = codes[pos:pos + chunk_size]
+        ref = coll.find({'code': {'$in': chunk}, 'date': {'$gte': start}},
+                        {'_id': 0, 'date': 1, 'code': 1, 'fin_value': 1, 'fin_buy_value': 1,
+                         'sec_value': 1, 'sec_sell_value': 1}, batch_size=10000)
         mtss = pd.DataFrame([item for item in ref])
-        if len(mtss) >= 2:
-            mtss.sort_values('date', inplace=True)
-
-            mtss['fin_refund_value'] = mtss['fin_value'].shift(1) + mtss['fin_buy_value'] - mtss['fin_value']
-            mtss['sec_refund_value'] = mtss['sec_value'].shift(1) + mtss['sec_sell_value'] - mtss['sec_value']
-            mtss = mtss.iloc[1:]
-        elif len(mtss) == 1:
-            mtss['fin_refund_value'] = mtss['fin_buy_value'] - mtss['fin_value']
-            mtss['sec_refund_value'] = mtss['sec_sell_value'] - mtss['sec_value']
-        else:
-            return
-
-        upd_data = util_to_json_from_pandas(mtss)
+        if len(mtss) == 0:
+            continue
+        mtss = mtss.sort_values(['code', 'date'], kind='mergesort').reset_index(drop=True)
+
+        group = mtss.groupby('code')
+        first = group.cumcount() == 0
+        single = group['code'].transform('size') == 1
+        fin_pre = group['fin_value'].shift(1).where(~first, 0)
+        sec_pre = group['sec_value'].shift(1).where(~first, 0)
+        mtss['fin_refund_value'] = fin_pre + mtss['fin_buy_value'] - mtss['fin_value']
+        mtss['sec_refund_value'] = sec_pre + mtss['sec_sell_value'] - mtss['sec_value']
+        # 有多条数据时，第一条数据缺少前一交易日余额，不更新
+        mtss = mtss[~first | single]
+
+        upd_data = util_to_json_from_pandas(mtss[['date', 'code', 'fin_refund_value', 'sec_refund_value']])
         try:
-            for d in upd_data:
-                coll.update_one({'date': d['date'], 'code': d['code']}, {'$set': d})
+            coll.bulk_write([UpdateOne({'date': d['date'], 'code': d['code']},
+                                       {'$set': {'fin_refund_value': d['fin_refund_value'],
+                                                 'sec_refund_value': d['sec_refund_value']}})
+                             for d in upd_data], ordered=False)
         except Exception as e:
-            print('更新失败，错误：{}，code:{}'.format(e, code))
+            ok = False
+            print('更新失败，错误：{}，code:{}'.format(e, chunk))
+    return ok
 
 
 def save_mtss_data():
@@ -145,16 +164,15 @@ def save_mtss_data():
         ref3 = DATABASE.stock_mtss.distinct('code', {'date': start})
 
     code_list = [item for item in ref3]
-    for item in range(len(code_list)):
-        print('The {} of Total {}'.format(item, len(code_list)))
-        patch_mtss_data(code_list[item], start)
+    print('Total {} codes'.format(len(code_list)))
+    patched = patch_mtss_data(code_list, start)
 
     print('==== FINISH SAVE STOCK MTSS DATA =====')
 
     if len(err) > 0:
         print('ERROR CODE \n ')
         print(err)
-    return
+    return len(err) == 0 and patched
 
 
 if __name__ == '__main__':
@@ -30,20 +30,32 @@ import pandas as pd
 import numpy as np
 import datetime
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import Optional
 from qff.price.fetch import fetch_price, fetch_stock_xdxr, fetch_stock_block
 from qff.price.query import get_all_securities
-from qff.tools.date import get_real_trade_date, get_next_trade_day, util_get_date_gap, get_trade_days, get_pre_trade_day
+from qff.price.adjust import adj_cache
+from qff.price.bar_cache import bar_cache
+from qff.price.resample import MIN_PERIODS, resample_min_bars
+from qff.tools.date import get_real_trade_date, get_next_trade_day, get_trade_days, get_trade_gap
 from qff.tools.mongo import DATABASE
+from qff.tools.parquet import PARQUET_ENABLE, write_price_parquet
+from qff.tools.tdx_pool import get_tdx_pool
 from qff.tools.utils import util_to_json_from_pandas, util_code_tolist
+from pymongo import ReplaceOne
 from pymongo.errors import PyMongoError
 
 
-def save_security_day(market='stock', security=None):
+def save_security_day(market='stock', security=None, workers=4):
     """
     从通达信获取交易日数据，并保存到数据库中
+
+    各证券已保存数据的最后一条记录通过一次聚合查询获得，workers个下载线程通过通达信连接池(复用持久连接)并发下载。
+
     :param market: 市场类型，目前支持“stock/index/etf", 默认“stock".
     :param security: list or None, 证券列表
+    :param workers: 下载线程数量，默认4个
+    :return: 全部保存成功返回True，出现错误返回False
     """
     try:
 
@@ -56,170 +68,346 @@ def save_security_day(market='stock', security=None):
         coll.create_index([("code", 1), ("date", 1)], unique=True)
         coll.create_index("date")
 
+        last = _last_day_records(coll, None if security is None else stock_list)
+        tasks = []
+        for code in stock_list:
+            last_recode = last.get(code)
+            start_date = '1990-01-01' if last_recode is None else last_recode['date']
+            if start_date != end_date:
+                tasks.append((code, start_date))
+
+        def _fetch(api, task):
+            return fetch_price(task[0], freq='day', market=market, start=task[1], api=api)
+
         data_num = 0
         data_list = []
+        errors = 0
         start = time.perf_counter()
-        total = len(stock_list)
-        for item in range(total):
-            code = stock_list[item]
+        total = len(tasks)
+        for item, ((code, start_date), data) in enumerate(get_tdx_pool().imap(_fetch, tasks, workers)):
             print_progress(item, total, start, code)
+            last_recode = last.get(code)
 
             try:
-                last_recode = coll.find_one({'code': code}, sort=[('date', -1)])
-                start_date = last_recode['date']
-            except TypeError or PyMongoError:
-                start_date = '1990-01-01'
-                last_recode = None
-
-            if start_date != end_date:
-                try:
-                    # start_date = get_next_trade_day(start_date)
-                    # print('Trying updating {} from {}'.format(code, start_date))
-                    data = fetch_price(code, freq='day', market=market, start=start_date)
-                    if data is None or len(data) == 0:
-                        # 如果每日更新时遇见连续停牌股票，则fetch_price返回空，
-                        # 如果start_date不为'1990-01-01'
-                        # 需要将数据库中最后一条记录的收盘价，用于生成停牌日数据
-                        if start_date > '1990-01-01':
-                            data = pd.DataFrame(
-                                index=pd.Index(get_trade_days(start_date, end_date), name='date'),
-                                columns=['code', 'open', 'close', 'low', 'high', 'vol', 'amount']
-                            )
-                            data['code'] = code
-                            data[['open', 'close', 'high', 'low']] = last_recode['close']
-                            data[['vol', 'amount']] = 0
-                        else:
-                            print('股票{}无历史日数据！可能是未上市新股!'.format(code))
-                            continue
-
-                    else:
-
-                        data = data.loc[:end_date]
-                        if start_date == '1990-01-01':
-                            start_date = data.index[0]   # fix bug like :updating 603125 data error!
-                                                         # Exception:'1990-01-01'
-
-                        dl = get_trade_days(start_date, end_date)
-
-                        if len(dl) > len(data):
-                            # 存在停牌日数据
-                            dl_df = pd.DataFrame(index=pd.Index(dl, name='date'))
-                            data = dl_df.join(data).sort_index()
-
-                            data.code.fillna(value=code, inplace=True)
-
-                            if np.isnan(data.loc[start_date, 'close']):
-                                data.loc[start_date, 'close'] = last_recode['close']
-                            data.close.fillna(method='ffill', inplace=True)
-
-                            data = data.fillna(method='bfill', axis=1)
-                            data.vol.fillna(value=0, inplace=True)
-                            data.amount.fillna(value=0, inplace=True)
-                            data = data.fillna(method='ffill', axis=1)
-
+                if isinstance(data, Exception):
+                    raise data
+                # start_date = get_next_trade_day(start_date)
+                # print('Trying updating {} from {}'.format(code, start_date))
+                if data is None or len(data) == 0:
+                    # 如果每日更新时遇见连续停牌股票，则fetch_price返回空，
+                    # 如果start_date不为'1990-01-01'
+                    # 需要将数据库中最后一条记录的收盘价，用于生成停牌日数据
                     if start_date > '1990-01-01':
-                        data.drop(start_date, inplace=True)  # start_date为数据库最后一条记录，避免重复插入
+                        data = pd.DataFrame(
+                            index=pd.Index(get_trade_days(start_date, end_date), name='date'),
+                            columns=['code', 'open', 'close', 'low', 'high', 'vol', 'amount']
+                        )
+                        data['code'] = code
+                        data[['open', 'close', 'high', 'low']] = last_recode['close']
+                        data[['vol', 'amount']] = 0
+                    else:
+                        print('股票{}无历史日数据！可能是未上市新股!'.format(code))
+                        continue
 
-                    data.reset_index(inplace=True)
-                    data_num += len(data)
-                    data_list.append(data)
-                    if data_num > 2000:
-                        data_batch = pd.concat(data_list)
-                        data_num = 0
-                        data_list.clear()
-                        coll.insert_many(util_to_json_from_pandas(data_batch))
+                else:
 
-                except Exception as e:
-                    print(f'updating {code} data error!')
-                    print('Exception:' + str(e))
+                    data = data.loc[:end_date]
+                    if start_date == '1990-01-01':
+                        start_date = data.index[0]   # fix bug like :updating 603125 data error!
+                                                     # Exception:'1990-01-01'
+
+                    dl = get_trade_days(start_date, end_date)
+
+                    if len(dl) > len(data):
+                        # 存在停牌日数据
+                        dl_df = pd.DataFrame(index=pd.Index(dl, name='date'))
+                        data = dl_df.join(data).sort_index()
+
+                        data.code.fillna(value=code, inplace=True)
+
+                        if np.isnan(data.loc[start_date, 'close']):
+                            data.loc[start_date, 'close'] = last_recode['close']
+                        data.close.fillna(method='ffill', inplace=True)
+
+                        data = data.fillna(method='bfill', axis=1)
+                        data.vol.fillna(value=0, inplace=True)
+                        data.amount.fillna(value=0, inplace=True)
+                        data = data.fillna(method='ffill', axis=1)
+
+                if start_date > '1990-01-01':
+                    data.drop(start_date, inplace=True)  # start_date为数据库最后一条记录，避免重复插入
+
+                data.reset_index(inplace=True)
+                data_num += len(data)
+                data_list.append(data)
+                if data_num > 2000:
+                    data_batch = pd.concat(data_list)
+                    data_num = 0
+                    data_list.clear()
+                    coll.insert_many(util_to_json_from_pandas(data_batch))
+                    if PARQUET_ENABLE:
+                        write_price_parquet(data_batch, market, 'day')
+
+            except Exception as e:
+                errors += 1
+                print(f'updating {code} data error!')
+                print('Exception:' + str(e))
 
         if data_num > 0:
             data = pd.concat(data_list)
             coll.insert_many(util_to_json_from_pandas(data))
+            if PARQUET_ENABLE:
+                write_price_parquet(data, market, 'day')
 
         print(f'\n==== SUCCESS SAVE {table_name.upper()} DATA! ====')
+        return errors == 0
     except EOFError:
         time.sleep(1)
+        return False
     except Exception as e:
         print(" \nError save_security_day exception!")
         print(str(e))
+        return False
+
 
+def _last_day_records(coll, codes=None):
+    # 一次聚合查询得到各证券已保存日线数据的最后一条记录(日期及收盘价)，替代逐只证券的find_one查询。
+    # 按(code, date)索引逆序排序后分组取第一条，可以使用索引逐个证券跳跃扫描，不扫描全部记录
+    pipeline = [] if codes is None else [{'$match': {'code': {'$in': list(codes)}}}]
+    pipeline += [{'$sort': {'code': -1, 'date': -1}},
+                 {'$group': {'_id': '$code', 'date': {'$first': '$date'}, 'close': {'$first': '$close'}}}]
+    return {doc['_id']: doc for doc in coll.aggregate(pipeline, allowDiskUse=True)}
 
-def save_security_min(market='stock', freq='1min', security=None):
+
+def _last_min_datetime(coll, freq, codes=None):
+    # 一次聚合查询得到各证券已保存分钟数据的最后时间，替代逐只证券的find_one查询。
+    # 按(type, code, datetime)索引逆序排序后分组取第一条，可以使用索引逐个证券跳跃扫描，不扫描全部记录
+    match = {'type': freq}
+    if codes is not None:
+        match['code'] = {'$in': list(codes)}
+    pipeline = [{'$match': match},
+                {'$sort': {'type': -1, 'code': -1, 'datetime': -1}},
+                {'$group': {'_id': '$code', 'last': {'$first': '$datetime'}}}]
+    return {doc['_id']: doc['last'] for doc in coll.aggregate(pipeline, allowDiskUse=True)}
+
+
+def save_security_min(market='stock', freq='1min', security=None, workers=4, batch_size=50000):
     """
     从通达信获取交易日数据，并保存到数据库中
+
+    各证券已保存数据的最后时间通过一次聚合查询获得；workers个下载线程通过通达信连接池(复用持久连接)并发下载，
+    同时在途的请求数量有上限；主线程按完成顺序取出数据，以无序bulk_write批量写入数据库(按type、code、datetime更新或插入)。
+
     :param market: 市场类型，目前支持“stock/index/etf", 默认“stock".
     :param freq: 分钟频率，支持1min/5min/15min/30min/60min.
     :param security: list or None, 证券列表
+    :param workers: 下载线程数量，默认4个
+    :param batch_size: 每次批量写入数据库的记录数
+    :return: 全部保存成功返回True，出现错误返回False
     """
     if freq not in ["1min", "5min", "15min", "30min", "60min"] or\
        market not in ["stock", "index", "etf"]:
         print("save_security_min: 输入参数错误！")
-        return
+        return False
 
     try:
         end_date = now_time()
-        # stock_list = fetch_stock_list(market).index.to_list()
-        # stock_list = get_all_securities(market=market)
         stock_list = get_all_securities(market=market) if security is None else security
         table_name = market + '_min'
         print(f'==== NOW SAVE {market.upper()}_{freq.upper()} DATA =====')
         coll = DATABASE.get_collection(table_name)
         coll.create_index([("type", 1), ("code", 1), ("datetime", 1)], unique=True)
 
-        data_num = 0
-        data_list = []
-
-        start = time.perf_counter()
-        total = len(stock_list)
-        for item in range(total):
-            code = stock_list[item]
-            print_progress(item, total, start, code)
-
-            try:
-                start_date = coll.find_one({'type': freq, 'code': code}, sort=[('datetime', -1)])['datetime']
-                if start_date is None or start_date == 'nan':
-                    raise TypeError
-            except TypeError or PyMongoError:
+        last = _last_min_datetime(coll, freq, None if security is None else stock_list)
+        tasks = []
+        for code in stock_list:
+            start_date = last.get(code)
+            if start_date is None or start_date == 'nan':
                 start_date = '1990-01-01'
-
             if start_date != end_date:
-                try:
-                    start_date = get_next_trade_day(start_date)
-                    # print('Trying updating {} {} data from {}'.format(code, freq, start_date))
-                    data = fetch_price(code, freq=freq, market=market, start=start_date)
-                    if data is None or len(data) == 0:
-                        continue
-                    data = data.loc[:end_date]
-                    data.reset_index(inplace=True)
-                    data['type'] = freq
-
-                    data_num += len(data)
-                    data_list.append(data)
-                    if data_num > 2000:
-                        data = pd.concat(data_list)
-                        data_num = 0
-                        data_list.clear()
-                        coll.insert_many(util_to_json_from_pandas(data))
-
-                except Exception as e:
-                    print(f'\nupdating {code} {freq} data error!')
-                    print('Exception:' + str(e))
-        if data_num > 0:
-            data = pd.concat(data_list)
-            coll.insert_many(util_to_json_from_pandas(data))
+                tasks.append((code, get_next_trade_day(start_date)))
 
-        print(f'\n==== SUCCESS SAVE {table_name.upper()} {freq} DATA! ====')
+        total = len(tasks)
+        if total == 0:
+            print(f'==== {table_name.upper()} {freq} DATA IS UP TO DATE! ====')
+            return True
+
+        ops = []
+        data_list = []
+        rows = 0
+        errors = 0
+        start = time.perf_counter()
+
+        def _fetch(api, task):
+            return fetch_price(task[0], freq=freq, market=market, start=task[1], api=api)
+
+        def _flush():
+            if len(ops) > 0:
+                coll.bulk_write(ops, ordered=False)
+                if PARQUET_ENABLE:
+                    write_price_parquet(pd.concat(data_list), market, freq)
+                ops.clear()
+                data_list.clear()
+
+        for done, ((code, _), data) in enumerate(get_tdx_pool().imap(_fetch, tasks, workers), 1):
+            print_progress(done, total, start, f'{code} {rows / (time.perf_counter() - start):.0f} rows/s')
+            if isinstance(data, Exception):
+                errors += 1
+                print(f'\nupdating {code} {freq} data error!')
+                print('Exception:' + str(data))
+                continue
+            if data is None or len(data) == 0:
+                continue
+            data = data.loc[:end_date].reset_index()
+            data['type'] = freq
+            data_list.append(data)
+            rows += len(data)
+            ops.extend(ReplaceOne({'type': freq, 'code': code, 'datetime': doc['datetime']}, doc, upsert=True)
+                       for doc in util_to_json_from_pandas(data))
+            if len(ops) >= batch_size:
+                _flush()
+        _flush()
+
+        dur = time.perf_counter() - start
+        print(f'\n==== SUCCESS SAVE {table_name.upper()} {freq} DATA! {rows} rows, {dur:.1f}s, '
+              f'{rows / max(dur, 1e-6):.0f} rows/s ====')
+        return errors == 0
     except EOFError:
         time.sleep(1)
+        return False
     except Exception as e:
         print(f"\nError save_security_min exception!:{market.upper()} {freq.upper()} DATA")
         print(e)
+        return False
+
+
+def save_security_resample(market='stock', freq='5min', security=None, batch_size=50000):
+    """
+    由数据库中已保存的1分钟数据合成5/15/30/60分钟数据并保存，替代分别从通达信下载各周期数据
+
+    各证券从已保存的目标周期数据最后一天的下一个交易日开始合成；日期相同的证券分组批量查询1分钟数据，
+    每组查询的数据量约为50万条，合成结果以无序bulk_write批量写入数据库。
+
+    :param market: 市场类型，目前支持“stock/index/etf", 默认“stock".
+    :param freq: 目标周期，支持5min/15min/30min/60min.
+    :param security: list or None, 证券列表
+    :param batch_size: 每次批量写入数据库的记录数
+    :return: 全部保存成功返回True，出现错误返回False
+    """
+    if freq not in MIN_PERIODS or market not in ["stock", "index", "etf"]:
+        print("save_security_resample: 输入参数错误！")
+        return False
+
+    try:
+        table_name = market + '_min'
+        print(f'==== NOW RESAMPLE {market.upper()}_{freq.upper()} DATA =====')
+        coll = DATABASE.get_collection(table_name)
+        coll.create_index([("type", 1), ("code", 1), ("datetime", 1)], unique=True)
+
+        codes = None if security is None else util_code_tolist(security)
+        last_1min = _last_min_datetime(coll, '1min', codes)
+        last_freq = _last_min_datetime(coll, freq, codes)
+
+        # 按开始合成日期对证券分组
+        groups = {}
+        for code, last in last_1min.items():
+            done = last_freq.get(code)
+            if done is not None and done[:10] >= last[:10]:
+                continue
+            start_day = '1990-01-01' if done is None else get_next_trade_day(done[:10])
+            groups.setdefault(start_day, []).append(code)
+
+        total = sum(len(x) for x in groups.values())
+        if total == 0:
+            print(f'==== {table_name.upper()} {freq} DATA IS UP TO DATE! ====')
+            return True
+
+        projection = {'_id': 0, 'code': 1, 'datetime': 1, 'open': 1, 'close': 1, 'high': 1, 'low': 1,
+                      'vol': 1, 'amount': 1}
+        if market == 'index':
+            projection.update(up_count=1, down_count=1)
+        today = str(datetime.date.today())
+        ops = []
+        rows = 0
+        finished = 0
+        start = time.perf_counter()
+        for start_day, group in groups.items():
+            days = max(1, get_trade_gap(max(start_day, '2000-01-04'), today))
+            chunk = max(1, 500000 // (240 * days))
+            for pos in range(0, len(group), chunk):
+                batch = group[pos:pos + chunk]
+                finished += len(batch)
+                print_progress(finished, total, start, batch[-1])
+                cursor = coll.find({'type': '1min', 'code': {'$in': batch},
+                                    'datetime': {'$gte': start_day + ' 09:30:00'}}, projection, batch_size=10000)
+                data = pd.DataFrame([item for item in cursor])
+                bars = resample_min_bars(data, freq)
+                if len(bars) == 0:
+                    continue
+                bars['type'] = freq
+                rows += len(bars)
+                ops.extend(ReplaceOne({'type': freq, 'code': doc['code'], 'datetime': doc['datetime']}, doc,
+                                      upsert=True) for doc in util_to_json_from_pandas(bars))
+                if PARQUET_ENABLE:
+                    write_price_parquet(bars, market, freq)
+                if len(ops) >= batch_size:
+                    coll.bulk_write(ops, ordered=False)
+                    ops.clear()
+        if len(ops) > 0:
+            coll.bulk_write(ops, ordered=False)
+
+        dur = time.perf_counter() - start
+        print(f'\n==== SUCCESS RESAMPLE {table_name.upper()} {freq} DATA! {rows} rows, {dur:.1f}s ====')
+        return True
+    except Exception as e:
+        print(f"\nError save_security_resample exception!:{market.upper()} {freq.upper()} DATA")
+        print(e)
+        return False
 
 
-def save_stock_xdxr(security=None):
+def save_security_parquet(market='stock', freq='day', security=None):
+    """
+    将数据库中已保存的行情数据导出至本地Parquet文件，用于初始化本地列式行情数据存储
+    :param market: 市场类型，目前支持“stock/index/etf", 默认“stock".
+    :param freq: 数据频率，支持day/1min/5min/15min/30min/60min.
+    :param security: list or None, 证券列表
+    """
+    if freq not in ["day", "1min", "5min", "15min", "30min", "60min"] or \
+       market not in ["stock", "index", "etf"]:
+        print("save_security_parquet: 输入参数错误！")
+        return
+
+    stock_list = get_all_securities(market=market) if security is None else util_code_tolist(security)
+    table_name = market + '_' + freq[-3:]
+    print(f'==== NOW EXPORT {market.upper()}_{freq.upper()} DATA TO PARQUET =====')
+    coll = DATABASE.get_collection(table_name)
+    _filter = {} if freq == 'day' else {'type': freq}
+
+    start = time.perf_counter()
+    total = len(stock_list)
+    for item in range(total):
+        code = stock_list[item]
+        print_progress(item, total, start, code)
+        try:
+            cursor = coll.find(dict(_filter, code=code), {'_id': 0}, batch_size=10000)
+            data = pd.DataFrame([item for item in cursor])
+            write_price_parquet(data, market, freq)
+        except Exception as e:
+            print(f'\nexporting {code} {freq} data error!')
+            print('Exception:' + str(e))
+
+    print(f'\n==== SUCCESS EXPORT {market.upper()}_{freq.upper()} DATA! ====')
+
+
+def save_stock_xdxr(security=None, workers=4):
     """
     保存除权除息数据，并计算股票最新前复权系数，保存至数据库中
+
+    除权除息数据通过通达信连接池并发下载，各股票复权系数的计算和保存在workers个线程中并行执行。
+
+    :param security: list or None, 股票列表
+    :param workers: 计算和保存复权系数的线程数量
+    :return: 全部保存成功返回True，出现错误返回False
     """
 
     coll_xdxr = DATABASE.get_collection('stock_xdxr')
@@ -235,67 +423,96 @@ def save_stock_xdxr(security=None):
         stock_list = util_code_tolist(security)
     start = time.perf_counter()
     total = len(stock_list)
-
-    for item in range(total):
-        code = stock_list[item]
-        print_progress(item, total, start, code)
-        try:
-
-            xdxr = fetch_stock_xdxr(str(code))
+    errors = 0
+
+    # 通过连接池并发下载除权除息数据，下载完成的股票提交至线程池计算并保存复权系数
+    def _fetch(api, code):
+        # 返回None时可能是请求过于频繁，等待1秒后重试一次
+        xdxr = fetch_stock_xdxr(str(code), api=api)
+        if xdxr is None:
+            time.sleep(1)
+            xdxr = fetch_stock_xdxr(str(code), api=api)
+        return xdxr
+
+    results = get_tdx_pool().imap(_fetch, stock_list)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for item, (code, xdxr) in enumerate(results):
+            print_progress(item, total, start, code)
+            if isinstance(xdxr, Exception):
+                errors += 1
+                print("\nError save_stock_xdxr exception!")
+                print(xdxr)
+                continue
             if xdxr is None:
-                time.sleep(1)
-                xdxr = fetch_stock_xdxr(str(code))
-                if xdxr is None:
-                    # print(f"\n {code}:无复权信息！")
-                    continue
-            new_count = len(xdxr)
-            db_count = coll_xdxr.count_documents({'code': code})
-
-            if new_count != db_count:
+                # print(f"\n {code}:无复权信息！")
+                continue
+            futures[executor.submit(_save_code_xdxr, code, xdxr, coll_xdxr, coll_adj)] = code
 
-                # 出现数据库记录数量比实时获取的数据多，则删除
-                coll_xdxr.delete_many({'code': code})
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                errors += 1
+                print(f"\nError save_stock_xdxr exception! {futures[future]}")
+                print(e)
 
-                # try:
-                coll_xdxr.insert_many(util_to_json_from_pandas(xdxr))
-                # except PyMongoError:
-                #     pass
+    print('\n==== SUCCESS SAVE STOCK_XDXR DATA! ====')
+    return errors == 0
 
-                # 判断更新的xdxr数据中是否有除权除息类型
-                if new_count > db_count:
-                    xdxr_new = xdxr.iloc[db_count - new_count:]
-                    if 1 not in xdxr_new['category'].to_list():
-                        continue
 
-                # 计算并更新复权系数
-                cursor = DATABASE.stock_day.find({'code': code}, {'_id': 0, 'date': 1, 'code': 1, 'close': 1})
-                data = pd.DataFrame([item for item in cursor])
-                if len(data) == 0:
-                    continue
-                data = data.set_index('date')
+def _save_code_xdxr(code, xdxr, coll_xdxr, coll_adj):
+    # 保存单只股票的除权除息数据，有新的除权除息记录时重新计算复权系数
+    new_count = len(xdxr)
+    db_count = coll_xdxr.count_documents({'code': code})
+    if new_count == db_count:
+        return
 
-                qfq = calc_qfq_cof(data, xdxr)  # 计算前复权系数
-                if qfq is None:
-                    print(f"\n复权系数均为1，忽略！{code}")
-                    continue
-                hfq = calc_hfq_cof(qfq, xdxr)  # 计算后复权系数
-                hfq = hfq.reset_index()
-                adjdata = util_to_json_from_pandas(hfq.loc[:, ['date', 'code', 'qfq', 'hfq']])
-                coll_adj.delete_many({'code': code})
-                coll_adj.insert_many(adjdata)
+    # 出现数据库记录数量比实时获取的数据多，则删除
+    coll_xdxr.delete_many({'code': code})
+    coll_xdxr.insert_many(util_to_json_from_pandas(xdxr))
 
-        except Exception as e:
-            print("\nError save_stock_xdxr exception!")
+    # 判断更新的xdxr数据中是否有除权除息类型
+    if new_count > db_count:
+        xdxr_new = xdxr.iloc[db_count - new_count:]
+        if 1 not in xdxr_new['category'].to_list():
+            return
 
-            print(e)
+    # 计算复权系数
+    cursor = DATABASE.stock_day.find({'code': code}, {'_id': 0, 'date': 1, 'code': 1, 'close': 1})
+    data = pd.DataFrame([item for item in cursor])
+    if len(data) == 0:
+        return
+    data = data.set_index('date').sort_index()
 
-    print('\n==== SUCCESS SAVE STOCK_XDXR DATA! ====')
+    qfq = calc_qfq_cof(data, xdxr)  # 计算前复权系数
+    if qfq is None:
+        print(f"\n复权系数均为1，忽略！{code}")
+        return
+    hfq = calc_hfq_cof(qfq, xdxr)  # 计算后复权系数
+    adj = hfq.reset_index().loc[:, ['date', 'code', 'qfq', 'hfq']]
+
+    # 只保存与数据库中不同的复权系数，删除数据库中多余的日期
+    old = pd.DataFrame([item for item in coll_adj.find({'code': code}, {'_id': 0, 'date': 1, 'qfq': 1, 'hfq': 1})])
+    if len(old) > 0:
+        merged = adj.merge(old, on='date', how='left', suffixes=('', '_old'))
+        same = np.isclose(merged['qfq'].to_numpy(dtype='float64'), merged['qfq_old'].to_numpy(dtype='float64')) & \
+            np.isclose(merged['hfq'].to_numpy(dtype='float64'), merged['hfq_old'].to_numpy(dtype='float64'))
+        stale = list(set(old['date']) - set(adj['date']))
+        if len(stale) > 0:
+            coll_adj.delete_many({'code': code, 'date': {'$in': stale}})
+        adj = adj[~same]
+    if len(adj) > 0:
+        coll_adj.bulk_write([ReplaceOne({'code': code, 'date': doc['date']}, doc, upsert=True)
+                             for doc in util_to_json_from_pandas(adj)], ordered=False)
+    adj_cache.invalidate(code)
+    bar_cache.invalidate(code)
 
 
 def save_security_block():
     """
     从通达信获取股票板块信息，并保存到数据库中
-    :return: None
+    :return: 全部保存成功返回True，出现错误返回False
     """
     try:
         table_name = 'stock_block'
@@ -307,10 +524,12 @@ def save_security_block():
         if data is not None:
             coll.insert_many(util_to_json_from_pandas(data))
         print(f'SUCCESS SAVE {table_name.upper()} ^_^')
+        return True
 
     except Exception as e:
         print(" Error save_security_info exception!")
         print(e)
+        return False
 
 
 ##########################################################################################################
@@ -329,81 +548,65 @@ def print_progress(item, total, start, code):
     print("\r{:^3.0f}%[{}->{}]{:.2f}s|{:.2f}s ({})".format(progress, finsh, need_do, dur, tt, code), end="")
 
 
-def calc_qfq_cof(bfq: pd.DataFrame, xdxr: pd.DataFrame) -> Optional[pd.DataFrame]:
+def _xdxr_ratio(bfq: pd.DataFrame, xdxr: pd.DataFrame):
     """
-    计算前复权系数
-    :param bfq: 被复权股票ochl数据
+    计算各除权除息事件的价格调整比例
+    :param bfq: 被复权股票ochl数据，行索引为按升序排列的日期
     :param xdxr: 股票对应的xdxr数据
-    :return: 在bfq数据后面增加一列 'adj' 保存对应的前复权系数，返回空表示复权系数均为1
+    :return: (pre, ratio), pre为各事件除权日之前最后一个交易日在bfq中的位置，ratio为复权后收盘价与原始收盘价之比；
+        没有除权除息事件时返回None
     """
     info = xdxr.query('category==1')
     info = info.loc[bfq.index[1]:bfq.index[-1]]  # 注意取index[1],复权系数的变化是除权日上一个交易日
+    if len(info) == 0:
+        return None
 
-    if len(info) > 0:
-        bfq['qfq'] = np.NAN
-        cof = 1
-        for i in range(len(info)-1, -1, -1):  # 前复权倒序
-            r = info.iloc[i]
-            _date = util_get_date_gap(info.index[i], -1)  #
-
-            try:
-                raw_close = bfq.loc[_date, 'close']  # 原始收盘价
-            except KeyError:
-                while _date not in bfq.index.to_list():
-                    _date = util_get_date_gap(_date, -1)
-                raw_close = bfq.loc[_date, 'close']
-
-            fq_close = (raw_close * 10 - r['fenhong'] + r['peigu'] * r['peigujia']) / \
-                       (10 + r['peigu'] + r['songzhuangu'])   # 复权后的收盘价
-            cof = cof * (fq_close / raw_close)  # 计算系数 累乘
-            bfq.loc[_date, 'qfq'] = cof
-
-        bfq['qfq'] = bfq['qfq'].fillna(method='bfill').fillna(1)
+    # 除权日之前最后一个有数据的交易日(处理停牌缺失数据情况)
+    pre = np.searchsorted(bfq.index.to_numpy(dtype=str), info.index.to_numpy(dtype=str), side='left') - 1
+    raw_close = bfq['close'].to_numpy(dtype='float64')[pre]  # 原始收盘价
+    fenhong, peigu, peigujia, songzhuangu = \
+        (info[col].to_numpy(dtype='float64') for col in ['fenhong', 'peigu', 'peigujia', 'songzhuangu'])
+    fq_close = (raw_close * 10 - fenhong + peigu * peigujia) / (10 + peigu + songzhuangu)  # 复权后的收盘价
+    return pre, fq_close / raw_close
 
-        return bfq
-    else:
 
+def calc_qfq_cof(bfq: pd.DataFrame, xdxr: pd.DataFrame) -> Optional[pd.DataFrame]:
+    """
+    计算前复权系数
+    :param bfq: 被复权股票ochl数据
+    :param xdxr: 股票对应的xdxr数据
+    :return: 在bfq数据后面增加一列 'qfq' 保存对应的前复权系数，返回空表示复权系数均为1
+    """
+    bfq = bfq.sort_index()
+    events = _xdxr_ratio(bfq, xdxr)
+    if events is None:
         return None    # 回复空表示不保存复权系数，
 
+    pre, ratio = events
+    cof = np.append(np.cumprod(ratio[::-1])[::-1], 1.0)  # 前复权倒序累乘，最后一次除权之后系数为1
+    # 每个交易日取其后(含当日)第一个除权前交易日的系数
+    bfq['qfq'] = cof[np.searchsorted(pre, np.arange(len(bfq)), side='left')]
+    return bfq
+
 
 def calc_hfq_cof(bfq: pd.DataFrame, xdxr: pd.DataFrame) -> Optional[pd.DataFrame]:
     """
     计算后复权系数
     :param bfq: 被复权股票ochl数据
     :param xdxr: 股票对应的xdxr数据
-    :return: 在bfq数据后面增加一列 'adj' 保存对应的后复权系数，返回空表示复权系数均为1
+    :return: 在bfq数据后面增加一列 'hfq' 保存对应的后复权系数，返回空表示复权系数均为1
     """
-
-    info = xdxr.query('category==1')
-    info = info.loc[bfq.index[1]:bfq.index[-1]]  # 注意取index[1],复权系数计算需用到前一天的收盘价
-
-    if len(info) > 0:
-        bfq['hfq'] = np.NAN
-        cof = 1
-        for i in range(len(info)):  # 前复权倒序
-            r = info.iloc[i]
-            xdxr_date = get_real_trade_date(info.index[i], towards=1)
-            _date = get_pre_trade_day(xdxr_date)
-
-            try:
-                pre_close = bfq.loc[_date, 'close']  # 前一天收盘价,处理停牌缺失数据情况
-            except KeyError:
-                while _date not in bfq.index.to_list():
-                    _date = get_pre_trade_day(_date)
-                pre_close = bfq.loc[_date, 'close']
-
-            fq_close = (pre_close * 10 - r['fenhong'] + r['peigu'] * r['peigujia']) / \
-                       (10 + r['peigu'] + r['songzhuangu'])   # 复权后的收盘价
-            cof = cof * (pre_close / fq_close)  # 计算系数 累乘
-            bfq.loc[xdxr_date, 'hfq'] = cof
-
-        bfq['hfq'] = bfq['hfq'].fillna(method='ffill').fillna(1)
-
-        return bfq
-    else:
-        # bfq['adj'] = 1.0
+    bfq = bfq.sort_index()
+    events = _xdxr_ratio(bfq, xdxr)
+    if events is None:
         return None    # 回复空表示不保存复权系数，
 
+    pre, ratio = events
+    cof = np.insert(np.cumprod(1 / ratio), 0, 1.0)  # 后复权正序累乘，第一次除权之前系数为1
+    # 除权日(含停牌后第一个交易日)起使用新的系数
+    bfq['hfq'] = cof[np.searchsorted(pre + 1, np.arange(len(bfq)), side='right')]
+    return bfq
+
 
 if __name__ == '__main__':
 
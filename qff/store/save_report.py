@@ -27,20 +27,26 @@
 """
 
 import hashlib
+import json
+import multiprocessing
 import os
 import requests
 import time
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pymongo import UpdateOne
 from pytdx.crawler.history_financial_crawler import HistoryFinancialCrawler
 from qff.tools.local import download_path
 from qff.tools.mongo import DATABASE
+from qff.tools.parquet import PARQUET_ENABLE, write_report_parquet
 from qff.tools.utils import util_to_json_from_pandas
 from qff.store.save_price import print_progress
 
-__all__ = ['save_report']
+__all__ = ['save_report', 'save_report_parquet']
 
 FINANCIAL_URL = 'http://down.tdx.com.cn:8001/tdxfin/gpcw.txt'
 DOWNLOAD_URL = 'http://down.tdx.com.cn:8001/tdxfin/'
+MANIFEST_FILE = '{}{}{}'.format(download_path, os.sep, 'report_manifest.json')
 
 
 # 计算文件的MD5值
@@ -99,11 +105,38 @@ def parse_to_df(filename):
     return df
 
 
-def save_report(update_all=False):
+def _parse_report(file_path):
+    # 进程池中解析财报文件，返回按code、report_date去重后的DataFrame
+    new_data = parse_to_df(file_path)
+    if new_data is None or len(new_data) < 1:
+        return None
+    return new_data.drop_duplicates(subset=['code', 'report_date'], keep='last')
+
+
+def _load_manifest():
+    # 已入库财报文件的MD5清单，文件未变化时不再解析和写入数据库
+    if os.path.exists(MANIFEST_FILE):
+        with open(MANIFEST_FILE, 'r') as f:
+            return json.load(f)
+    return {}
+
+
+def _save_manifest(manifest):
+    with open(MANIFEST_FILE, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+
+def save_report(update_all=False, workers=None, batch_size=1000):
     """
     从通达信网站爬取股票季报年报数据，数据清洗后保存至数据库中
-    :param update_all: 是否保存所有下载文件，True-只保存新下载的文件
-    :return: 无
+
+    财报文件在进程池中并行解析，解析结果以无序bulk_write批量更新数据库；已入库文件的MD5值记录在清单文件中，
+    文件内容未变化时直接跳过，不读取数据库。
+
+    :param update_all: 是否保存所有下载文件，True-保存所有下载文件，False-只保存新下载的文件
+    :param workers: 解析文件的进程数量，默认为CPU核数
+    :param batch_size: 每次批量写入数据库的记录数
+    :return: 全部保存成功返回True，出现错误返回False
     """
     file_list = download_report()
 
@@ -117,42 +150,75 @@ def save_report(update_all=False):
     if update_all:
         file_list = os.listdir(download_path)
 
-    start = time.perf_counter()
-    total = len(file_list)
-    for item in range(total):
-        file_name = file_list[item]
-        print_progress(item, total, start, file_name)
-
+    manifest = _load_manifest()
+    tasks = {}
+    for file_name in file_list:
         if file_name[0:4] != 'gpcw':
             continue
         file_path = '{}{}{}'.format(download_path, os.sep, file_name)
+        md5 = get_file_md5(file_path)
+        if manifest.get(file_name) != md5:
+            tasks[file_name] = md5
 
-        try:
-            new_data = parse_to_df(file_path)
-            if new_data is None or len(new_data) < 1:
-                continue
-            # 将公告日期列移动到第3列,由于df列数量太多，执行以下语句pandas报警效率低下，舍弃
-            # pub_date_col = new_data.pop('314')
-            # new_data.insert(2, 'pub_date', pub_date_col)
+    start = time.perf_counter()
+    total = len(tasks)
+    errors = 0
+    # 不使用fork方式，避免在update_all的多线程环境中复制其他线程持有的锁导致子进程死锁
+    methods = multiprocessing.get_all_start_methods()
+    mp = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp) as executor:
+        futures = {executor.submit(_parse_report, '{}{}{}'.format(download_path, os.sep, file_name)): file_name
+                   for file_name in tasks}
+        for item, future in enumerate(as_completed(futures)):
+            file_name = futures[future]
+            print_progress(item, total, start, file_name)
+            file_path = '{}{}{}'.format(download_path, os.sep, file_name)
+            try:
+                new_data = future.result()
+                if new_data is not None:
+                    data = util_to_json_from_pandas(new_data)
+                    for pos in range(0, len(data), batch_size):
+                        coll.bulk_write([UpdateOne({'code': d['code'], 'report_date': d['report_date']},
+                                                   {'$set': d}, upsert=True) for d in data[pos:pos + batch_size]],
+                                        ordered=False)
+                    if PARQUET_ENABLE:
+                        write_report_parquet(new_data)
+                manifest[file_name] = tasks[file_name]
+                _save_manifest(manifest)
+            except Exception as e:
+                errors += 1
+                print(f"DATA FILE {file_name} SAVE/UPDATE FAILED!")
+                print(e)
+                os.remove(file_path)
 
-            new_data = new_data.drop_duplicates(subset=['code', 'report_date'], keep='last')
+    print('SUCCESSFULLY SAVE/UPDATE FINANCIAL DATA')
+    return errors == 0
 
-            data = util_to_json_from_pandas(new_data)
-            try:
-                for d in data:
-                    coll.update_one({'code': d['code'], 'report_date': d['report_date']}, {'$set': d}, upsert=True)
 
+def save_report_parquet(workers=None):
+    """
+    解析已下载的全部财报文件，生成本地Parquet财报数据，用于初始化财报列式存储，不读写数据库
+    :param workers: 解析文件的进程数量，默认为CPU核数
+    :return: 无
+    """
+    file_list = [x for x in os.listdir(download_path) if x[0:4] == 'gpcw']
+    start = time.perf_counter()
+    total = len(file_list)
+    # 不使用fork方式，避免在update_all的多线程环境中复制其他线程持有的锁导致子进程死锁
+    methods = multiprocessing.get_all_start_methods()
+    mp = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp) as executor:
+        futures = {executor.submit(_parse_report, '{}{}{}'.format(download_path, os.sep, file_name)): file_name
+                   for file_name in file_list}
+        for item, future in enumerate(as_completed(futures)):
+            print_progress(item, total, start, futures[future])
+            try:
+                write_report_parquet(future.result())
             except Exception as e:
-                if isinstance(e, MemoryError):
-                    coll.insert_many(data, ordered=True)
-                else:
-                    raise e
-        except Exception as e:
-            print(f"DATA FILE {file_name} SAVE/UPDATE FAILED!")
-            print(e)
-            os.remove(file_path)
+                print(f"DATA FILE {futures[future]} EXPORT FAILED!")
+                print(e)
 
-    print('SUCCESSFULLY SAVE/UPDATE FINANCIAL DATA')
+    print('\nSUCCESSFULLY EXPORT FINANCIAL DATA TO PARQUET')
 
 
 if __name__ == '__main__':
@@ -22,12 +22,13 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import datetime
+import numpy as np
 import pandas as pd
 import pymongo
 import time
 from dateutil.relativedelta import relativedelta
 from qff.tools.mongo import DATABASE
-from qff.tools.date import get_next_trade_day, get_pre_trade_day, int_to_date
+from qff.tools.date import get_next_trade_day, get_pre_trade_day, int_to_date, date_to_int, trade_calendar
 from qff.price.finance import get_stock_reports
 from qff.tools.utils import util_to_json_from_pandas
 from qff.price.query import get_stock_list, get_security_info
@@ -100,6 +101,10 @@ def save_valuation_by_code(code, err):
         new_rows['f004'] = new_rows['f294']
         fin = pd.concat([fin, new_rows], ignore_index=True)
         fin = fin.sort_values('pub_date').reset_index(drop=True)
+        # 非交易日发布的财报顺延到下一交易日生效，否则按日期精确合并时会丢失
+        index = trade_calendar.ceil_array(fin['pub_date'].to_numpy())
+        valid = index < len(trade_calendar)
+        fin.loc[valid, 'pub_date'] = trade_calendar.array[index[valid]]
 
         fin['dyn'] = fin['f096'] * 12 / (fin['report_date'] % 2000 / 100).astype('int')
 
@@ -118,7 +123,7 @@ def save_valuation_by_code(code, err):
 
         kdf = kdf.merge(fin, left_on='date', right_on='pub_date', how='left')
         kdf = kdf.drop_duplicates(subset=['date'], keep='last')  # 修订：当年报和一季报同一天发布时，会产生两条记录
-        kdf.fillna(method='ffill', inplace=True)
+        kdf.ffill(inplace=True)
 
         # 以下为修订部分，考虑总股本和流通股本在财报中的严重滞后，修改为从除权信息库中获取
         ref3 = DATABASE.stock_xdxr.find(
@@ -146,7 +151,7 @@ def save_valuation_by_code(code, err):
                 xdxr.loc[first, 'date'] = kdf.date[0]
 
             kdf = kdf.merge(xdxr, left_on='date', right_on='date', how='left', suffixes=('', '_y'))
-            kdf.fillna(method='ffill', inplace=True)
+            kdf.ffill(inplace=True)
 
         # 开始计算
         kdf['quantity_ratio'] = round(kdf.vol / kdf.vol.rolling(5).mean().shift(1), 2)  # 计算量比
@@ -175,7 +180,112 @@ def save_valuation_by_code(code, err):
     return
 
 
-def save_valuation_data():
+_VAL_FIELDS = ['code', 'quantity_ratio', 'capitalization', 'circulating_cap', 'market_cap', 'cir_market_cap',
+               'turnover_ratio', 'pe_ttm', 'pe_lyr', 'pe_dyn', 'pb_ratio']
+
+
+def _int_dates(values):
+    # type: (np.ndarray) -> np.ndarray
+    """
+    将YYMMDD或YYYYMMDD格式的整数日期批量转换为'YYYY-MM-DD'格式字符串，与int_to_date一致
+    """
+    v = np.asarray(values, dtype='int64')
+    v = np.where(v < 1000000, np.where(v > 800000, 19000000 + v, 20000000 + v), v)
+    s = pd.Series(v).astype(str)
+    return (s.str[:4] + '-' + s.str[4:6] + '-' + s.str[6:8]).to_numpy()
+
+
+def _load_frame(coll, _filter, projection):
+    cursor = coll.find(_filter, dict(_id=0, **dict.fromkeys(projection, 1)), batch_size=10000)
+    return pd.DataFrame([item for item in cursor], columns=projection)
+
+
+def _build_valuation(codes, starts):
+    # type: (list, dict) -> pd.DataFrame
+    """
+    批量计算多只股票的估值数据，计算方法与save_valuation_by_code一致
+
+    :param codes: 股票代码列表
+    :param starts: 各股票估值数据的开始日期
+    :return: 各股票开始日期之后的估值数据，columns=['date'] + _VAL_FIELDS
+    """
+    start = min(starts.values())
+
+    # 1、日线数据，多读取开始日期前6个交易日的数据，用于计算量比
+    kdf = _load_frame(DATABASE.stock_day, {'code': {'$in': codes}, 'date': {'$gte': get_pre_trade_day(start, 6)}},
+                      ['code', 'date', 'close', 'vol'])
+    if len(kdf) == 0:
+        return kdf
+    kdf = kdf.sort_values(['code', 'date'], kind='mergesort').reset_index(drop=True)
+    kdf['key'] = pd.to_datetime(kdf['date'])  # merge_asof要求合并字段为数值或日期类型
+
+    # 2、财报数据，计算TTM、LYR及动态净利润
+    query_start = (datetime.datetime.strptime(start, '%Y-%m-%d') - relativedelta(months=14)).strftime('%Y-%m-%d')
+    fin = _load_frame(DATABASE.report, {'code': {'$in': codes}, 'f314': {'$gte': date_to_int(query_start[2:])}},
+                      ['code', 'report_date', 'f314', 'f232', 'f096', 'f004', 'f238', 'f239', 'f287', 'f294',
+                       'f315'])
+    fin = fin[fin['f314'] > 0].sort_values(['code', 'report_date'], kind='mergesort').reset_index(drop=True)
+    fin['pub_date'] = _int_dates(fin['f314'].to_numpy())
+    if len(fin) > 0:
+        fin['ttm'] = fin.groupby('code')['f232'].rolling(4).sum().reset_index(level=0, drop=True)
+    else:
+        fin['ttm'] = np.nan
+
+    # 如已公布当年业绩快报，则在快报发布日期和年报发布日期之间使用快报数据（同花顺）
+    new_rows = fin[fin['f315'] > 1].copy()
+    new_rows['report_date'] = new_rows['report_date'] // 10000 * 10000 + 1231
+    new_rows['pub_date'] = _int_dates(new_rows['f315'].to_numpy())
+    new_rows['f096'] = new_rows['f287']
+    new_rows['f004'] = new_rows['f294']
+    fin = pd.concat([fin, new_rows], ignore_index=True)
+    fin = fin.sort_values(['code', 'pub_date'], kind='mergesort').reset_index(drop=True)
+
+    fin['dyn'] = fin['f096'] * 12 / (fin['report_date'] % 2000 // 100)
+    fin['lyr'] = fin['f096'].where(fin['report_date'] % 2000 == 1231)
+    fields = ['f004', 'f238', 'f239', 'ttm', 'lyr', 'dyn']
+    fin[fields] = fin.groupby('code')[fields].ffill()
+    fin['key'] = pd.to_datetime(fin['pub_date'], errors='coerce')
+    fin = fin.dropna(subset=['key'])
+
+    # 每个交易日匹配已发布的最新财报
+    kdf = pd.merge_asof(kdf.sort_values('key', kind='mergesort'),
+                        fin[['code', 'key'] + fields].sort_values('key', kind='mergesort'),
+                        on='key', by='code', direction='backward')
+
+    # 3、总股本和流通股本在财报中严重滞后，有除权信息的股票从除权信息库中获取
+    xdxr = _load_frame(DATABASE.stock_xdxr, {'code': {'$in': codes}, 'category': {'$in': [2, 3, 5, 7, 8, 9, 10]}},
+                       ['code', 'date', 'shares_after', 'liquidity_after'])
+    if len(xdxr) > 0:
+        xdxr = xdxr.sort_values(['code', 'date'], kind='mergesort').reset_index(drop=True)
+        xdxr[['shares_after', 'liquidity_after']] = \
+            xdxr.groupby('code')[['shares_after', 'liquidity_after']].ffill()
+        xdxr['key'] = pd.to_datetime(xdxr['date'], errors='coerce')
+        xdxr = xdxr.dropna(subset=['key'])
+        kdf = pd.merge_asof(kdf, xdxr[['code', 'key', 'shares_after', 'liquidity_after']]
+                            .sort_values('key', kind='mergesort'), on='key', by='code', direction='backward')
+        has_xdxr = kdf['code'].isin(set(xdxr['code']))
+        kdf['f238'] = kdf['shares_after'].where(has_xdxr, kdf['f238'])
+        kdf['f239'] = kdf['liquidity_after'].where(has_xdxr, kdf['f239'])
+
+    # 4、开始计算
+    kdf = kdf.sort_values(['code', 'date'], kind='mergesort').reset_index(drop=True)
+    vol_ma = kdf.groupby('code')['vol'].rolling(5).mean().reset_index(level=0, drop=True)
+    kdf['quantity_ratio'] = round(kdf.vol / vol_ma.groupby(kdf['code']).shift(1), 2)  # 计算量比
+    kdf['capitalization'] = kdf['f238']     # 总股本(万股)
+    kdf['circulating_cap'] = kdf['f239']    # 流通股本(万股)
+    kdf['market_cap'] = round(kdf['f238'] * kdf['close'] * 10000 / 1.0e+8, 2)  # 总市值(亿元)
+    kdf['cir_market_cap'] = round(kdf['f239'] * kdf['close'] * 10000 / 1.0e+8, 2)  # 流通市值(亿元)
+    kdf['turnover_ratio'] = round(kdf['vol'] * 100 / (kdf['f239'] * 10000), 4)  # 换手率(%)
+    kdf['pe_ttm'] = round(kdf['f238'] * kdf['close'] * 10000 / kdf['ttm'], 2)  # 市盈率(PE, TTM)
+    kdf['pe_lyr'] = round(kdf['f238'] * kdf['close'] * 10000 / kdf['lyr'], 2)  # 市盈率(PE)s
+    kdf['pe_dyn'] = round(kdf['f238'] * kdf['close'] * 10000 / kdf['dyn'], 2)  # 市盈率（动态）
+    kdf['pb_ratio'] = round(kdf['close'] / kdf['f004'], 3)  # 市净率(PB)
+
+    kdf = kdf[kdf['date'] >= kdf['code'].map(starts)]
+    return kdf[['date'] + _VAL_FIELDS].replace([np.inf, -np.inf], np.nan)
+
+
+def save_valuation_data(append=True, chunk_size=200, batch_size=50000):
     """
     根据stock_day和report数据集，生成市值数据集valuation，并自动补全前期数据
     valuation字段如下：
@@ -191,7 +301,14 @@ def save_valuation_data():
                 pe_ratio 市盈率(PE, TTM)
                 pe_ratio_lyr 市盈率(PE)s
                 pb_ratio 市净率(PB)
-    :return: None
+
+    股票按开始日期排序后分组，每组chunk_size只股票的日线、财报及除权数据各通过一次查询批量读取，以分组向量化方式
+    计算估值指标，结果以batch_size条为一批写入数据库。
+
+    :param append: True表示从各股票已保存估值数据的下一个交易日开始追加，False表示删除已有数据后全部重新计算
+    :param chunk_size: 每组计算的股票数量
+    :param batch_size: 每次批量写入数据库的记录数
+    :return: 全部保存成功返回True，出现错误返回False
     """
     print('==== NOW SAVE VALUATION DATA =====')
     stock_list = get_stock_list()
@@ -205,19 +322,38 @@ def save_valuation_data():
     coll.create_index("date")
     err = []
 
+    last = {}
+    if append:
+        # 按(code, date)索引逆序排序后分组取第一条，使用索引逐个股票跳跃扫描，不扫描全部记录
+        pipeline = [{'$sort': {'code': -1, 'date': -1}},
+                    {'$group': {'_id': '$code', 'last': {'$first': '$date'}}}]
+        last = {doc['_id']: doc['last'] for doc in coll.aggregate(pipeline, allowDiskUse=True)}
+    starts = {code: get_next_trade_day(last[code], 1) if code in last else '2005-01-04' for code in stock_list}
+    stock_list = sorted(stock_list, key=lambda x: starts[x])
+
     start = time.perf_counter()
     total = len(stock_list)
-    for item in range(total):
-        code = stock_list[item]
-        print_progress(item, total, start, code)
-
-        save_valuation_by_code(code, err)
+    rows = 0
+    for item in range(0, total, chunk_size):
+        codes = stock_list[item:item + chunk_size]
+        print_progress(item, total, start, codes[-1])
+        try:
+            data = _build_valuation(codes, {code: starts[code] for code in codes})
+            if not append:
+                coll.delete_many({'code': {'$in': codes}})
+            docs = util_to_json_from_pandas(data)
+            for pos in range(0, len(docs), batch_size):
+                coll.insert_many(docs[pos:pos + batch_size], ordered=False)
+            rows += len(docs)
+        except Exception as e:
+            print(e)
+            err.extend(codes)
 
-    print('\n==== FINISH SAVE VALUATION DATA! ====')
+    print(f'\n==== FINISH SAVE VALUATION DATA! {rows} rows, {time.perf_counter() - start:.1f}s ====')
     if len(err) > 0:
         print('\n ERROR CODE:')
         print(err)
-    return
+    return len(err) == 0
 
 
 if __name__ == '__main__':
@@ -31,19 +31,130 @@
 from qff.store.save_info import save_stock_list, init_index_list, init_etf_list, \
     init_stock_list, save_index_stock, save_industry_stock, init_stock_name
 from qff.store.save_price import save_security_day, save_security_min, save_stock_xdxr, \
-    save_security_block
-from qff.store.save_report import save_report
+    save_security_block, save_security_parquet, save_security_resample
+from qff.store.save_report import save_report, save_report_parquet
 from qff.store.save_valuation import save_valuation_data
 from qff.store.save_mtss import save_mtss_data
 from qff.tools.mongo import DATABASE
 from qff.tools.date import is_trade_day
 from qff.tools.logs import log
+from qff.tools.local import log_path
 import prettytable as pt
+import os
+import json
 import datetime
 import pandas as pd
-
-
-def update_all(date=None):
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List
+
+
+def save_security_min_all(market='stock', security=None):
+    # 只从通达信下载1分钟数据，5/15/30/60分钟数据由1分钟数据合成，出现错误时返回False
+    ok = save_security_min(market=market, freq='1min', security=security)
+    for freq_ in ["5min", "15min", "30min", "60min"]:
+        ok = save_security_resample(market=market, freq=freq_, security=security) and ok
+    return ok
+
+
+class UpdateTask:
+    """
+    数据更新任务，deps为必须先完成的任务名称列表
+
+    数据保存函数自行捕获并打印异常，出现错误时返回False，此时run抛出异常，使任务记录为失败
+    """
+
+    def __init__(self, name, func, deps=None, **kwargs):
+        self.name = name
+        self.func = func
+        self.deps = deps or []
+        self.kwargs = kwargs
+
+    def run(self):
+        if self.func(**self.kwargs) is False:
+            raise RuntimeError(f'{self.func.__name__}保存数据出现错误，详见运行日志')
+
+
+def _update_tasks():
+    # type: () -> List[UpdateTask]
+    # 数据更新任务依赖关系：估值数据需要日线、财报及股本数据，复权系数需要日线及除权除息数据
+    return [
+        UpdateTask('stock_list', save_stock_list),
+        UpdateTask('stock_day', save_security_day, ['stock_list'], market='stock'),
+        UpdateTask('index_day', save_security_day, ['stock_list'], market='index'),
+        UpdateTask('etf_day', save_security_day, ['stock_list'], market='etf'),
+        UpdateTask('stock_min', save_security_min_all, ['stock_list'], market='stock'),
+        UpdateTask('index_min', save_security_min_all, ['stock_list'], market='index'),
+        UpdateTask('etf_min', save_security_min_all, ['stock_list'], market='etf'),
+        UpdateTask('stock_xdxr', save_stock_xdxr, ['stock_day']),
+        UpdateTask('report', save_report),
+        UpdateTask('valuation', save_valuation_data, ['stock_day', 'stock_xdxr', 'report']),
+        UpdateTask('mtss', save_mtss_data, ['stock_list']),
+        UpdateTask('stock_block', save_security_block),
+    ]
+
+
+def run_update_tasks(tasks, checkpoint, workers=4):
+    # type: (List[UpdateTask], str, int) -> dict
+    """
+    按依赖关系并发执行数据更新任务，依赖任务全部完成后才开始执行，相互独立的任务在线程池中同时执行。
+
+    每个任务完成后，将任务状态及开始、结束时间和耗时写入检查点文件(JSON格式)，同时作为运行日志；
+    任务抛出异常或数据保存函数返回False时记录为失败，再次运行时跳过检查点文件中已完成的任务，失败任务及依赖它的任务重新执行。
+
+    :param tasks: 任务列表
+    :param checkpoint: 检查点文件路径
+    :param workers: 同时执行的任务数量
+    :return: 各任务状态字典
+    """
+    state = {}
+    if os.path.exists(checkpoint):
+        with open(checkpoint, 'r', encoding='utf-8') as f:
+            state = {k: v for k, v in json.load(f).items() if v.get('status') == 'done'}
+        if len(state) > 0:
+            log.info(f"从检查点恢复，跳过已完成任务：{list(state.keys())}")
+
+    def _save():
+        with open(checkpoint, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False, indent=2)
+
+    pending = [task for task in tasks if task.name not in state]
+    running = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            for task in list(pending):
+                status = [state.get(dep, {}).get('status') for dep in task.deps]
+                if any(x in ['failed', 'skipped'] for x in status):
+                    state[task.name] = {'status': 'skipped'}
+                    pending.remove(task)
+                    log.warning(f"数据更新任务{task.name}因依赖任务未完成而跳过！")
+                elif all(x == 'done' for x in status):
+                    state[task.name] = {'status': 'running', 'start': str(datetime.datetime.now())[:19]}
+                    running[executor.submit(task.run)] = task
+                    pending.remove(task)
+                    log.info(f"数据更新任务{task.name}开始执行")
+            _save()
+            if len(running) == 0:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                item = state[task.name]
+                item['end'] = str(datetime.datetime.now())[:19]
+                item['seconds'] = round((pd.Timestamp(item['end']) - pd.Timestamp(item['start'])).total_seconds())
+                try:
+                    future.result()
+                    item['status'] = 'done'
+                    log.info(f"数据更新任务{task.name}完成，耗时{item['seconds']}秒")
+                except Exception as e:
+                    item['status'] = 'failed'
+                    item['error'] = str(e)
+                    log.error(f"数据更新任务{task.name}执行失败！{e}")
+            _save()
+    return state
+
+
+def update_all(date=None, workers=4):
     if date is None:
         date = str(datetime.date.today())
     log.info(f'====更新数据日期:{date} ==========')
@@ -57,19 +168,15 @@ def update_all(date=None):
     if 'etf_list' not in colls:
         init_etf_list()
 
-    save_stock_list()
-    for market_ in ['stock', 'index', 'etf']:
-        save_security_day(market_)
-        for freq_ in ["1min", "5min", "15min", "30min", "60min"]:
-            save_security_min(market=market_, freq=freq_)
+    checkpoint = os.path.join(log_path, f'update_{date}.json')
+    state = run_update_tasks(_update_tasks(), checkpoint, workers)
 
-    save_stock_xdxr()
-    save_report()
-    save_valuation_data()
-    save_mtss_data()
+    tb = pt.PrettyTable(['任务', '状态', '开始时间', '耗时(秒)'])
+    for name, item in state.items():
+        tb.add_row([name, item.get('status'), item.get('start', ''), item.get('seconds', '')])
+    print(tb)
     # save_index_stock()
     # save_industry_stock()
-    save_security_block()
 
     log.info('==== 更新数据完成 ==========')
 
@@ -78,8 +185,7 @@ def init_delist_date():
     from qff.price.query import get_all_securities
     stock_list = get_all_securities('delist')
     save_security_day('stock', stock_list)
-    for freq_ in ["1min", "5min", "15min", "30min", "60min"]:
-        save_security_min(market='stock', freq=freq_, security=stock_list)
+    save_security_min_all('stock', stock_list)
 
     save_stock_xdxr(stock_list)
 
@@ -151,8 +257,7 @@ def qff_save(*args):
 
     elif args[0] == 'min':
         for market_ in ['stock', 'index', 'etf']:
-            for freq_ in ["1min", "5min", "15min", "30min", "60min"]:
-                save_security_min(market=market_, freq=freq_)
+            save_security_min_all(market_)
 
     elif args[0] == 'stock_list':
         save_stock_list()
@@ -161,8 +266,7 @@ def qff_save(*args):
         save_security_day(str(args[0]).split('_')[0])
 
     elif args[0] in ['stock_min', 'index_min', 'etf_min']:
-        for freq_ in ["1min", "5min", "15min", "30min", "60min"]:
-            save_security_min(market=str(args[0]).split('_')[0], freq=freq_)
+        save_security_min_all(str(args[0]).split('_')[0])
 
     elif args[0] == 'stock_xdxr':
         save_stock_xdxr()
@@ -190,6 +294,12 @@ def qff_save(*args):
         init_index_list()
         init_etf_list()
 
+    elif args[0] == 'parquet':
+        for market_ in ['stock', 'index', 'etf']:
+            for freq_ in ["day", "1min", "5min", "15min", "30min", "60min"]:
+                save_security_parquet(market=market_, freq=freq_)
+        save_report_parquet()
+
     elif args[0] == 'init_name':
         init_stock_name()
     elif args[0] == 'save_delist':
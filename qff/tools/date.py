@@ -24,9 +24,11 @@
 
 
 from datetime import datetime, timedelta
-from functools import wraps
+from functools import wraps, lru_cache
 import time
 import math
+import bisect
+import numpy as np
 import pandas as pd
 from typing import Optional, Callable
 
@@ -613,6 +615,80 @@ trade_date_sse = pd.bdate_range(start="1990-12-19",
                                 ).strftime("%Y-%m-%d").tolist()
 
 
+class TradeCalendar:
+    """
+    交易日历索引，提供交易日期与序号之间的相互转换
+
+    * 日期→序号通过字典查找，时间复杂度O(1)
+    * 序号→日期通过列表(或NumPy数组)下标访问
+    * 非交易日通过二分查找定位到前后最近的交易日，支持对日期数组进行批量查找
+    """
+
+    def __init__(self, days):
+        # type: (list) -> None
+        self.days = days
+        self.array = np.array(days)
+        self._ordinal = {day: i for i, day in enumerate(days)}
+
+    def __len__(self):
+        return len(self.days)
+
+    def __contains__(self, date):
+        return date in self._ordinal
+
+    def index(self, date):
+        # type: (str) -> int
+        """
+        返回交易日的序号，非交易日抛出ValueError异常
+        """
+        try:
+            return self._ordinal[date]
+        except KeyError:
+            raise ValueError("{} is not a trade day".format(date))
+
+    def floor(self, date):
+        # type: (str) -> int
+        """
+        返回小于等于date的最近一个交易日序号，早于第一个交易日时返回-1
+        """
+        i = self._ordinal.get(date)
+        return i if i is not None else bisect.bisect_right(self.days, date) - 1
+
+    def ceil(self, date):
+        # type: (str) -> int
+        """
+        返回大于等于date的最近一个交易日序号，晚于最后一个交易日时返回len(self)
+        """
+        i = self._ordinal.get(date)
+        return i if i is not None else bisect.bisect_left(self.days, date)
+
+    def floor_array(self, dates):
+        # type: (np.ndarray) -> np.ndarray
+        """
+        批量返回日期数组中每个日期小于等于该日期的最近交易日序号，日期可以是'YYYY-MM-DD'或'YYYY-MM-DD HH:MM:SS'格式
+        """
+        return np.searchsorted(self.array, np.asarray(dates, dtype=str).astype('U10'), side='right') - 1
+
+    def ceil_array(self, dates):
+        # type: (np.ndarray) -> np.ndarray
+        """
+        批量返回日期数组中每个日期大于等于该日期的最近交易日序号
+        """
+        return np.searchsorted(self.array, np.asarray(dates, dtype=str).astype('U10'), side='left')
+
+    def is_trade_day_array(self, dates):
+        # type: (np.ndarray) -> np.ndarray
+        """
+        批量判断日期数组中的日期是否为交易日
+        """
+        dates = np.asarray(dates, dtype=str).astype('U10')
+        i = np.clip(np.searchsorted(self.array, dates, side='left'), 0, len(self.array) - 1)
+        return self.array[i] == dates
+
+
+trade_calendar = TradeCalendar(trade_date_sse)
+
+
 def get_real_trade_date(date, towards=-1):
     """
     根据给定日期，获取真实的交易日期
@@ -625,25 +701,11 @@ def get_real_trade_date(date, towards=-1):
     """
     day = str(date)[0:10]
     if towards == 1:
-        if pd.to_datetime(day) >= pd.to_datetime(trade_date_sse[-1]):
-            return trade_date_sse[-1]
-        while day not in trade_date_sse:
-            day = str(
-                datetime.strptime(day, "%Y-%m-%d")
-                + timedelta(days=1)
-            )[0:10]
-        else:
-            return str(day)[0:10]
+        i = trade_calendar.ceil(day)
+        return trade_date_sse[min(i, len(trade_date_sse) - 1)]
     elif towards == -1:
-        if pd.to_datetime(day) <= pd.to_datetime(trade_date_sse[0]):
-            return trade_date_sse[0]
-        while day not in trade_date_sse:
-            day = str(
-                datetime.strptime(day, "%Y-%m-%d")
-                - timedelta(days=1)
-            )[0:10]
-        else:
-            return str(day)[0:10]
+        i = trade_calendar.floor(day)
+        return trade_date_sse[max(i, 0)]
 
 
 def is_trade_day(date: str) -> bool:
@@ -654,10 +716,7 @@ def is_trade_day(date: str) -> bool:
 
     :return: True：是交易日期
     """
-    if date in trade_date_sse:
-        return True
-    else:
-        return False
+    return date in trade_calendar
 
 
 def get_date_gap(date: str, gap: int, methods: str) -> Optional[str]:
@@ -674,17 +733,17 @@ def get_date_gap(date: str, gap: int, methods: str) -> Optional[str]:
 
     try:
         if methods in [">", "gt"]:
-            index = trade_date_sse.index(date) + gap
+            index = trade_calendar.index(date) + gap
             return trade_date_sse[index] if index < len(trade_date_sse) else trade_date_sse[-1]
         elif methods in [">=", "gte"]:
-            index = trade_date_sse.index(date) + gap - 1
+            index = trade_calendar.index(date) + gap - 1
             return trade_date_sse[index] if index < len(trade_date_sse) else trade_date_sse[-1]
         elif methods in ["<", "lt"]:
-            index = trade_date_sse.index(date) - gap
+            index = trade_calendar.index(date) - gap
             return trade_date_sse[index] if index > 0 else trade_date_sse[0]
 
         elif methods in ["<=", "lte"]:
-            index = trade_date_sse.index(date) - gap + 1
+            index = trade_calendar.index(date) - gap + 1
             return trade_date_sse[index] if index > 0 else trade_date_sse[0]
         elif methods in ["==", "=", "eq"]:
             return date
@@ -770,9 +829,7 @@ def get_trade_days(start: str, end: str) -> Optional[list]:
     if real_start > real_end:
         return None
     else:
-        return trade_date_sse[
-               trade_date_sse.index(real_start): trade_date_sse.index(real_end) + 1: 1
-               ]
+        return trade_date_sse[trade_calendar.index(real_start): trade_calendar.index(real_end) + 1]
 
 
 def get_trade_gap(start: str, end: str) -> int:
@@ -789,11 +846,49 @@ def get_trade_gap(start: str, end: str) -> int:
     real_end = get_real_trade_date(end, -1)
 
     if real_start is not None:
-        return trade_date_sse.index(real_end) + 1 - trade_date_sse.index(real_start)
+        return trade_calendar.index(real_end) + 1 - trade_calendar.index(real_start)
     else:
         return 0
 
 
+_trade_min_grid = {}  # 各周期的日内分钟网格，key为周期(分钟)，value为距零点的分钟偏移量数组
+
+
+def get_trade_min_offsets(period=1):
+    # type: (int) -> np.ndarray
+    """
+    获取交易日内分钟网格相对零点的分钟偏移量，各周期只计算一次
+
+    :param period: 间隔时间（分钟）
+    :return: np.ndarray, 如1分钟周期为[570, 571, ..., 690, 781, ..., 900]
+    """
+    grid = _trade_min_grid.get(period)
+    if grid is None:
+        offsets = []
+        t = 9 * 60 + 30
+        while t <= 15 * 60:
+            offsets.append(t)
+            t += period
+            if 11 * 60 + 30 < t < 13 * 60:
+                t = 13 * 60 + period
+        grid = np.array(offsets, dtype='int32')
+        grid.flags.writeable = False
+        _trade_min_grid[period] = grid
+    return grid
+
+
+@lru_cache(maxsize=32)
+def _trade_min_suffix(period):
+    # type: (int) -> np.ndarray
+    return np.array([' {:02d}:{:02d}:00'.format(t // 60, t % 60) for t in get_trade_min_offsets(period)])
+
+
+@lru_cache(maxsize=256)
+def _trade_min_tuple(day, period):
+    # type: (str, int) -> tuple
+    return tuple(np.char.add(day, _trade_min_suffix(period)).tolist())
+
+
 def get_trade_min_list(day, period=1):
     """
      获取交易日的分钟列表
@@ -801,17 +896,7 @@ def get_trade_min_list(day, period=1):
     :param period: 间隔时间（分钟）
     :return: list
     """
-    min_list = []
-    dt = day + " 09:30:00"
-    while dt <= day + " 15:00:00":
-        min_list.append(dt)
-        dt = (datetime.strptime(dt, "%Y-%m-%d %H:%M:%S")
-              + timedelta(minutes=period)).strftime("%Y-%m-%d %H:%M:%S")
-        if day + " 11:30:00" < dt < day + " 13:00:00":
-            dt = day + " 13:00:00"
-            dt = (datetime.strptime(dt, "%Y-%m-%d %H:%M:%S")
-                  + timedelta(minutes=period)).strftime("%Y-%m-%d %H:%M:%S")
-    return min_list
+    return list(_trade_min_tuple(day, period))
 
 
 def util_date_valid(date):
@@ -28,6 +28,8 @@ import os
 2. cache_path ==> 用于存放临时文件
 3. log_path ==> 用于存放储存的log
 4. output_path ==> 用于存放输出的文件
+5. parquet_path ==> 用于存放本地列式行情数据
+6. shared_path ==> 用于存放多进程共享的内存映射行情数据
 """
 
 base_path = os.path.expanduser('~')
@@ -51,6 +53,8 @@ output_path = generate_path('output')
 back_test_path = generate_path('back_test', output_path)
 sim_trade_path = generate_path('sim_trade', output_path)
 evaluation_path = generate_path('evaluation', output_path)
+parquet_path = generate_path('parquet')
+shared_path = generate_path('shared')
 
 make_dir(qff_path, exist_ok=True)
 make_dir(setting_path, exist_ok=True)
@@ -62,3 +66,5 @@ make_dir(output_path, exist_ok=True)
 make_dir(back_test_path, exist_ok=True)
 make_dir(sim_trade_path, exist_ok=True)
 make_dir(evaluation_path, exist_ok=True)
+make_dir(parquet_path, exist_ok=True)
+make_dir(shared_path, exist_ok=True)
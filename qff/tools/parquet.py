@@ -0,0 +1,337 @@
+# coding :utf-8
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016-2019 XuHaiJiang/QFF
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+本地列式(Parquet)行情数据存储
+
+行情数据按 market_freq/code/year.parquet 分区保存在 parquet_path 目录下，作为MongoDB之外的可选行情数据后端：
+
+1. 配置项 [PARQUET] enable = true 时，save_security_day/save_security_min 在写入MongoDB的同时写入本地文件；
+2. 配置项 [PRICE] backend = parquet 时，get_price 通过内存映射、按列投影的方式读取本地文件。
+
+文件中保存的字段与MongoDB中的记录一致(不含_id和type)，读取结果可直接替代数据库查询结果。
+
+财报数据按报告期保存在 parquet_path/report/<report_date>.parquet 文件中：
+
+1. 配置项 [PARQUET] enable = true 时，save_report 在写入MongoDB的同时写入本地文件；
+2. 配置项 [REPORT] backend = parquet 时，财务数据查询函数只读取查询条件和返回结果所需的字段列。
+
+pyarrow 在读写本地文件时才导入，只使用MongoDB后端时无需安装。
+"""
+
+import os
+import pandas as pd
+from typing import Dict, List, Optional
+from qff.tools.local import parquet_path, make_dir
+from qff.tools.config import get_config
+
+__all__ = ['PARQUET_ENABLE', 'write_price_parquet', 'read_price_parquet', 'write_report_parquet',
+           'read_report_parquet']
+
+PARQUET_ENABLE = str(get_config('PARQUET', 'enable', 'false')).lower() == 'true'
+
+
+def _price_dir(market, freq, code):
+    return '{}{}{}_{}{}{}'.format(parquet_path, os.sep, market, freq, os.sep, code)
+
+
+def _price_file(market, freq, code, year):
+    return '{}{}{}.parquet'.format(_price_dir(market, freq, code), os.sep, year)
+
+
+def _price_parts(market, freq, code, year):
+    # 同一年份追加写入的增量文件，文件名为 year-序号.parquet，按写入顺序排列
+    path = _price_dir(market, freq, code)
+    if not os.path.exists(path):
+        return []
+    prefix = '{}-'.format(year)
+    parts = [x for x in os.listdir(path) if x.startswith(prefix) and x.endswith('.parquet')]
+    return ['{}{}{}'.format(path, os.sep, x) for x in sorted(parts, key=lambda x: int(x[len(prefix):-8]))]
+
+
+def _concat_tables(tables):
+    # 合并多个文件的数据，同一字段在不同文件中类型不一致(整数/浮点数)时统一转换为float64
+    import pyarrow as pa
+
+    if len(tables) == 1:
+        return tables[0]
+    names = tables[0].schema.names
+    types = {}
+    for table in tables:
+        for field in table.schema:
+            types.setdefault(field.name, set()).add(field.type)
+    schema = pa.schema([pa.field(name, next(iter(types[name])) if len(types[name]) == 1 else pa.float64())
+                        for name in names])
+    return pa.concat_tables([table.select(names).cast(schema) for table in tables])
+
+
+MAX_PRICE_PARTS = 16  # 增量文件数量达到该值时合并至年度文件
+
+
+def write_price_parquet(data, market='stock', freq='day'):
+    # type: (pd.DataFrame, str, str) -> int
+    """
+    将行情数据追加写入本地Parquet文件，同一标的同一年份的数据保存在一个年度文件及若干增量文件中，重复记录以新数据为准
+
+    每批数据写入一个新的增量文件，不重写已有文件；增量文件达到MAX_PRICE_PARTS个时合并至年度文件。
+    整数字段(如指数的up_count/down_count)保持整数类型，其他行情字段保存为float64。
+
+    :param data: 行情数据，包含code、date(分钟数据为datetime)及行情字段列
+    :param market: 市场类型，目前支持“stock/index/etf"
+    :param freq: 数据频率，支持day/1min/5min/15min/30min/60min
+
+    :return: 写入的记录数量
+    """
+    if data is None or len(data) == 0:
+        return 0
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    date_index = 'date' if freq == 'day' else 'datetime'
+    data = data.drop(columns=['_id', 'type'], errors='ignore')
+    data = data.assign(**{date_index: data[date_index].astype(str)})
+    value_cols = [col for col in data.columns if col not in ['code', date_index]]
+    data = data.astype({col: 'int64' if pd.api.types.is_integer_dtype(data[col]) else 'float64'
+                        for col in value_cols})
+
+    for (code, year), df in data.groupby(['code', data[date_index].str[:4]]):
+        make_dir(_price_dir(market, freq, code))
+        file_name = _price_file(market, freq, code, year)
+        table = pa.Table.from_pandas(df.sort_values(date_index), preserve_index=False)
+        parts = _price_parts(market, freq, code, year)
+        if not os.path.exists(file_name):
+            target = file_name
+        elif len(parts) + 1 < MAX_PRICE_PARTS:
+            number = int(os.path.basename(parts[-1])[len(year) + 1:-8]) + 1 if parts else 1
+            target = '{}{}{}-{}.parquet'.format(_price_dir(market, freq, code), os.sep, year, number)
+        else:
+            # 合并年度文件、增量文件及本批数据，重写年度文件后删除增量文件
+            tables = [pq.read_table(x) for x in [file_name] + parts] + [table]
+            df = _concat_tables(tables).to_pandas()
+            df = df.drop_duplicates(date_index, keep='last').sort_values(date_index)
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            target = file_name
+        tmp_file = target + '.tmp'
+        pq.write_table(table, tmp_file)
+        os.replace(tmp_file, target)
+        if target == file_name:
+            for part in parts:
+                os.remove(part)
+    return len(data)
+
+
+def read_price_parquet(code, start, end, freq='day', market='stock', columns=None):
+    # type: (List[str], str, str, str, str, Optional[List[str]]) -> pd.DataFrame
+    """
+    从本地Parquet文件中读取行情数据，返回结果与MongoDB查询结果生成的DataFrame格式一致
+
+    :param code: 标的代码列表
+    :param start: 开始日期(分钟数据为日期时间)，包含
+    :param end: 结束日期(分钟数据为日期时间)，包含
+    :param freq: 数据频率，支持day/1min/5min/15min/30min/60min
+    :param market: 市场类型，目前支持“stock/index/etf"
+    :param columns: 需读取的字段列表，需包含code和日期字段，None表示读取全部字段
+
+    :return: 行情数据DataFrame，无数据时返回空DataFrame
+    """
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    date_index = 'date' if freq == 'day' else 'datetime'
+    tables = []
+    has_parts = False
+    for _code in code:
+        for year in range(int(start[:4]), int(end[:4]) + 1):
+            file_name = _price_file(market, freq, _code, year)
+            if os.path.exists(file_name):
+                parts = _price_parts(market, freq, _code, year)
+                has_parts = has_parts or len(parts) > 0
+                for x in [file_name] + parts:
+                    tables.append(pq.read_table(x, columns=columns, memory_map=True))
+    if len(tables) == 0:
+        return pd.DataFrame()
+
+    table = _concat_tables(tables)
+    mask = pc.and_(pc.greater_equal(table[date_index], start), pc.less_equal(table[date_index], end))
+    data = table.filter(mask).to_pandas()
+    if has_parts:
+        # 增量文件中的记录可能与年度文件重复，以后写入的为准
+        data = data.drop_duplicates(['code', date_index], keep='last')
+        data = data.sort_values(['code', date_index], kind='mergesort').reset_index(drop=True)
+    return data
+
+
+def _report_dir():
+    return '{}{}report'.format(parquet_path, os.sep)
+
+
+def write_report_parquet(data):
+    # type: (pd.DataFrame) -> int
+    """
+    将财报数据写入本地Parquet文件，同一报告期的数据保存在一个文件中，重复记录以新数据为准
+
+    :param data: 财报数据，包含code、report_date及f001~fNNN字段列
+    :return: 写入的记录数量
+    """
+    if data is None or len(data) == 0:
+        return 0
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    data = data.drop(columns=['_id'], errors='ignore')
+    value_cols = [col for col in data.columns if col not in ['code', 'report_date']]
+    data = data.astype(dict(code=str, report_date='int64', **dict.fromkeys(value_cols, 'float64')))
+
+    make_dir(_report_dir())
+    for report_date, df in data.groupby('report_date'):
+        file_name = '{}{}{}.parquet'.format(_report_dir(), os.sep, report_date)
+        if os.path.exists(file_name):
+            old = pq.read_table(file_name).to_pandas()
+            df = pd.concat([old, df], sort=False).drop_duplicates('code', keep='last')
+        df = df.sort_values('code')
+        tmp_file = file_name + '.tmp'
+        pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp_file)
+        os.replace(tmp_file, file_name)
+    return len(data)
+
+
+_COMPARE = {'$eq': 'equal', '$ne': 'not_equal', '$gt': 'greater', '$gte': 'greater_equal',
+            '$lt': 'less', '$lte': 'less_equal'}
+
+
+def _report_mask(table, key, cond):
+    # 将MongoDB查询条件转换为pyarrow过滤条件，不支持的条件返回None
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    column = table[key]
+    if not isinstance(cond, dict):
+        return pc.equal(column, cond)
+    masks = []
+    for op, value in cond.items():
+        if op == '$ne':
+            masks.append(pc.fill_null(pc.not_equal(column, value), True))  # 与MongoDB一致，空值满足$ne条件
+        elif op in _COMPARE:
+            masks.append(getattr(pc, _COMPARE[op])(column, value))
+        elif op in ['$in', '$nin'] and isinstance(value, list):
+            mask = pc.is_in(column, value_set=pa.array(value, type=column.type))
+            masks.append(mask if op == '$in' else pc.invert(mask))
+        else:
+            return None
+    mask = masks[0]
+    for m in masks[1:]:
+        mask = pc.and_(mask, m)
+    return mask
+
+
+def _report_bound(cond, ops):
+    # 从查询条件中取出报告期(YYYYMMDD)的边界值
+    if not isinstance(cond, dict):
+        return cond
+    values = [v for op, v in cond.items() if op in ops]
+    return values[0] if len(values) > 0 else None
+
+
+def _pub_bound(cond, ops):
+    # 从f314(YYMMDD格式)查询条件中取出公告日期的边界值，转换为YYYYMMDD格式
+    value = _report_bound(cond, ops)
+    if value is None:
+        return None
+    value = int(value)
+    return value + (19000000 if value > 800000 else 20000000) if value < 1000000 else value
+
+
+def read_report_parquet(filter, projection=None):
+    # type: (Dict, Optional[Dict]) -> Optional[pd.DataFrame]
+    """
+    按MongoDB查询格式从本地Parquet文件中读取财报数据，只读取查询条件和projection中的字段列
+
+    支持字段等于、$eq、$ne、$gt、$gte、$lt、$lte、$in、$nin查询条件，其他查询条件(包括$or等顶层逻辑条件)、
+    $ne/$nin条件的字段在部分文件中不存在及没有本地文件时返回None，由调用者改为查询数据库。
+
+    根据report_date及f314条件跳过不需读取的报告期文件：财报公告日期不早于报告期，且一般在报告期结束后一年内公告，
+    因此只读取f314下限前一年至f314上限之间的报告期文件。
+
+    :param filter: 查询条件，同pymongo的find函数
+    :param projection: 返回字段，同pymongo的find函数，None或不包含为1的字段时返回全部字段
+    :return: 财报数据DataFrame，无匹配数据时返回空DataFrame
+    """
+    # $or/$and/$nor等顶层逻辑条件不支持，由调用者改为查询数据库
+    if any(str(key).startswith('$') for key in filter.keys()):
+        return None
+    path = _report_dir()
+    if not os.path.exists(path):
+        return None
+    files = sorted(int(x.split('.')[0]) for x in os.listdir(path) if x.endswith('.parquet'))
+    if len(files) == 0:
+        return None
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+
+    # 根据报告期范围筛选文件，财报公告日期(f314为YYMMDD格式)不早于报告期
+    low = _report_bound(filter.get('report_date'), ['$eq', '$gt', '$gte'])
+    high = _report_bound(filter.get('report_date'), ['$eq', '$lt', '$lte'])
+    pub_low = _pub_bound(filter.get('f314'), ['$eq', '$gt', '$gte'])
+    pub_high = _pub_bound(filter.get('f314'), ['$eq', '$lt', '$lte'])
+    if pub_low is not None:
+        low = pub_low - 10000 if low is None else max(low, pub_low - 10000)
+    if pub_high is not None:
+        high = pub_high if high is None else min(high, pub_high)
+    files = [x for x in files if (low is None or x >= low) and (high is None or x <= high)]
+
+    columns = None
+    if projection is not None:
+        columns = [key for key, value in projection.items() if value and key != '_id']
+    read_columns = None if not columns else list(dict.fromkeys(columns + list(filter.keys())))
+
+    frames = []
+    for report_date in files:
+        file_name = '{}{}{}.parquet'.format(path, os.sep, report_date)
+        schema = pq.read_schema(file_name)
+        missing = [key for key in filter.keys() if key not in schema.names]
+        if any(isinstance(filter[key], dict) and ('$ne' in filter[key] or '$nin' in filter[key]) for key in missing):
+            return None  # 不存在的字段满足$ne/$nin条件，由数据库查询
+        if len(missing) > 0:
+            continue
+        table = pq.read_table(file_name, memory_map=True,
+                              columns=None if read_columns is None else
+                              [col for col in read_columns if col in schema.names])
+        mask = None
+        for key, cond in filter.items():
+            m = _report_mask(table, key, cond)
+            if m is None:
+                return None
+            mask = m if mask is None else pc.and_(mask, m)
+        if mask is not None:
+            table = table.filter(mask)
+        if table.num_rows > 0:
+            df = table.to_pandas()
+            frames.append(df if columns is None else df[[col for col in columns if col in df.columns]])
+
+    if len(frames) == 0:
+        return pd.DataFrame()
+    data = pd.concat(frames, ignore_index=True, sort=False)
+    if 'report_date' in data.columns:
+        data['report_date'] = data['report_date'].astype('int64')
+    return data
@@ -26,6 +26,7 @@
 # 具体参见rainx的pytdx(https://github.com/rainx/pytdx)
 
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 from pytdx.hq import TdxHq_API
 from qff.tools.config import get_config, set_config
 from qff.tools.logs import log
@@ -157,6 +158,21 @@ def get_best_ip():
     return ip, port
 
 
+def get_best_ip_list(count=4):
+    """
+    并发测速所有行情服务器，返回响应最快的count个可用服务器，供通达信连接池使用
+    :param count: 返回的服务器数量
+    :return: List[dict], 按响应时间排序的服务器列表，每项包含ip、port
+    """
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        delays = list(executor.map(lambda x: ping(x['ip'], x['port']), stock_ip_list))
+    ranked = sorted([(dt, x) for dt, x in zip(delays, stock_ip_list) if dt < timedelta(0, 9, 0)],
+                    key=lambda item: item[0])
+    if len(ranked) == 0:
+        log.warning('ALL IP PING TIMEOUT!')
+    return [{'ip': x['ip'], 'port': x['port']} for _, x in ranked[:count]]
+
+
 stock_ip_list = [
     # added 20190222 from tdx
     {"ip": "106.120.74.86", "port": 7711, "name": "北京行情主站1"},
@@ -0,0 +1,282 @@
+# coding :utf-8
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016-2019 XuHaiJiang/QFF
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+通达信行情服务器连接池
+
+数据下载时每次请求都重新测速、建立连接的开销远大于数据传输本身。本模块维护size个持久的pytdx连接，
+连接分布在测速排名靠前的多个服务器上：
+
+1. 取出连接时，空闲超过health_interval秒的连接先进行心跳检查，检查失败则重新连接；
+2. 请求执行异常时丢弃该连接，将对应服务器降级至列表末尾，改连其他服务器后重试(故障切换)；
+3. imap函数以线程池方式并发执行批量请求，供save_*系列数据保存函数使用。
+
+连接对象通过api_factory创建，测试时可传入模拟pytdx接口的对象或连接本地桩服务器。
+"""
+
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+from pytdx.hq import TdxHq_API
+from qff.tools.config import get_config
+from qff.tools.logs import log
+from qff.tools.tdx import get_best_ip_list
+
+__all__ = ['TdxPool', 'get_tdx_pool']
+
+
+class TdxPool:
+    """
+    通达信持久连接池
+
+    ================== =====================  =======================================================================
+        属性            类型                      说明
+    ================== =====================  =======================================================================
+    size               int                      连接数量，同时也是imap的并发线程数
+    servers            List[dict]               按优先级排序的服务器列表，每项包含ip、port
+    retries            int                      单个请求失败后切换连接重试的次数
+    health_interval    float                    连接空闲超过该秒数时，取出前进行心跳检查
+    failovers          int                      发生故障切换的次数
+    ================== =====================  =======================================================================
+
+    """
+
+    def __init__(self, size=4, servers=None, api_factory=None, retries=2, health_interval=30.0):
+        # type: (int, Optional[List[dict]], Optional[Callable], int, float) -> None
+        self.size = size
+        self.servers = list(servers) if servers else get_best_ip_list(size)
+        if len(self.servers) == 0:
+            raise ConnectionError('TdxPool: 没有可用的通达信行情服务器！')
+        self.retries = retries
+        self.health_interval = health_interval
+        self.failovers = 0
+        # pytdx默认在网络错误时返回None，需设置raise_exception才能触发故障切换
+        self._api_factory = api_factory if api_factory is not None else \
+            (lambda: TdxHq_API(heartbeat=True, auto_retry=True, raise_exception=True))
+        self._idle = queue.Queue()  # 空闲连接，元素为(api, server, 最后使用时间)
+        self._lock = threading.Lock()
+        self._next = 0
+        self._created = 0
+        self._closed = False
+
+    def _connect(self):
+        # 从下一个服务器开始依次尝试连接，所有服务器均失败时抛出异常
+        with self._lock:
+            servers = list(self.servers)
+            start = self._next
+            self._next = (self._next + 1) % len(servers)
+        for i in range(len(servers)):
+            server = servers[(start + i) % len(servers)]
+            api = self._api_factory()
+            try:
+                if api.connect(server['ip'], server['port']):
+                    return api, server
+            except Exception as e:
+                log.warning(f"TdxPool: 连接服务器{server['ip']}:{server['port']}失败！{e}")
+            self._demote(server)
+        raise ConnectionError('TdxPool: 所有通达信行情服务器均无法连接！')
+
+    def _demote(self, server):
+        # 将故障服务器降级至列表末尾
+        with self._lock:
+            if server in self.servers and len(self.servers) > 1:
+                self.servers.remove(server)
+                self.servers.append(server)
+                self.failovers += 1
+
+    @staticmethod
+    def _healthy(api):
+        try:
+            return api.get_security_count(0) is not None
+        except Exception:
+            return False
+
+    @staticmethod
+    def _disconnect(api):
+        try:
+            api.disconnect()
+        except Exception:
+            pass
+
+    def acquire(self):
+        # type: () -> Tuple[object, dict]
+        """
+        取出一个可用连接，没有空闲连接且连接数未达上限时新建连接，否则等待其他线程归还
+        :return: (api, server)
+        """
+        if self._closed:
+            raise RuntimeError('TdxPool: 连接池已关闭！')
+        while True:
+            try:
+                api, server, last_used = self._idle.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    create = self._created < self.size
+                    if create:
+                        self._created += 1
+                if create:
+                    try:
+                        return self._connect()
+                    except Exception:
+                        with self._lock:
+                            self._created -= 1
+                        raise
+                try:
+                    # 定时唤醒，以便其他线程丢弃连接后能够新建连接
+                    api, server, last_used = self._idle.get(timeout=1.0)
+                except queue.Empty:
+                    continue
+
+            if time.time() - last_used < self.health_interval or self._healthy(api):
+                return api, server
+            log.warning(f"TdxPool: 服务器{server['ip']}:{server['port']}连接失效，重新连接")
+            self.discard(api, server)
+
+    def release(self, api, server):
+        """
+        归还连接
+        """
+        if self._closed:
+            self._disconnect(api)
+            with self._lock:
+                self._created -= 1
+        else:
+            self._idle.put((api, server, time.time()))
+
+    def discard(self, api, server):
+        """
+        丢弃故障连接，并将对应服务器降级，连接数空出后由acquire新建连接
+        """
+        self._disconnect(api)
+        self._demote(server)
+        with self._lock:
+            self._created -= 1
+
+    @contextmanager
+    def connection(self):
+        """
+        以上下文管理方式使用连接，代码块中抛出异常时丢弃该连接
+
+        :example:
+
+        .. code-block:: python
+
+            with get_tdx_pool().connection() as api:
+                data = fetch_price('000001', freq='1min', api=api)
+
+        """
+        api, server = self.acquire()
+        try:
+            yield api
+        except Exception:
+            self.discard(api, server)
+            raise
+        else:
+            self.release(api, server)
+
+    def call(self, func, *args, **kwargs):
+        """
+        使用连接池中的连接执行func(api, *args, **kwargs)，失败时切换连接重试retries次
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                with self.connection() as api:
+                    return func(api, *args, **kwargs)
+            except Exception as e:
+                if attempt >= self.retries:
+                    raise
+                log.warning(f'TdxPool: 请求失败，切换连接重试({attempt + 1}/{self.retries})！{e}')
+
+    def imap(self, func, items, workers=None):
+        # type: (Callable, Iterable, Optional[int]) -> Iterator[Tuple[object, object]]
+        """
+        并发执行批量请求，每个请求调用func(api, item)，按完成顺序返回(item, 结果)；
+        请求重试后仍然失败时，结果为对应的异常对象。同时提交的请求数量有上限，items可以是生成器。
+
+        :param func: 请求函数，第一个参数为连接对象
+        :param items: 请求参数序列
+        :param workers: 并发线程数，默认为连接数量
+
+        :example:
+
+        .. code-block:: python
+
+            pool = get_tdx_pool()
+            for code, data in pool.imap(lambda api, x: fetch_stock_xdxr(x, api=api), stock_list):
+                ...
+
+        """
+        workers = workers or self.size
+        items = iter(items)
+
+        def _run(item):
+            try:
+                return item, self.call(func, item)
+            except Exception as e:
+                return item, e
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            for item in items:
+                pending.add(executor.submit(_run, item))
+                if len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+    def close(self):
+        """
+        关闭所有空闲连接，正在使用的连接在归还时关闭
+        """
+        self._closed = True
+        while True:
+            try:
+                api, _, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._disconnect(api)
+            with self._lock:
+                self._created -= 1
+
+
+_pool = None  # type: Optional[TdxPool]
+_pool_lock = threading.Lock()
+
+
+def get_tdx_pool():
+    # type: () -> TdxPool
+    """
+    获取进程内共享的通达信连接池，连接数量由配置项 [TDX] pool_size 设置，默认4个
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool._closed:
+            _pool = TdxPool(int(get_config('TDX', 'pool_size', '4')))
+        return _pool
@@ -0,0 +1,71 @@
+# coding :utf-8
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016-2019 XuHaiJiang/QFF
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+分钟回测日内循环开销基准测试
+
+对比原逐分钟strptime/strftime生成分钟列表的方式与预计算分钟网格方式，在一年交易日上的单日耗时。
+运行方式: python test/bench_trade_min_list.py
+"""
+
+import time
+from datetime import datetime, timedelta
+from qff.tools.date import get_trade_days, get_trade_min_list
+
+
+def legacy_trade_min_list(day, period=1):
+    min_list = []
+    dt = day + " 09:30:00"
+    while dt <= day + " 15:00:00":
+        min_list.append(dt)
+        dt = (datetime.strptime(dt, "%Y-%m-%d %H:%M:%S")
+              + timedelta(minutes=period)).strftime("%Y-%m-%d %H:%M:%S")
+        if day + " 11:30:00" < dt < day + " 13:00:00":
+            dt = day + " 13:00:00"
+            dt = (datetime.strptime(dt, "%Y-%m-%d %H:%M:%S")
+                  + timedelta(minutes=period)).strftime("%Y-%m-%d %H:%M:%S")
+    return min_list
+
+
+def backtest_loop(days, func):
+    # 模拟_back_test_run分钟频率下每日的分钟循环
+    start = time.perf_counter()
+    for day in days:
+        for _min in func(day)[1:]:
+            pass
+    return (time.perf_counter() - start) / len(days) * 1e6
+
+
+if __name__ == '__main__':
+    days = get_trade_days('2021-01-01', '2021-12-31')
+    legacy = backtest_loop(days, legacy_trade_min_list)
+    cold = backtest_loop(days, get_trade_min_list)  # 首次生成当日分钟列表
+    warm = backtest_loop(days, get_trade_min_list)  # 命中分钟列表缓存
+    for period in [1, 5, 15, 30, 60]:
+        assert all(get_trade_min_list(day, period) == legacy_trade_min_list(day, period) for day in days)
+
+    print("交易日数量: {}".format(len(days)))
+    print("原分钟列表生成: {:.1f} us/日".format(legacy))
+    print("预计算分钟网格: {:.1f} us/日 (加速比 {:.1f}x)".format(cold, legacy / cold))
+    print("分钟列表缓存命中: {:.1f} us/日 (加速比 {:.1f}x)".format(warm, legacy / warm))
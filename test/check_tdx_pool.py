@@ -0,0 +1,82 @@
+# coding :utf-8
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016-2019 XuHaiJiang/QFF
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+"""
+通达信连接池故障切换检查
+
+使用模拟pytdx接口的FakeApi对象代替真实连接：服务器bad.host无法连接，服务器flaky.host上的连接在处理若干请求后断开，
+检查连接池能否切换服务器、重建连接并完成全部请求；同时检查默认创建的pytdx连接在网络错误时抛出异常。
+运行方式: python test/check_tdx_pool.py
+"""
+
+import threading
+from qff.tools.tdx_pool import TdxPool
+
+
+class FakeApi:
+    connects = 0
+    lock = threading.Lock()
+
+    def __init__(self):
+        self.host = None
+        self.calls = 0
+
+    def connect(self, ip, port):
+        with FakeApi.lock:
+            FakeApi.connects += 1
+        if ip == 'bad.host':
+            raise ConnectionRefusedError(ip)
+        self.host = ip
+        return self
+
+    def disconnect(self):
+        self.host = None
+
+    def get_security_count(self, market):
+        return 1000 if self.host else None
+
+    def get_xdxr_info(self, market, code):
+        self.calls += 1
+        if self.host == 'flaky.host' and self.calls > 3:
+            raise ConnectionResetError(self.host)
+        return [{'code': code, 'host': self.host}]
+
+
+if __name__ == '__main__':
+    servers = [{'ip': 'bad.host', 'port': 7709}, {'ip': 'flaky.host', 'port': 7709},
+               {'ip': 'good.host', 'port': 7709}]
+    pool = TdxPool(size=3, servers=servers, api_factory=FakeApi, retries=3)
+    codes = ['{:06d}'.format(i) for i in range(200)]
+    results = dict(pool.imap(lambda api, code: api.get_xdxr_info(0, code), codes))
+    errors = [code for code, data in results.items() if isinstance(data, Exception)]
+    pool.close()
+
+    assert len(results) == len(codes), '请求数量不一致'
+    assert len(errors) == 0, f'请求失败：{errors[:5]}'
+    assert pool.servers[-1]['ip'] in ('bad.host', 'flaky.host'), '故障服务器未降级'
+    print(f'完成请求{len(results)}个，建立连接{FakeApi.connects}次，故障切换{pool.failovers}次，'
+          f"服务器顺序：{[x['ip'] for x in pool.servers]}")
+
+    # 默认连接需在网络错误时抛出异常，否则pytdx返回None，连接池无法触发故障切换
+    default_api = TdxPool(size=1, servers=servers)._api_factory()
+    assert default_api.raise_exception, '默认连接未设置raise_exception'
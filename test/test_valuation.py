@@ -0,0 +1,89 @@
+# coding :utf-8
+#
+# The MIT License (MIT)
+#
+# Copyright (c) 2016-2019 XuHaiJiang/QFF
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+估值数据批量计算检查
+
+对数据库中的几只股票，分别用save_valuation_by_code(逐只计算)和_build_valuation(批量计算)从2005-01-04开始计算估值数据，
+检查两者结果一致。两种方式都将非交易日发布的财报顺延到下一交易日生效。逐只计算写入的valuation数据集被替换为模拟对象，
+不修改数据库。测试需要可连接的MongoDB数据库，无法连接时跳过。
+运行方式: python test/test_valuation.py
+"""
+
+import unittest
+import numpy as np
+import pandas as pd
+import pymongo
+from unittest import mock
+from qff.store import save_valuation
+from qff.tools.mongo import DATABASE
+
+
+class _Database:
+    # 读取真实数据库，valuation数据集替换为模拟对象，记录写入的数据
+    def __init__(self, db):
+        self._db = db
+        self.valuation = mock.MagicMock()
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+
+class TestValuation(unittest.TestCase):
+    codes = ['000001', '600000', '600519']
+    start = '2005-01-04'
+    columns = [col for col in save_valuation._VAL_FIELDS if col != 'code']
+
+    @classmethod
+    def setUpClass(cls):
+        try:
+            DATABASE.client.admin.command('ping')
+        except pymongo.errors.PyMongoError:
+            raise unittest.SkipTest('无法连接MongoDB数据库')
+
+    def _by_code(self, code):
+        db = _Database(DATABASE)
+        err = []
+        with mock.patch.object(save_valuation, 'DATABASE', db):
+            save_valuation.save_valuation_by_code(code, err)
+        self.assertEqual(err, [])
+        docs = db.valuation.insert_many.call_args[0][0]
+        return pd.DataFrame(docs).set_index('date')[self.columns].replace([np.inf, -np.inf], np.nan)
+
+    def test_build_valuation(self):
+        codes = [code for code in self.codes if DATABASE.stock_day.count_documents({'code': code}, limit=1) > 0]
+        if len(codes) == 0:
+            self.skipTest('数据库中没有日线数据')
+
+        data = save_valuation._build_valuation(codes, dict.fromkeys(codes, self.start))
+        for code in codes:
+            with self.subTest(code=code):
+                expected = self._by_code(code)
+                result = data[data['code'] == code].set_index('date')[self.columns]
+                pd.testing.assert_frame_equal(result.astype('float64'), expected.astype('float64'),
+                                              check_exact=False, rtol=1e-9, check_names=False)
+
+
+if __name__ == '__main__':
+    unittest.main()